@@ -1,123 +1,276 @@
+import time
+IMPORTED_AT = time.monotonic()  # start of the import-to-first-token clock, before the heavy imports
+
 import asyncio
+from contextlib import asynccontextmanager, nullcontext
 from fastapi import FastAPI, Request
 from fastapi.responses import StreamingResponse
-from models.inference_engine import TinyLLamaModel
 from pydantic import BaseModel
-from utils.batching import RequestQueueManager, BatchedRequest
-from fastapi.responses import PlainTextResponse
-from utils.logger import logger
-from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST, Summary
-from fastapi.responses import Response
-import time
-from utils.model_manager import ModelManager
+from utils.admission import RequestTooLargeError, TokenAdmission
+from utils.batching import RequestQueueManager, BatchedRequest, QueueFullError
+from utils.bulk_jobs import BulkJobManager, LineRejected
+from utils.cancellation import CancelToken
+from utils.config import BATCH_SIZE_LIMIT
+from utils.streaming import TokenChannel
+from fastapi.responses import JSONResponse, PlainTextResponse
+from utils.logger import REQUEST, logger
+from prometheus_client import Counter, Gauge, Histogram, Info, generate_latest, CONTENT_TYPE_LATEST, Summary
+from fastapi.responses import FileResponse, Response
 from utils.multi_model_manager import MultiModelManager
-from utils.autoscaler import Autoscaler
-import traceback
-from typing import List
-from prometheus_client import make_asgi_app
+from utils.model_registry import ModelMemoryError, ModelRegistry, UnknownModelError
+from utils import config
+from models.inference_engine import PromptTokenizer
+from utils.autoscaler import Autoscaler, LoadSignals
+from utils.load_balancing import ROUTED_LATENCY
+from utils.telemetry import TIME_TO_FIRST_TOKEN
+from typing import List, Optional
 import os
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from models.inference_engine import load_model
-
-if os.getenv("TESTING") == "1":
-    from unittest.mock import AsyncMock
-    model_worker = AsyncMock()
-else:
-    model_worker = load_model()
 
 
-NUM_MODEL_WORKERS = 3
-BATCH_SIZE_LIMIT = 32  # Maximum number of requests in a batch
+NUM_MODEL_WORKERS = config.NUM_WORKERS
 REQUEST_COUNT = Counter("inference_requests_total", "Total number of inference requests")
 RETRY_COUNT = Counter("inference_retries_total", "Total number of retries")
 INFERENCE_LATENCY = Histogram("inference_request_duration_seconds", "Duration of inference requests")
+STARTUP_SECONDS = Gauge(
+    "startup_seconds",
+    "Seconds from importing the API to each startup milestone (first_worker_ready, all_workers_ready, first_token)",
+    ["milestone"]
+)
+# What this instance runs with, so tuned and untuned hosts can be told apart across the fleet
+SERVING_CONFIG = Info("infersafe_serving_config", "Worker and llama.cpp parameters in effect")
+SERVING_CONFIG.info({
+    "workers": str(config.NUM_WORKERS), "n_threads": str(config.N_THREADS),
+    "worker_concurrency": str(config.WORKER_CONCURRENCY), "n_batch": str(config.N_BATCH), "n_ctx": str(config.N_CTX),
+    "use_mmap": str(config.USE_MMAP), "use_mlock": str(config.USE_MLOCK),
+    "tuned_config": config.TUNED_CONFIG_PATH if config.TUNED else "",
+})
 
 MAX_RETRIES = 5
 INFERENCE_TIMEOUT = 10  # seconds
 
-MODEL_PATH = os.path.join(os.path.dirname(__file__), "..", "models", "tinyllama-1.1b-chat-v1.0.Q4_K_M.gguf")
-MODEL_PATH = os.path.abspath(MODEL_PATH)
-
-if os.getenv("TESTING") != "1":
-    model = TinyLLamaModel(model_path=MODEL_PATH)
+MODEL_PATH = config.MODEL_PATH
 
+# Nothing is loaded at import; the lifespan hook brings the workers up concurrently
 model_manager = MultiModelManager(
     num_workers=NUM_MODEL_WORKERS,
-    model_path=MODEL_PATH
+    model_path=MODEL_PATH,
+    lazy=True
 )
 
 # model_worker = model_manager.get_least_busy_model()  # ❌ Replaced by get_model_worker for better testability
 
 # ✅ New: Use this getter so we can easily mock it in tests
-def get_model_worker():
-    return model_manager.get_least_busy_model()
+def get_model_worker(prompt=None, max_tokens=128, policy=None, prompt_tokens=None, manager=None):
+    return (manager or model_manager).select_worker(prompt, max_tokens, policy, prompt_tokens)
+
+# Other models in config.MODELS get their own pool on first use; the autoscaler spreads workers over all of them
+# A model with requests queued for it is never evicted from under them
+model_registry = ModelRegistry(config.MODELS, config.DEFAULT_MODEL, model_manager,
+                               queued=lambda name: request_manager.queued_for(name))
+
+load_signals = LoadSignals()  # queue wait and latency samples the autoscaler scales on
+# Prompt tokens are counted once at enqueue; estimated from length until the tokenizer has loaded
+tokenizer = PromptTokenizer(MODEL_PATH)
+request_manager = RequestQueueManager(admission=TokenAdmission(tokenizer))
+# With a shared queue (INFERSAFE_QUEUE_BACKEND=sqlite) each process scales on its share of the cluster-wide backlog
+autoscaler = Autoscaler(model_registry, scale_interval=5, queue_depth=request_manager.share, signals=load_signals)
+
+async def run_bulk_line(prompt: str, max_tokens: int, model: Optional[str] = None) -> str:
+    # Straight to an idle worker: no batch window and no streaming, bulk_jobs decides how many run at once
+    prompt, max_tokens, prompt_tokens = request_manager.admission.admit(prompt, max_tokens)
+    holding = nullcontext(model_manager) if model in (None, model_registry.default) else model_registry.hold(model)
+    try:
+        async with holding as manager:
+            idle = [worker for worker in manager.models if worker.is_idle()]
+            worker = idle[0] if idle else get_model_worker(prompt, max_tokens, manager.routing_policy(), prompt_tokens, manager)
+            with worker.reserve(prompt, max_tokens, prompt_tokens):
+                return await asyncio.wait_for(
+                    worker.generate(prompt, max_tokens, cancel=CancelToken(), prompt_tokens=prompt_tokens, reserved=True),
+                    config.BULK_LINE_TIMEOUT
+                )
+    except UnknownModelError as e:
+        raise LineRejected(str(e))
+
+def bulk_paused(manager=None, queue=None) -> bool:
+    # Bulk lines can't be preempted, so they only take workers nobody else needs: none while interactive
+    # requests are queued, and never the last BULK_IDLE_RESERVE idle workers, kept for the next arrival
+    manager, queue = manager or model_manager, queue or request_manager
+    idle = sum(worker.is_idle() for worker in manager.models)
+    return queue.depth() > 0 or not manager.is_ready() or idle <= config.BULK_IDLE_RESERVE
+
+bulk_jobs = BulkJobManager(
+    run_bulk_line, concurrency=lambda: config.BULK_CONCURRENCY or len(model_manager.models), paused=bulk_paused
+)
+_startup_milestones = set()
+_background_tasks = set()
 
-autoscaler = Autoscaler(model_manager, scale_interval=5)  # Autoscaler instance
+def _milestone(name: str):
+    # Each milestone is recorded once, the first time it is reached
+    if name not in _startup_milestones:
+        _startup_milestones.add(name)
+        STARTUP_SECONDS.labels(milestone=name).set(time.monotonic() - IMPORTED_AT)
+        logger.info(f"[STARTUP] {name} after {time.monotonic() - IMPORTED_AT:.2f}s")
 
-app = FastAPI()
+def _spawn(coro):
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+async def load_tokenizer():
+    try:
+        await asyncio.get_event_loop().run_in_executor(None, tokenizer.load)
+    except Exception as e:
+        logger.warning("[ADMISSION] Tokenizer unavailable, estimating prompt tokens from length: %s", e)
+
+async def start_workers():
+    try:
+        await model_manager.start(on_worker_ready=lambda worker: _milestone("first_worker_ready"))
+    except Exception as e:
+        logger.error(f"[STARTUP] Worker initialisation failed: {e}")
+        return
+    _milestone("all_workers_ready")
+    # Scaling decisions only make sense once the initial workers are in
+    model_manager.replenish_spares()
+    _spawn(autoscaler.start_scaling())
+    bulk_jobs.resume()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if os.getenv("TESTING") != "1":
+        _spawn(load_tokenizer())
+        _spawn(start_workers())
+    # One batch in flight per worker; more would only queue for the worker token slots
+    _spawn(request_manager.start_loop(process_batch, lambda: len(model_manager.models)))
+    yield
+    for task in list(_background_tasks):
+        task.cancel()
+    await bulk_jobs.close()
+    request_manager.close()
+    await model_registry.close()
+    await model_manager.close()
+
+app = FastAPI(lifespan=lifespan)
 
 @app.get("/")
 def read_root():
     return {"message": "InferSafe is up!"}
 
-metrics_app = make_asgi_app()
-app.mount("/metrics", metrics_app)
-request_manager = RequestQueueManager()
+@app.get("/ready")
+def ready():
+    # Readiness probe: 503 until at least one worker can serve, more join as they finish loading
+    body = {"ready": model_manager.is_ready(), "workers": len(model_manager.models), "target": model_manager.num_workers}
+    return JSONResponse(body, status_code=200 if body["ready"] else 503)
 
 class GenerateRequest(BaseModel):
     prompt: str
     max_tokens: int = 128
-
-@app.on_event("startup")
-async def on_startup():
-    asyncio.create_task(autoscaler.start_scaling())
-    asyncio.create_task(request_manager.start_loop(process_batch))
+    model: Optional[str] = None  # a name from INFERSAFE_MODELS; the default model if omitted
 
 @app.get("/metrics")
 async def metrics():
+    model_manager.report_memory()
+    model_registry.report_memory()
     return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
+def _already_streamed(req: BatchedRequest) -> bool:
+    # Once tokens reached the client a retry would send them twice, so give up instead
+    return req.emitted > 0
+
+async def process_request(i: int, req: BatchedRequest) -> bool:
+    # Observed once per request, however many attempts it took
+    load_signals.queue_wait.add(time.monotonic() - req.enqueued_at)
+    start = time.time()
+    ok = await _process_with_retries(i, req)
+    INFERENCE_LATENCY.observe(time.time() - start)
+    req.trace.finish("ok" if ok else "cancelled" if req.cancel_event.is_set() else "error")
+    return ok
+
+def _manager_for(req: BatchedRequest):
+    # Held for the whole attempt, so the pool can't be evicted between routing and generating
+    if req.model is None:
+        return nullcontext(model_manager)
+    return model_registry.hold(req.model)  # reloads the model if it was evicted while queued
+
+async def _process_with_retries(i: int, req: BatchedRequest) -> bool:
+    worker = None
+    for attempt in range(MAX_RETRIES + 1):
+        if req.cancel_event.is_set():
+            # Every caller gave up (disconnect or timeout), don't spend a worker on it
+            req.future.cancel()
+            return False
+        start = time.time()
+        try:
+            async with _manager_for(req) as manager:
+                policy = manager.routing_policy()
+                worker = get_model_worker(req.prompt, req.max_tokens, policy, req.prompt_tokens, manager)  # ✅ Use the getter here
+                on_token = None
+                if req.channels:
+                    on_token = req.emit_async if worker.tokens_on_loop else req.emit
+                # Reserved here, not inside generate: wait_for runs it as its own task, so the rest of
+                # the batch would route before any of it was counted. Released before a retry re-routes
+                with worker.reserve(req.prompt, req.max_tokens, req.prompt_tokens):
+                    token_stream = await asyncio.wait_for(
+                        worker.generate(req.prompt, req.max_tokens, on_token=on_token, cancel=req.cancel_event,
+                                        trace=req.trace, prompt_tokens=req.prompt_tokens, reserved=True),
+                        timeout=INFERENCE_TIMEOUT
+                    )
+            duration = time.time() - start
+            ROUTED_LATENCY.labels(policy=policy.name).observe(duration)
+            load_signals.latency.add(time.monotonic() - req.enqueued_at)
+            if req.cancel_event.is_set():
+                # Partial output of an abandoned request, never hand it to the response cache
+                req.future.cancel()
+                return False
+            if not req.future.done():
+                req.future.set_result(token_stream)
+            logger.log(REQUEST, "[BATCH] Request %d processed by %s in %.2f seconds", i, worker.name, duration)
+            return True
+        except asyncio.TimeoutError:
+            RETRY_COUNT.inc()
+            logger.error("[TIMEOUT] Request #%d attempt %d timed out after %ss", i + 1, attempt + 1, INFERENCE_TIMEOUT)
+            if _already_streamed(req):
+                break
+        except (UnknownModelError, ModelMemoryError) as e:
+            # The registry can't serve this model right now; retrying at once won't change that
+            logger.warning("[REGISTRY] Request #%d for model %s failed: %s", i + 1, req.model, e)
+            if not req.future.done():
+                req.future.set_exception(e)
+            return False
+        except RequestTooLargeError as e:
+            # The worker's own context can't hold it; the same on every attempt
+            logger.warning("[ADMISSION] Request #%d does not fit %s: %s", i + 1, worker.name, e)
+            if not req.future.done():
+                req.future.set_exception(e)
+            return False
+        except Exception as e:
+            RETRY_COUNT.inc()
+            logger.error("[ERROR] Failed request #%d on attempt %d with %s: %s", i + 1, attempt + 1,
+                         worker.name if worker is not None else req.model, str(e))
+            if _already_streamed(req):
+                break
+
+    if not req.future.done():
+        req.future.set_exception(Exception("Inference failed after all retries"))
+    return False
+
 async def process_batch(batch: list[BatchedRequest]):
-    print(f"[BATCH] Processing {len(batch)} requests")
+    logger.log(REQUEST, "[BATCH] Processing %d requests", len(batch))
     REQUEST_COUNT.inc(len(batch))
-    
-    failed_requests = []
-
-    for i, req in enumerate(batch):
-        success = False
-        for attempt in range(MAX_RETRIES + 1):
-            start = time.time()
-            try:
-                worker = get_model_worker()  # ✅ Use the getter here
-                token_stream = await asyncio.wait_for(
-                    worker.generate(req.prompt, req.max_tokens),
-                    timeout=INFERENCE_TIMEOUT
-                )
-                duration = time.time() - start
-                INFERENCE_LATENCY.observe(duration)
-                if not req.future.done():
-                    req.future.set_result(token_stream)
-                logger.info(f"[BATCH] Request {i} processed by {worker.name} in {duration:.2f} seconds")
-                success = True
-                break
-            except asyncio.TimeoutError:
-                RETRY_COUNT.inc()
-                logger.error(f"[TIMEOUT] Request #{i+1} attempt {attempt+1} timed out after {INFERENCE_TIMEOUT}s")
-                if attempt == MAX_RETRIES:
-                    failed_requests.append(req)
-            except Exception as e:
-                RETRY_COUNT.inc()
-                duration = time.time() - start
-                INFERENCE_LATENCY.observe(duration)
-                logger.error(f"[ERROR] Failed request #{i+1} on attempt {attempt+1} with {worker.name}: {e}")
-                if attempt == MAX_RETRIES:
-                    failed_requests.append(req)
-        
-        if not success and not req.future.done():
-            req.future.set_exception(Exception("Inference failed after all retries"))
-    
-    logger.info(f"[BATCH] Completed batch of {len(batch)} requests. Failed: {len(failed_requests)}")
+
+    # Requests run concurrently: worker token slots bound the parallelism, and a continuous-batching
+    # worker decodes them together in one context
+    results = await asyncio.gather(*(process_request(i, req) for i, req in enumerate(batch)))
+
+    logger.log(REQUEST, "[BATCH] Completed batch of %d requests. Failed: %d", len(batch), results.count(False))
+
+def _registry_error(e: Exception) -> PlainTextResponse:
+    if isinstance(e, UnknownModelError):
+        return PlainTextResponse(str(e), status_code=404)
+    logger.warning("[REGISTRY] Rejecting request: %s", e)
+    return PlainTextResponse(str(e), status_code=503, headers={"Retry-After": "5"})
 
 @app.post("/generate-batch")
 async def generate_via_batch(request: GenerateRequest):
@@ -128,30 +281,119 @@ async def generate_via_batch(request: GenerateRequest):
         result = await future
         return PlainTextResponse(result)
 
-    future = request_manager.enqueue(request.prompt, request.max_tokens)
+    if not model_manager.is_ready():
+        return PlainTextResponse("Model workers are still loading", status_code=503, headers={"Retry-After": "5"})
+
+    arrived = time.time()
+    model = request.model if request.model != model_registry.default else None
+    if model is not None:
+        try:
+            await model_registry.get(model)  # cold-loads the model on its first request
+        except (UnknownModelError, ModelMemoryError) as e:
+            return _registry_error(e)
+        except Exception as e:
+            logger.exception("[REGISTRY] Loading model %s failed: %s", model, e)
+            return PlainTextResponse(f"Model {model} failed to load", status_code=503, headers={"Retry-After": "5"})
+
+    channel = TokenChannel()
+    try:
+        future = request_manager.enqueue(request.prompt, request.max_tokens, channel=channel, model=model)
+    except QueueFullError as e:
+        logger.warning("[QUEUE] Rejecting request, queue full (retry after %ds)", e.retry_after)
+        return PlainTextResponse(str(e), status_code=429, headers={"Retry-After": str(e.retry_after)})
+    except RequestTooLargeError as e:
+        # Would fail inside llama.cpp on every retry; tell the client now
+        logger.warning("[ADMISSION] Rejecting request: %s", e)
+        return PlainTextResponse(str(e), status_code=413)
+
+    queue_size = request_manager.depth()
+    dynamic_timeout = min(30.0, 10.0 + (queue_size / BATCH_SIZE_LIMIT) * 5.0)
+    deltas = channel.iter_until(future, timeout=dynamic_timeout)
+
+    # Headers wait for the first token or the outcome, so a model the registry can't serve (evicted
+    # and no longer loadable while queued) gets its status code instead of an error line in a 200
+    first, early_error = None, None
+    try:
+        first = await deltas.__anext__()
+    except StopAsyncIteration:
+        if future.done() and not future.cancelled() and isinstance(future.exception(), (UnknownModelError, ModelMemoryError)):
+            channel.close()
+            return _registry_error(future.exception())
+    except asyncio.CancelledError:
+        channel.close()
+        future.cancel()  # client went away before the first token
+        raise
+    except Exception as e:
+        early_error = e  # reported in the stream, like any later failure
 
     async def stream():
         try:
-            queue_size = len(request_manager.queue)
-            dynamic_timeout = min(30.0, 10.0 + (queue_size / BATCH_SIZE_LIMIT) * 5.0)
-            
-            result = await asyncio.wait_for(future, timeout=dynamic_timeout)
-            for token in result.split():
-                yield f"{token} ".encode()
+            if early_error is not None:
+                raise early_error
+            first_token = True
+            if first is not None:
+                TIME_TO_FIRST_TOKEN.observe(time.time() - arrived)
+                _milestone("first_token")
+                first_token = False
+                yield first.encode()
+            async for delta in deltas:
+                yield delta.encode()
+            result = future.result()
+            if first_token and result:
+                # Worker did not stream (e.g. a mocked model), send the full text at once
+                TIME_TO_FIRST_TOKEN.observe(time.time() - arrived)
+                _milestone("first_token")
+                yield result.encode()
         except asyncio.TimeoutError:
-            logger.error(f"Request timed out after {dynamic_timeout}s")
+            logger.error("Request timed out after %.1fs", dynamic_timeout)
             yield b"Error: Request timed out, please try again"
         except Exception as e:
-            logger.error(f"Exception during streaming: {e}")
-            traceback.print_exc()
+            logger.exception("Exception during streaming: %s", str(e))
             yield f"Error: {type(e).__name__}: {str(e)}".encode()
+        finally:
+            channel.close()
+            if not future.done():
+                future.cancel()  # client disconnected or timed out: release our claim on the generation
 
     return StreamingResponse(stream(), media_type="text/plain")
 
+@app.post("/bulk-jobs")
+async def submit_bulk_job(request: Request):
+    # Body is the JSONL itself; poll the returned job for progress, fetch /output when done
+    data = await request.body()
+    if not data.strip():
+        return PlainTextResponse("Empty JSONL body", status_code=400)
+    job = bulk_jobs.submit(data)
+    return JSONResponse(job.to_dict(), status_code=202)
+
+@app.get("/bulk-jobs/{job_id}")
+async def bulk_job_status(job_id: str):
+    job = bulk_jobs.get(job_id)
+    if job is None:
+        return PlainTextResponse(f"Unknown job {job_id}", status_code=404)
+    return job.to_dict()
+
+@app.get("/bulk-jobs/{job_id}/output")
+async def bulk_job_output(job_id: str):
+    # Lines written so far, always in input order
+    job = bulk_jobs.get(job_id)
+    if job is None or not os.path.exists(job.output_path):
+        return PlainTextResponse(f"No output for job {job_id}", status_code=404)
+    return FileResponse(job.output_path, media_type="application/x-ndjson")
+
+@app.delete("/bulk-jobs/{job_id}")
+async def cancel_bulk_job(job_id: str):
+    if not bulk_jobs.cancel(job_id):
+        return PlainTextResponse(f"Job {job_id} is not running", status_code=404)
+    return JSONResponse(bulk_jobs.get(job_id).to_dict(), status_code=202)
+
 @app.post("/reload-model")
-def reload_model():
-    try:
-        model_manager.reload_model()
-        return "Model reloaded successfully"
-    except Exception as e:
-        return Response(f"Failed to reload model: {str(e)}", status_code=500)
+async def reload_model():
+    # Rolling reload runs in the background, one worker at a time; poll /reload-model/status
+    if not model_manager.start_reload():
+        return JSONResponse(model_manager.reload_status, status_code=409)
+    return JSONResponse(model_manager.reload_status, status_code=202)
+
+@app.get("/reload-model/status")
+async def reload_status():
+    return model_manager.reload_status
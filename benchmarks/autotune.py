@@ -0,0 +1,218 @@
+"""Sweep worker and llama.cpp parameters on this host and write the best ones as a tuned config.
+
+    python benchmarks/autotune.py --model models/tinyllama-1.1b-chat-v1.0.Q4_K_M.gguf --rate 2 --duration 20
+    python benchmarks/autotune.py --model ... --replay prompts.jsonl --output /etc/infersafe/tuned.json
+
+Each candidate runs the serving benchmark (benchmarks/serving.py) against a fresh worker pool: a
+Poisson trace over the representative prompts, or a --replay file of real ones. Parameters are tuned
+one stage at a time, keeping the best value of earlier stages: worker count with threads per
+worker (workers x threads never exceed the cores available), per-worker concurrency, llama.cpp
+prompt batch size, and context size (only sizes that fit the longest request of the prompt set, and
+never below the current INFERSAFE_N_CTX without --replay: the built-in prompts are short and say
+nothing about how long real requests get). With INFERSAFE_WORKER_BACKEND=process only the worker
+count is swept in the first stage and concurrency not at all: each worker process takes a thread per
+core of its set and one request at a time, so neither setting would reach it.
+The best candidate has the highest tokens/s with p95 latency within INFERSAFE_SLO_LATENCY_SECONDS
+and nothing failed; a later value has to beat the current one by MIN_GAIN to replace it, so ties go
+to the cheaper setting. The result is written to --output (by default the file utils/config loads
+at startup) with every measurement. Prints the same JSON document. A --fake dry run only prints it
+unless --output is given: its numbers say nothing about the real model.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import resource
+import sys
+import time
+from typing import Dict, List, Optional
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from utils import config
+from utils.admission import CHAT_TEMPLATE_TOKENS, TokenAdmission
+from utils.batching import RequestQueueManager
+from utils.load_balancing import estimate_tokens
+from utils.multi_model_manager import MultiModelManager
+from benchmarks.serving import FakeModelManager, poisson_trace, replay_trace, run_benchmark
+
+MIN_GAIN = 0.03  # relative tokens/s improvement needed to prefer a later candidate
+WORKER_COUNTS = (1, 2, 3, 4, 6, 8)
+CONCURRENCY = (1, 2, 4, 8)
+N_BATCH = (128, 256, 512, 1024)
+N_CTX = (512, 1024, 2048, 4096)
+
+# Parameter name in the sweep -> setting it is written as, and the config attribute it overrides
+SETTINGS = {
+    "workers": ("INFERSAFE_NUM_WORKERS", "NUM_WORKERS"),
+    "n_threads": ("INFERSAFE_N_THREADS", "N_THREADS"),
+    "worker_concurrency": ("INFERSAFE_WORKER_CONCURRENCY", "WORKER_CONCURRENCY"),
+    "n_batch": ("INFERSAFE_N_BATCH", "N_BATCH"),
+    "n_ctx": ("INFERSAFE_N_CTX", "N_CTX"),
+}
+# A process-backend worker runs llama.cpp with one thread per core of its CorePool set and one request
+# at a time, whatever these say, so they are left out of that sweep and out of its tuned config
+NOT_FOR_PROCESS_BACKEND = ("n_threads", "worker_concurrency")
+
+
+def available_cores() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def pool_shapes(cores: int, backend: str = "thread") -> List[Dict[str, int]]:
+    # Each worker count with all cores split between workers, and with half of them (leaves room for
+    # the event loop and tokenizer, and llama.cpp often scales past the physical cores badly)
+    shapes = []
+    for workers in WORKER_COUNTS:
+        if workers > cores:
+            break
+        if backend == "process":
+            shapes.append({"workers": workers})  # threads follow from the cores each process is pinned to
+            continue
+        for threads in sorted({cores // workers, max(1, cores // (2 * workers))}, reverse=True):
+            shapes.append({"workers": workers, "n_threads": threads})
+    return shapes
+
+
+def context_sizes(trace, floor: int = 0) -> List[int]:
+    longest = max(estimate_tokens(prompt) + CHAT_TEMPLATE_TOKENS + max_tokens for _, prompt, max_tokens in trace)
+    needed = max(longest, floor)
+    fitting = [n_ctx for n_ctx in N_CTX if n_ctx >= needed]
+    if floor >= longest and floor not in fitting:
+        fitting.insert(0, floor)  # keeping the current size is always a candidate
+    return fitting or [N_CTX[-1]]
+
+
+def mlock_fits(model_path: str) -> bool:
+    # Pinning the weights only helps if all of them may be locked and they leave most of RAM free
+    try:
+        size = os.path.getsize(model_path)
+        soft, _ = resource.getrlimit(resource.RLIMIT_MEMLOCK)
+        available = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return False
+    return (soft == resource.RLIM_INFINITY or soft >= size) and size < available / 2
+
+
+def better(candidate: dict, best: Optional[dict], slo: float) -> bool:
+    """Whether `candidate`'s measurements beat `best`'s: within SLO first, then tokens/s."""
+    if best is None:
+        return True
+
+    def ok(result):
+        return result["failed"] == 0 and result["latency_p95_s"] is not None and result["latency_p95_s"] <= slo
+
+    if ok(candidate) != ok(best):
+        return ok(candidate)
+    if not ok(candidate):
+        # Neither meets the SLO: the one closer to it
+        return (candidate["latency_p95_s"] or float("inf")) < (best["latency_p95_s"] or float("inf"))
+    return candidate["tokens_per_s"] > best["tokens_per_s"] * (1 + MIN_GAIN)
+
+
+def request_queue(n_ctx: int) -> RequestQueueManager:
+    # Admission and the batch token budget take their defaults from config at import, so setting
+    # config.N_CTX doesn't reach them: build them for the candidate, the way the service would start up
+    default_budget = n_ctx * (config.BATCH_SLOTS if config.CONTINUOUS_BATCHING else 1)
+    budget = config._setting("INFERSAFE_BATCH_TOKEN_BUDGET", default_budget, int)
+    return RequestQueueManager(batch_token_budget=budget, admission=TokenAdmission(n_ctx=n_ctx))
+
+
+async def measure(params: dict, trace, args) -> dict:
+    for name, value in params.items():
+        setattr(config, SETTINGS[name][1], value)
+        os.environ[SETTINGS[name][0]] = str(value)  # spawned worker processes read their config afresh
+    with contextlib.redirect_stdout(sys.stderr):
+        if args.fake:
+            manager = FakeModelManager(params["workers"], {"token_ms": args.token_ms})
+        else:
+            manager = MultiModelManager(params["workers"], model_path=args.model)
+        try:
+            report = await run_benchmark(trace, manager, timeout=args.timeout, request_manager=request_queue(params["n_ctx"]))
+        finally:
+            await manager.close()
+    result = {
+        **params,
+        "tokens_per_s": report["tokens_per_s"],
+        "throughput_rps": report["throughput_rps"],
+        "latency_p95_s": report["latency_s"].get("p95"),
+        "ttft_p95_s": report["ttft_s"].get("p95"),
+        "failed": report["failed"] + report["rejected"],
+    }
+    print(json.dumps(result), file=sys.stderr)
+    return result
+
+
+async def autotune(args) -> dict:
+    trace = (replay_trace(args.replay, args.rate, max_tokens=args.max_tokens) if args.replay
+             else poisson_trace(args.rate, args.duration, max_tokens=args.max_tokens))
+    cores = available_cores()
+    backend = "thread" if args.fake else config.WORKER_BACKEND  # the fake pool always runs thread workers
+    best_params = {"workers": config.NUM_WORKERS, "n_threads": config.N_THREADS,
+                   "worker_concurrency": config.WORKER_CONCURRENCY, "n_batch": config.N_BATCH, "n_ctx": config.N_CTX}
+    if backend == "process":
+        best_params = {name: value for name, value in best_params.items() if name not in NOT_FOR_PROCESS_BACKEND}
+    stages = [
+        ("pool", pool_shapes(cores, backend)),
+        ("concurrency", [{"worker_concurrency": n} for n in CONCURRENCY] if backend != "process" else []),
+        ("n_batch", [{"n_batch": n} for n in N_BATCH]),
+        # Only requests replayed from production show how small the context may get
+        ("n_ctx", [{"n_ctx": n} for n in context_sizes(trace, floor=0 if args.replay else config.N_CTX)]),
+    ]
+    measurements, best = [], None
+    started = time.monotonic()
+    for stage, candidates in stages:
+        if not candidates:
+            continue
+        stage_best = None
+        for candidate in candidates:
+            params = {**best_params, **candidate}
+            result = {"stage": stage, **await measure(params, trace, args)}
+            measurements.append(result)
+            if better(result, stage_best, config.SLO_LATENCY_SECONDS):
+                stage_best = result
+        best_params = {name: stage_best[name] for name in best_params}
+        best = stage_best
+
+    settings = {SETTINGS[name][0]: value for name, value in best_params.items()}
+    if args.model and not args.fake:
+        settings["INFERSAFE_USE_MLOCK"] = mlock_fits(args.model)
+    return {
+        "settings": settings,
+        "best": best,
+        "host": {"cores": cores, "backend": backend, "model": None if args.fake else args.model, "tuned_at": time.strftime("%Y-%m-%dT%H:%M:%S%z")},
+        "trace": {"requests": len(trace), "rate": args.rate, "replay": args.replay, "max_tokens": args.max_tokens},
+        "slo_latency_s": config.SLO_LATENCY_SECONDS,
+        "sweep_seconds": round(time.monotonic() - started, 1),
+        "measurements": measurements,
+    }
+
+
+async def main(args):
+    tuned = await autotune(args)
+    output = args.output
+    if output is None and not args.fake:
+        output = config.TUNED_CONFIG_PATH
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(tuned, f, indent=2)
+    else:
+        print(f"Dry run with --fake, {config.TUNED_CONFIG_PATH} left alone (pass --output to write one)", file=sys.stderr)
+    print(json.dumps(tuned, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model", default=config.MODEL_PATH, help="GGUF model to tune for")
+    parser.add_argument("--replay", help="JSONL of representative requests, see benchmarks/serving.py")
+    parser.add_argument("--rate", type=float, default=2.0, help="arrivals per second, high enough to load every candidate")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds of arrivals per candidate")
+    parser.add_argument("--max-tokens", type=int, default=64)
+    parser.add_argument("--timeout", type=float, default=60.0, help="seconds a request may take before it counts as failed")
+    parser.add_argument("--output", help=f"tuned config to write (default {config.TUNED_CONFIG_PATH}, nothing with --fake)")
+    parser.add_argument("--fake", action="store_true", help="fake model (only worker count and concurrency matter), for a dry run")
+    parser.add_argument("--token-ms", type=float, default=20.0, help="fake model: ms per generated token")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,77 @@
+"""Aggregate decode throughput: sequential TinyLLamaModel vs ContinuousBatchingEngine.
+
+    python benchmarks/continuous_batching.py --model models/tinyllama-1.1b-chat-v1.0.Q4_K_M.gguf
+
+For each concurrency level, N prompts are generated one after another on a TinyLLamaModel (the old
+process_batch behaviour) and all at once on an engine with N slots. Prints one JSON document.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from models.inference_engine import ContinuousBatchingEngine, TinyLLamaModel
+
+PROMPTS = [
+    "Explain what a hash map is in two sentences.",
+    "Write a haiku about autumn.",
+    "List three uses of Python decorators.",
+    "Summarise the plot of Hamlet briefly.",
+    "What is the capital of Australia and why?",
+    "Give one tip for writing unit tests.",
+    "Describe a rainbow to a child.",
+    "What does HTTP 429 mean?",
+]
+
+
+def count_tokens(model, texts):
+    llm = model.llm if hasattr(model, "llm") else model.base
+    return sum(len(llm.tokenize(text.encode("utf-8"), add_bos=False)) for text in texts)
+
+
+async def run_sequential(model, prompts, max_tokens):
+    start = time.perf_counter()
+    texts = [await model.generate(prompt, max_tokens) for prompt in prompts]
+    return texts, time.perf_counter() - start
+
+
+async def run_concurrent(model, prompts, max_tokens):
+    start = time.perf_counter()
+    texts = await asyncio.gather(*(model.generate(prompt, max_tokens) for prompt in prompts))
+    return texts, time.perf_counter() - start
+
+
+async def main(args):
+    results = []
+    sequential = TinyLLamaModel(args.model, n_threads=args.threads)
+    for concurrency in args.concurrency:
+        prompts = [PROMPTS[i % len(PROMPTS)] for i in range(concurrency)]
+        texts, seconds = await run_sequential(sequential, prompts, args.max_tokens)
+        seq_tokens = count_tokens(sequential, texts)
+
+        engine = ContinuousBatchingEngine(args.model, n_slots=concurrency, n_threads=args.threads)
+        texts, cb_seconds = await run_concurrent(engine, prompts, args.max_tokens)
+        cb_tokens = count_tokens(engine, texts)
+        engine.close()
+
+        results.append({
+            "concurrency": concurrency,
+            "sequential_tokens_per_s": round(seq_tokens / seconds, 2),
+            "continuous_tokens_per_s": round(cb_tokens / cb_seconds, 2),
+            "sequential_seconds": round(seconds, 3),
+            "continuous_seconds": round(cb_seconds, 3),
+        })
+    sequential.close()
+    print(json.dumps({"benchmark": "continuous_batching", "max_tokens": args.max_tokens, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model", required=True, help="Path to a GGUF model")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--max-tokens", type=int, default=64)
+    parser.add_argument("--threads", type=int, default=4)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,126 @@
+"""Event-loop lag under request logging: synchronous FileHandler vs the queued pipeline in utils/logger.
+
+    python benchmarks/logging_lag.py --requests 20000
+
+Simulated requests arrive at --rate and each log the lines the hot path logs (enqueue, routing,
+worker start/finish, batch done) while a probe coroutine measures how late a 5 ms sleep wakes up. `sync` is the old
+setup (f-strings, FileHandler written on the loop); `queued` hands records to a background writer
+with lazy formatting; `queued_rate_limited` also applies the REQUEST-level rate limit.
+
+By default every record is fsynced, standing in for a slow or busy disk: that is where writing on
+the loop hurts, and where the queued pipeline cuts p99 lag. With --no-fsync the writes land in the
+page cache and all three setups show about the same lag, so the plain-disk case is no gain.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from utils import config
+from utils.logger import REQUEST, configure
+
+PROBE_INTERVAL = 0.005
+
+
+class FsyncFileHandler(logging.FileHandler):
+    def emit(self, record):
+        super().emit(record)
+        self.flush()
+        os.fsync(self.stream.fileno())
+
+
+def sync_logger(path: str, fsync: bool) -> logging.Logger:
+    log = logging.getLogger(f"bench_sync_{path}")
+    log.setLevel(logging.INFO)
+    log.propagate = False
+    handler = FsyncFileHandler(path) if fsync else logging.FileHandler(path)
+    handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+    log.addHandler(handler)
+    return log
+
+
+def queued_logger(path: str, fsync: bool, rate_limited: bool) -> logging.Logger:
+    config.LOG_REQUEST_RATE = 20.0 if rate_limited else float("inf")
+    log = configure(f"bench_queued_{path}", path)
+    if fsync:
+        listener_handler = FsyncFileHandler(path)
+        listener_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+        # Swap the rotating handler for a durable one; rotation itself is not what we measure
+        for handler in log.handlers:
+            handler.listener.handlers = (listener_handler,)
+    return log
+
+
+async def request(log: logging.Logger, i: int, lazy: bool):
+    prompt = f"Write me a haiku about autumn {i}"
+    if lazy:
+        log.log(REQUEST, "[QUEUE] Enqueuing prompt: %.30s, queue size: %d", prompt, i % 10)
+        log.log(REQUEST, "[Manager] Selected %s (in-flight: %d)", "worker_0", i % 4)
+        log.log(REQUEST, "[%s] Processing prompt: %.30s...", "worker_0", prompt)
+        await asyncio.sleep(0)
+        log.log(REQUEST, "[%s] Completed prompt: %.30s", "worker_0", prompt)
+        log.log(REQUEST, "[BATCH] Request %d processed by %s in %.2f seconds", i, "worker_0", 0.5)
+    else:
+        log.info(f"[QUEUE] Enqueuing prompt: {prompt[:30]}, queue size: {i % 10}")
+        log.info(f"[Manager] Selected worker_0 (in-flight: {i % 4})")
+        log.info(f"[worker_0] Processing prompt: {prompt[:30]}...")
+        await asyncio.sleep(0)
+        log.info(f"[worker_0] Completed prompt: {prompt[:30]}")
+        log.info(f"[BATCH] Request {i} processed by worker_0 in {0.5:.2f} seconds")
+
+
+async def run(log: logging.Logger, requests: int, concurrency: int, rate: float, lazy: bool) -> dict:
+    lags = []
+    done = asyncio.Event()
+
+    async def probe():
+        while not done.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(PROBE_INTERVAL)
+            lags.append(time.perf_counter() - start - PROBE_INTERVAL)
+
+    async def client(offset):
+        for i in range(offset, requests, concurrency):
+            await request(log, i, lazy)
+            await asyncio.sleep(concurrency / rate)  # open loop: leave the loop idle between requests
+
+    probe_task = asyncio.ensure_future(probe())
+    start = time.perf_counter()
+    await asyncio.gather(*(client(c) for c in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    done.set()
+    await probe_task
+
+    lags.sort()
+    pick = lambda q: round(lags[min(len(lags) - 1, int(q * len(lags)))] * 1000, 3)
+    return {"requests_per_s": round(requests / elapsed, 1), "lag_ms_p50": pick(0.5), "lag_ms_p99": pick(0.99),
+            "lag_ms_max": round(lags[-1] * 1000, 3), "probes": len(lags)}
+
+
+async def main(args):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        setups = [
+            ("sync", sync_logger(os.path.join(tmp, "sync.log"), args.fsync), False),
+            ("queued", queued_logger(os.path.join(tmp, "queued.log"), args.fsync, rate_limited=False), True),
+            ("queued_rate_limited", queued_logger(os.path.join(tmp, "limited.log"), args.fsync, rate_limited=True), True),
+        ]
+        for name, log, lazy in setups:
+            results[name] = await run(log, args.requests, args.concurrency, args.rate, lazy)
+    print(json.dumps({"benchmark": "logging_lag", "requests": args.requests, "rate": args.rate, "fsync": args.fsync,
+                      "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--rate", type=float, default=2000.0, help="target requests per second across all clients")
+    parser.add_argument("--fsync", action=argparse.BooleanOptionalAction, default=True,
+                        help="fsync after every record (default), --no-fsync for plain buffered writes")
+    asyncio.run(main(parser.parse_args()))
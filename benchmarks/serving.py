@@ -0,0 +1,330 @@
+"""Offline, in-process benchmark of the serving stack under open-loop arrival traces.
+
+    python benchmarks/serving.py --trace poisson --rate 8 --duration 30 --workers 3
+    python benchmarks/serving.py --trace bursty --rate 4 --burst-rate 20 --autoscale
+    python benchmarks/serving.py --trace replay --replay prompts.jsonl --rate 5
+    python benchmarks/serving.py --model models/tinyllama-1.1b-chat-v1.0.Q4_K_M.gguf --rate 1 --duration 20
+    python benchmarks/serving.py --rate 8 --bulk-lines 2000  # interactive p99 with a bulk job running
+
+Requests go through the same path as /generate-batch: RequestQueueManager -> process_batch ->
+MultiModelManager -> ModelWorker, optionally with the Autoscaler running. By default workers run a
+FakeModel that sleeps for prompt processing and for every generated token, so results are
+repeatable on any machine; --model swaps in a real GGUF model. Arrivals are open loop: a request is
+sent at its scheduled time whether or not earlier ones have finished. --bulk-lines runs a bulk
+JSONL job through the same workers for the whole trace, to check interactive latency stays within
+the SLO while it does. Prints one JSON document (throughput, queue wait, TTFT, latency percentiles,
+SLO check) meant to be diffed between commits.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from utils import config
+from utils.batching import QueueFullError, RequestQueueManager
+from utils.bulk_jobs import BulkJob
+from utils.load_balancing import estimate_tokens
+from utils.multi_model_manager import MultiModelManager
+from utils.streaming import TokenChannel
+
+PROMPTS = [
+    "Explain what a hash map is in two sentences.",
+    "Write a haiku about autumn.",
+    "List three uses of Python decorators.",
+    "Summarise the plot of Hamlet briefly.",
+    "What is the capital of Australia and why?",
+    "Give one tip for writing unit tests.",
+    "Describe a rainbow to a child.",
+    "What does HTTP 429 mean?",
+]
+
+Arrival = Tuple[float, str, int]  # (seconds after start, prompt, max_tokens)
+
+
+class FakeModel:
+    """Stands in for TinyLLamaModel: same interface, latency simulated with sleeps.
+
+    One request decodes at a time per model (like the single llama.cpp context), in an executor
+    thread, emitting one token per `token_ms` after `prompt_ms_per_token` per prompt token.
+    """
+
+    def __init__(self, prompt_ms_per_token: float = 0.5, token_ms: float = 20.0, output_fraction: float = 1.0):
+        self.prompt_ms_per_token = prompt_ms_per_token
+        self.token_ms = token_ms
+        self.output_fraction = output_fraction  # share of max_tokens generated before "EOS"
+        self.tokens_avoided = 0
+        self._decode_lock = threading.Lock()
+
+    async def generate(self, prompt: str, max_tokens: int = 128, on_token: Optional[Callable[[str], None]] = None,
+                       cancel: Optional[threading.Event] = None):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self._sync_generate, prompt, max_tokens, on_token, cancel)
+
+    def _sync_generate(self, prompt, max_tokens, on_token=None, cancel=None):
+        with self._decode_lock:
+            time.sleep(estimate_tokens(prompt) * self.prompt_ms_per_token / 1000)
+            pieces = []
+            for _ in range(max(1, int(max_tokens * self.output_fraction))):
+                if cancel is not None and cancel.is_set():
+                    break
+                time.sleep(self.token_ms / 1000)
+                pieces.append(" tok")
+                if on_token is not None:
+                    on_token(" tok")
+            return "".join(pieces)
+
+    def prefix_match_chars(self, prompt: str) -> int:
+        return 0
+
+    def context_bytes(self) -> int:
+        return 0
+
+    def close(self):
+        pass
+
+
+class FakeModelManager(MultiModelManager):
+    """MultiModelManager whose workers run FakeModels; `load_seconds` simulates reading weights."""
+
+    def __init__(self, num_workers: int, fake_model_args: dict, load_seconds: float = 0.0):
+        self.fake_model_args = fake_model_args
+        self.load_seconds = load_seconds
+        super().__init__(num_workers, model_path="fake.gguf", backend="thread")
+
+    def _new_model(self, cores=None):
+        time.sleep(self.load_seconds)
+        return FakeModel(**self.fake_model_args)
+
+
+def _prompt(rng: random.Random, i: int) -> str:
+    # Numbered so identical prompts don't coalesce into one generation and flatter the numbers
+    return f"{rng.choice(PROMPTS)} (request {i})"
+
+
+def poisson_trace(rate: float, duration: float, seed: int = 0, max_tokens: int = 64) -> List[Arrival]:
+    rng = random.Random(seed)
+    arrivals, t = [], rng.expovariate(rate)
+    while t < duration:
+        arrivals.append((t, _prompt(rng, len(arrivals)), max_tokens))
+        t += rng.expovariate(rate)
+    return arrivals
+
+
+def bursty_trace(rate: float, burst_rate: float, duration: float, burst_every: float = 10.0,
+                 burst_length: float = 2.0, seed: int = 0, max_tokens: int = 64) -> List[Arrival]:
+    # Poisson at `rate`, switching to `burst_rate` for `burst_length` seconds every `burst_every`
+    rng = random.Random(seed)
+    arrivals, t = [], 0.0
+    while True:
+        in_burst = (t % burst_every) >= burst_every - burst_length
+        t += rng.expovariate(burst_rate if in_burst else rate)
+        if t >= duration:
+            return arrivals
+        arrivals.append((t, _prompt(rng, len(arrivals)), max_tokens))
+
+
+def replay_trace(path: str, rate: float = 1.0, seed: int = 0, max_tokens: int = 64) -> List[Arrival]:
+    """Requests from a JSONL file: {"prompt": ..., "max_tokens": ..., "at": seconds}.
+
+    Lines without "at" are spaced with Poisson gaps at `rate`. Lines without "prompt" use their
+    "body" or "title", so a backlog-style file of work items can be replayed too.
+    """
+    rng = random.Random(seed)
+    arrivals, t = [], 0.0
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            t = item["at"] if "at" in item else t + rng.expovariate(rate)
+            prompt = item.get("prompt") or item.get("body") or item.get("title", "")
+            arrivals.append((t, prompt, item.get("max_tokens", max_tokens)))
+    return sorted(arrivals)
+
+
+def percentiles(values: List[float]) -> dict:
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+
+    def pick(q):
+        return round(values[min(len(values) - 1, math.ceil(q * len(values)) - 1)], 4)
+
+    return {
+        "count": len(values), "mean": round(sum(values) / len(values), 4),
+        "p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": round(values[-1], 4),
+    }
+
+
+async def _client(request_manager, arrival: Arrival, start: float, results: dict, timeout: float):
+    at, prompt, max_tokens = arrival
+    await asyncio.sleep(max(0.0, start + at - time.monotonic()))
+    sent = time.monotonic()
+    channel = TokenChannel()
+    try:
+        future = request_manager.enqueue(prompt, max_tokens, channel=channel)
+    except QueueFullError:
+        results["rejected"] += 1
+        return
+    first_token, tokens = None, 0
+    try:
+        async for _ in channel.iter_until(future, timeout=timeout):
+            tokens += 1
+            if first_token is None:
+                first_token = time.monotonic() - sent
+        text = future.result()
+    except Exception:
+        results["failed"] += 1
+        return
+    finally:
+        channel.close()
+        if not future.done():
+            future.cancel()
+    latency = time.monotonic() - sent
+    results["ttft"].append(first_token if first_token is not None else latency)
+    results["latency"].append(latency)
+    results["tokens"] += tokens or estimate_tokens(text)
+
+
+async def run_benchmark(trace: List[Arrival], manager: MultiModelManager, *, autoscale: bool = False,
+                        scale_interval: float = 1.0, timeout: float = 60.0, bulk_lines: int = 0,
+                        bulk_max_tokens: int = 64, request_manager: Optional[RequestQueueManager] = None) -> dict:
+    """Replay `trace` against the in-process serving stack and summarise what the clients saw.
+
+    With `bulk_lines`, a bulk job of that many prompts runs alongside until the trace is done.
+    `request_manager` replaces the default queue, e.g. one built for other admission settings.
+    """
+    # api.main loads nothing at import; point its request path at our manager and queue
+    from api import main
+    from utils.autoscaler import Autoscaler, LoadSignals
+
+    request_manager = request_manager or RequestQueueManager()
+    main.model_manager = manager
+    main.request_manager = request_manager
+    main.load_signals = LoadSignals()
+    queue_waits: List[float] = []
+    worker_counts = [len(manager.models)]
+
+    async def timed_batch(batch):
+        now = time.monotonic()
+        queue_waits.extend(now - req.enqueued_at for req in batch)
+        await main.process_batch(batch)
+
+    background = [asyncio.ensure_future(request_manager.start_loop(timed_batch, lambda: len(manager.models)))]
+    if autoscale:
+        scaler = Autoscaler(manager, scale_interval=scale_interval, cooldown=scale_interval * 3,
+                            queue_depth=request_manager.depth, signals=main.load_signals)
+        background.append(asyncio.ensure_future(scaler.start_scaling()))
+
+    async def watch_workers():
+        while True:
+            await asyncio.sleep(0.1)
+            worker_counts.append(len(manager.models))
+
+    background.append(asyncio.ensure_future(watch_workers()))
+    bulk_job = None
+    if bulk_lines:
+        # Same wiring as api.main's bulk_jobs, against this benchmark's manager and queue
+        bulk_dir = tempfile.mkdtemp(prefix="bulk-benchmark-")
+        with open(os.path.join(bulk_dir, "input.jsonl"), "w") as f:
+            for i in range(bulk_lines):
+                f.write(json.dumps({"prompt": f"{PROMPTS[i % len(PROMPTS)]} (bulk {i})", "max_tokens": bulk_max_tokens}) + "\n")
+        bulk_job = BulkJob("benchmark", os.path.join(bulk_dir, "input.jsonl"), os.path.join(bulk_dir, "output.jsonl"))
+        background.append(asyncio.ensure_future(bulk_job.run(
+            main.run_bulk_line, lambda: config.BULK_CONCURRENCY or len(manager.models),
+            lambda: main.bulk_paused(manager, request_manager)
+        )))
+    results = {"rejected": 0, "failed": 0, "tokens": 0, "ttft": [], "latency": []}
+    start = time.monotonic()
+    await asyncio.gather(*(_client(request_manager, arrival, start, results, timeout) for arrival in trace))
+    elapsed = time.monotonic() - start
+    for task in background:
+        task.cancel()
+    await asyncio.gather(*background, return_exceptions=True)
+
+    completed = len(results["latency"])
+    latency = percentiles(results["latency"])
+    report = {
+        "requests": len(trace),
+        "completed": completed,
+        "rejected": results["rejected"],
+        "failed": results["failed"],
+        "duration_s": round(elapsed, 3),
+        "throughput_rps": round(completed / elapsed, 3) if elapsed else 0.0,
+        "tokens_per_s": round(results["tokens"] / elapsed, 2) if elapsed else 0.0,
+        "queue_wait_s": percentiles(queue_waits),
+        "ttft_s": percentiles(results["ttft"]),
+        "latency_s": latency,
+        "workers": {"start": worker_counts[0], "max": max(worker_counts), "end": worker_counts[-1]},
+        # p99 against the p95 target the autoscaler holds: a stricter check than the autoscaler's own
+        "slo": {"target_s": config.SLO_LATENCY_SECONDS, "latency_p99_s": latency.get("p99"),
+                "within": completed > 0 and latency["p99"] <= config.SLO_LATENCY_SECONDS},
+    }
+    if bulk_job is not None:
+        report["bulk"] = {"lines": bulk_lines, "written": bulk_job.done, "errors": bulk_job.errors,
+                          "lines_per_s": round(bulk_job.done / elapsed, 3) if elapsed else 0.0}
+    return report
+
+
+def build_trace(args) -> List[Arrival]:
+    if args.trace == "poisson":
+        return poisson_trace(args.rate, args.duration, args.seed, args.max_tokens)
+    if args.trace == "bursty":
+        return bursty_trace(args.rate, args.burst_rate, args.duration, args.burst_every, args.burst_length,
+                            args.seed, args.max_tokens)
+    return replay_trace(args.replay, args.rate, args.seed, args.max_tokens)
+
+
+def build_manager(args) -> MultiModelManager:
+    if args.model:
+        return MultiModelManager(args.workers, model_path=args.model)
+    fake = {"prompt_ms_per_token": args.prompt_ms, "token_ms": args.token_ms, "output_fraction": args.output_fraction}
+    return FakeModelManager(args.workers, fake, load_seconds=args.load_seconds)
+
+
+async def main(args):
+    trace = build_trace(args)
+    with contextlib.redirect_stdout(sys.stderr):  # keep stdout for the JSON report
+        manager = build_manager(args)
+        summary = await run_benchmark(trace, manager, autoscale=args.autoscale, scale_interval=args.scale_interval,
+                                      bulk_lines=args.bulk_lines, bulk_max_tokens=args.bulk_max_tokens)
+        await manager.close()
+    settings = {key: value for key, value in vars(args).items() if value is not None}
+    print(json.dumps({"benchmark": "serving", "config": settings, "results": summary}, indent=2))
+
+
+def parser() -> argparse.ArgumentParser:
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--trace", choices=["poisson", "bursty", "replay"], default="poisson")
+    p.add_argument("--rate", type=float, default=5.0, help="mean arrivals per second")
+    p.add_argument("--burst-rate", type=float, default=20.0, help="arrivals per second inside a burst")
+    p.add_argument("--burst-every", type=float, default=10.0, help="seconds between burst starts")
+    p.add_argument("--burst-length", type=float, default=2.0)
+    p.add_argument("--replay", help="JSONL file of requests for --trace replay")
+    p.add_argument("--duration", type=float, default=30.0, help="seconds of arrivals to generate")
+    p.add_argument("--max-tokens", type=int, default=64)
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--workers", type=int, default=3)
+    p.add_argument("--autoscale", action="store_true", help="run the Autoscaler alongside")
+    p.add_argument("--scale-interval", type=float, default=1.0)
+    p.add_argument("--bulk-lines", type=int, default=0, help="run a bulk job of this many prompts alongside")
+    p.add_argument("--bulk-max-tokens", type=int, default=64)
+    p.add_argument("--model", help="real GGUF model instead of the fake one")
+    p.add_argument("--prompt-ms", type=float, default=0.5, help="fake model: ms per prompt token")
+    p.add_argument("--token-ms", type=float, default=20.0, help="fake model: ms per generated token")
+    p.add_argument("--output-fraction", type=float, default=1.0, help="fake model: share of max_tokens generated")
+    p.add_argument("--load-seconds", type=float, default=0.0, help="fake model: time to load a worker")
+    return p
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parser().parse_args()))
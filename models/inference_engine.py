@@ -1,9 +1,36 @@
 from llama_cpp import Llama
+import llama_cpp
+import llama_cpp._internals as llama_internals
+from llama_cpp.llama_chat_format import Jinja2ChatFormatter
+import numpy as np
 import asyncio
+import codecs
+import concurrent.futures
+import contextlib
+import ctypes
 import logging
+import os
+import queue
+import threading
+import time
 from pathlib import Path
+from typing import Awaitable, Callable, Dict, Optional
+from utils import config
+from utils.admission import RequestTooLargeError
+from utils.cancellation import WASTED_TOKENS_AVOIDED, await_stoppable, stop_checker
+from models.speculative import DECODE_TOKENS_PER_SECOND, make_draft
+from utils.prefix_cache import PrefixCache
+from utils.streaming import STREAM_BUFFER_SIZE, TokenRelay
 
-MODEL_PATH = Path("models/tinyllama-1.1b-chat-v1.0.Q4_K_M.gguf")
+MODEL_PATH = Path(config.MODEL_PATH)
+
+# Private Llama attributes SharedWeights.new_context copies or replaces; they move between llama-cpp-python
+# releases, so the version is pinned in requirements.txt and checked when the weights load
+SHARED_CONTEXT_ATTRIBUTES = (
+    "_model", "_stack", "_ctx", "_batch", "_n_ctx", "_n_vocab", "_logits_all", "_candidates", "_mirostat_mu",
+    "_sampler", "_requires_eval", "_chat_handlers", "context_params", "n_batch", "n_threads", "n_threads_batch",
+    "n_tokens", "input_ids", "scores", "cache", "draft_model",
+)
 
 def load_model():
     if not MODEL_PATH.exists():
@@ -11,35 +38,494 @@ def load_model():
         return None
     return TinyLLamaModel(str(MODEL_PATH))
 
-class TinyLLamaModel:
+class SharedWeights:
+    """One read-only, mmap-backed copy of a GGUF model that many worker contexts decode against.
+
+    llama-cpp-python ties a model and a context together inside `Llama`, so workers get a `Llama`
+    that reuses the loaded model of `base` and only allocates its own context (KV cache, logits).
+    """
+    _instances: Dict[str, "SharedWeights"] = {}
+    _lock = threading.Lock()
+
     def __init__(self, model_path: str):
-        self.llm = Llama(
+        self.model_path = model_path
+        # The base context is never decoded on, keep it tiny
+        self.base = Llama(
             model_path=model_path,
-            n_ctx=2048,
+            n_ctx=64,
             n_threads=4,
-            n_gpu_layers=0
+            n_gpu_layers=0,
+            use_mmap=True,
+            use_mlock=config.USE_MLOCK
         )
+        missing = [name for name in SHARED_CONTEXT_ATTRIBUTES if name not in self.base.__dict__]
+        if missing:
+            raise RuntimeError(
+                f"INFERSAFE_SHARED_WEIGHTS does not support llama-cpp-python {llama_cpp.__version__} "
+                f"(Llama has no {', '.join(missing)}); install the version in requirements.txt"
+            )
+
+    @classmethod
+    def get(cls, model_path: str) -> "SharedWeights":
+        key = os.path.realpath(model_path)
+        with cls._lock:
+            if key not in cls._instances:
+                logging.info(f"[WEIGHTS] Loading shared weights from {key}")
+                cls._instances[key] = cls(key)
+            return cls._instances[key]
+
+    @classmethod
+    def forget(cls, model_path: str):
+        # Next get() reloads from disk; contexts already handed out keep the old weights alive
+        with cls._lock:
+            cls._instances.pop(os.path.realpath(model_path), None)
+
+    def new_context(self, n_ctx: int, n_threads: int, draft_model=None) -> Llama:
+        base = self.base
+        llm = Llama.__new__(Llama)
+        llm.__dict__.update(base.__dict__)  # shares the model, tokenizer and chat handlers
+        llm._shared_weights = self  # keep the weights alive while any context uses them
+        llm.draft_model = draft_model
+        llm._logits_all = base._logits_all or draft_model is not None  # drafts are verified against every position
+        llm._stack = contextlib.ExitStack()
+
+        params = type(base.context_params).from_buffer_copy(base.context_params)
+        params.n_ctx = n_ctx
+        params.n_batch = params.n_ubatch = min(n_ctx, config.N_BATCH)
+        params.n_threads = params.n_threads_batch = n_threads
+        llm.context_params = params
+        llm.n_batch = params.n_batch
+        llm.n_threads = llm.n_threads_batch = n_threads
+
+        llm._ctx = llm._stack.enter_context(contextlib.closing(
+            llama_internals.LlamaContext(model=base._model, params=params, verbose=base.verbose)
+        ))
+        llm._batch = llm._stack.enter_context(contextlib.closing(
+            llama_internals.LlamaBatch(n_tokens=llm.n_batch, embd=0, n_seq_max=n_ctx, verbose=base.verbose)
+        ))
+
+        # Per-context decoding state, mirrors what Llama.__init__ sets up
+        llm._n_ctx = llm.n_ctx()
+        llm.n_tokens = 0
+        llm._requires_eval = True
+        llm.input_ids = np.ndarray((n_ctx,), dtype=np.intc)
+        llm.scores = np.ndarray((n_ctx if llm._logits_all else llm.n_batch, llm._n_vocab), dtype=np.single)
+        llm._candidates = llama_internals.LlamaTokenDataArray(n_vocab=llm._n_vocab)
+        llm._mirostat_mu = ctypes.c_float(2.0 * 5.0)
+        llm._sampler = None
+        llm.cache = None
+        llm._chat_handlers = dict(base._chat_handlers)
+        return llm
+
+    def rss_bytes(self) -> int:
+        return mapped_rss_bytes(self.model_path)
+
+
+def mapped_rss_bytes(path: str, field: str = "Rss") -> int:
+    """Resident bytes of every mapping of `path` in this process (Linux only, 0 elsewhere).
+
+    Pass field="Pss" to count pages mapped more than once (or by other processes) only once in total.
+    """
+    target = os.path.realpath(path)
+    field += ":"
+    total = 0
+    in_mapping = False
+    try:
+        with open("/proc/self/smaps") as smaps:
+            for line in smaps:
+                fields = line.split()
+                if fields and "-" in fields[0] and not fields[0].endswith(":"):
+                    in_mapping = line.rstrip().endswith(target)
+                elif in_mapping and fields[0] == field:
+                    total += int(fields[1]) * 1024
+    except OSError:
+        return 0
+    return total
+
+
+def chat_formatter(llm: Llama) -> Optional[Jinja2ChatFormatter]:
+    template = llm.metadata.get("tokenizer.chat_template")
+    return Jinja2ChatFormatter(
+        template=template,
+        eos_token=llm._model.token_get_text(llm.token_eos()),
+        bos_token=llm._model.token_get_text(llm.token_bos()),
+    ) if template else None
+
+
+def chat_prompt(formatter: Optional[Jinja2ChatFormatter], prompt: str) -> str:
+    # The text a single-turn chat request is decoded from
+    messages = [{"role": "user", "content": prompt}]
+    if formatter is not None:
+        return formatter(messages=messages).prompt
+    return f"<|user|>\n{prompt}</s>\n<|assistant|>\n"  # TinyLlama / zephyr layout
+
+
+class PromptTokenizer:
+    """Counts prompt tokens the way a worker will decode them (chat template included).
+
+    Loads only the vocabulary of the GGUF, no weights, so it is cheap to keep next to the queue.
+    """
+
+    def __init__(self, model_path: str):
+        self.model_path = model_path
+        self.llm: Optional[Llama] = None
+        self._formatter: Optional[Jinja2ChatFormatter] = None
+
+    @property
+    def ready(self) -> bool:
+        return self.llm is not None
+
+    def load(self):
+        if self.llm is None:
+            llm = Llama(model_path=self.model_path, vocab_only=True, n_ctx=64, verbose=False)
+            self._formatter = chat_formatter(llm)
+            self.llm = llm
+
+    def count(self, prompt: str) -> int:
+        return len(self.llm.tokenize(chat_prompt(self._formatter, prompt).encode("utf-8"), add_bos=True, special=True))
+
+    def drop_head(self, prompt: str, n_tokens: int) -> str:
+        tokens = self.llm.tokenize(prompt.encode("utf-8"), add_bos=False)
+        return self.llm.detokenize(tokens[n_tokens:]).decode("utf-8", errors="ignore")
+
+
+class TinyLLamaModel:
+    def __init__(self, model_path: str, n_threads: Optional[int] = None, speculative: Optional[str] = None):
+        self.model_path = model_path
+        n_threads = n_threads or config.N_THREADS
+        # Proposes tokens the model verifies in one batch; None when speculative decoding is off
+        self.speculative = speculative or config.SPECULATIVE
+        self.draft = make_draft(self.speculative)
+        if config.SHARED_WEIGHTS:
+            self.llm = SharedWeights.get(model_path).new_context(n_ctx=config.N_CTX, n_threads=n_threads, draft_model=self.draft)
+        else:
+            self.llm = Llama(
+                model_path=model_path,
+                n_ctx=config.N_CTX,
+                n_threads=n_threads,
+                n_batch=min(config.N_CTX, config.N_BATCH),
+                n_gpu_layers=0,
+                use_mmap=config.USE_MMAP,
+                use_mlock=config.USE_MLOCK,
+                draft_model=self.draft
+            )
+        self.tokens_avoided = 0  # running total, the process backend reports it to the parent
+        # A Llama context is not thread-safe; concurrent requests on this worker decode one at a time
+        self._decode_lock = threading.Lock()
+        # Saves llama.cpp state after each completion and restores the longest cached prefix before decoding
+        self.prefix_cache = None
+        if config.PREFIX_CACHE_BYTES > 0:
+            self.prefix_cache = PrefixCache(config.PREFIX_CACHE_BYTES, context_tokens=lambda: self.llm.input_ids[:self.llm.n_tokens])
+            self.llm.set_cache(self.prefix_cache)
+
+    def prefix_match_chars(self, prompt: str) -> int:
+        if self.prefix_cache is None:
+            return 0
+        return self.prefix_cache.longest_text_prefix(prompt)
+
+    def context_bytes(self) -> int:
+        # Size of this worker's own state (KV cache + logits), excludes the weights
+        return int(llama_cpp.llama_state_get_size(self.llm.ctx))
+
+    def close(self):
+        if self.prefix_cache is not None:
+            self.prefix_cache.clear()
+        self.llm.close()
 
-    async def generate(self, prompt: str, max_tokens: int = 128):
+    async def generate(self, prompt: str, max_tokens: int = 128, on_token: Optional[Callable[[str], None]] = None,
+                       cancel: Optional[threading.Event] = None):
+        # `cancel` is set when every caller gave up; `stop` when this attempt itself is cancelled (timeout)
         loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(None, self._sync_generate, prompt, max_tokens)
+        stop = threading.Event()
+        job = loop.run_in_executor(None, self._sync_generate, prompt, max_tokens, on_token, stop_checker(cancel, stop))
+        return await await_stoppable(job, stop)
 
-    def _sync_generate(self, prompt: str, max_tokens: int = 128):
+    def _sync_generate(self, prompt: str, max_tokens: int = 128, on_token: Optional[Callable[[str], None]] = None,
+                       should_stop: Optional[Callable[[], bool]] = None):
+        # on_token runs in this executor thread for every delta, so callers can stream as we decode
+        should_stop = should_stop or (lambda: False)
+        with self._decode_lock:
+            if should_stop():
+                return ""  # abandoned while waiting for the context
+            return self._decode(prompt, max_tokens, on_token, should_stop)
+
+    def _decode(self, prompt: str, max_tokens: int, on_token: Optional[Callable[[str], None]], should_stop: Callable[[], bool]):
         try:
+            if self.prefix_cache is not None:
+                self.prefix_cache.pending_text = prompt
+            if self.draft is not None:
+                self.draft.begin()
             messages = [{"role": "user", "content": prompt}]
             response = ""
-            for output in self.llm.create_chat_completion(messages=messages, max_tokens=max_tokens, stream=True):
+            n_tokens = 0
+            first_token_at = None
+            chunks = self.llm.create_chat_completion(messages=messages, max_tokens=max_tokens, temperature=config.TEMPERATURE, stream=True)
+            for output in chunks:
                 delta = output["choices"][0]["delta"]
                 if "content" in delta:
+                    # Only content chunks are tokens; the role and finish chunks carry none
+                    n_tokens += 1
+                    if first_token_at is None:
+                        first_token_at = time.monotonic()
                     response += delta["content"]
+                    if on_token is not None:
+                        on_token(delta["content"])
+                if should_stop():
+                    chunks.close()  # stops llama.cpp before the next token is decoded
+                    self._record_avoided(max(0, max_tokens - n_tokens))
+                    break
+            self._record_speed(n_tokens, first_token_at)
             return response
         except Exception as e:
             logging.error(f"[MODEL ERROR] {e}")
             raise
 
+    def _record_speed(self, n_tokens: int, first_token_at: Optional[float]):
+        # Labelled by decoding mode so speculative and plain workers can be compared side by side
+        if self.draft is not None:
+            self.draft.finish()
+        if first_token_at is not None and n_tokens > 1:
+            elapsed = time.monotonic() - first_token_at
+            if elapsed > 0:
+                DECODE_TOKENS_PER_SECOND.labels(mode=self.speculative).observe((n_tokens - 1) / elapsed)
+
+    def _record_avoided(self, n_tokens: int):
+        self.tokens_avoided += n_tokens
+        WASTED_TOKENS_AVOIDED.inc(n_tokens)
+
+
+PAUSED_POLL_SECONDS = 0.002  # engine wait while every active sequence is paused on its reader
+
+
+class _Sequence:
+    def __init__(self, prompt_tokens, max_tokens: int, relay: Optional[TokenRelay], future: concurrent.futures.Future,
+                 should_stop):
+        self.pending = list(prompt_tokens)  # tokens still to feed into the context
+        self.max_tokens = max_tokens
+        self.relay = relay
+        self.future = future
+        self.should_stop = should_stop
+        self.seq_id = -1
+        self.n_past = 0
+        self.n_generated = 0
+        self.sampler = None
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        self.text = ""
+
+
+class ContinuousBatchingEngine:
+    """Decodes several sequences through one llama.cpp context, each in its own KV slot (seq_id).
+
+    A background thread runs one decode per step over every active sequence: prompts are
+    prefilled in chunks and generating sequences contribute their last sampled token. New
+    requests take a free slot and finished ones release it between steps, so aggregate tokens/s
+    rises with concurrency instead of requests queueing behind each other.
+    Same interface as TinyLLamaModel, so a ModelWorker can use either, except that `on_token` is
+    awaited on the event loop: the engine thread only hands deltas to a TokenRelay, and a sequence
+    whose reader falls STREAM_BUFFER_SIZE deltas behind sits out of the batch until it catches up.
+    """
+
+    tokens_on_loop = True
+
+    def __init__(self, model_path: str, n_slots: int = 4, n_ctx_per_slot: Optional[int] = None,
+                 n_threads: Optional[int] = None):
+        self.model_path = model_path
+        n_ctx_per_slot = n_ctx_per_slot or config.N_CTX
+        n_threads = n_threads or config.N_THREADS
+        self.n_slots = n_slots
+        if config.SPECULATIVE != "off":
+            logging.warning("[SPECULATIVE] Not supported by the continuous batching engine, decoding without it")
+        if config.SHARED_WEIGHTS:
+            self.base = SharedWeights.get(model_path).base
+        else:
+            self.base = Llama(model_path=model_path, n_ctx=64, n_threads=n_threads, n_gpu_layers=0,
+                              use_mmap=config.USE_MMAP, use_mlock=config.USE_MLOCK)
+        self._owns_base = not config.SHARED_WEIGHTS  # shared weights outlive any one engine
+
+        params = type(self.base.context_params).from_buffer_copy(self.base.context_params)
+        params.n_ctx = n_slots * n_ctx_per_slot
+        params.n_seq_max = n_slots
+        params.n_batch = params.n_ubatch = config.N_BATCH
+        params.n_threads = params.n_threads_batch = n_threads
+        self.n_batch = params.n_batch
+        self._stack = contextlib.ExitStack()
+        self._ctx = self._stack.enter_context(contextlib.closing(
+            llama_internals.LlamaContext(model=self.base._model, params=params, verbose=self.base.verbose)
+        ))
+        self._batch = self._stack.enter_context(contextlib.closing(
+            llama_internals.LlamaBatch(n_tokens=self.n_batch, embd=0, n_seq_max=1, verbose=self.base.verbose)
+        ))
+        self._memory = llama_cpp.llama_get_memory(self._ctx.ctx)
+        self._vocab = llama_cpp.llama_model_get_vocab(self.base.model)
+
+        self._formatter = chat_formatter(self.base)
+        self._start(n_slots, n_ctx_per_slot)
+
+    def _start(self, n_slots: int, n_ctx_per_slot: int):
+        self.n_ctx_per_slot = n_ctx_per_slot
+        self.max_backlog = STREAM_BUFFER_SIZE  # undelivered deltas before a sequence is paused
+        self._incoming: "queue.Queue[Optional[_Sequence]]" = queue.Queue()
+        self._slots: list = [None] * n_slots
+        self._running = True
+        self._thread = threading.Thread(target=self._loop, name="continuous-batching", daemon=True)
+        self._thread.start()
+
+    def _prompt_tokens(self, prompt: str):
+        return self.base.tokenize(chat_prompt(self._formatter, prompt).encode("utf-8"), add_bos=True, special=True)
+
+    async def generate(self, prompt: str, max_tokens: int = 128, on_token: Optional[Callable[[str], Awaitable[None]]] = None,
+                       cancel: Optional[threading.Event] = None):
+        prompt_tokens = self._prompt_tokens(prompt)
+        # A sequence may only grow to its own slot; one that can't fit fails here, not the shared decode
+        if len(prompt_tokens) >= self.n_ctx_per_slot:
+            raise RequestTooLargeError(len(prompt_tokens), max_tokens, self.n_ctx_per_slot)
+        max_tokens = min(max_tokens, self.n_ctx_per_slot - len(prompt_tokens))
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        stop = threading.Event()
+        relay = TokenRelay(on_token) if on_token is not None else None
+        self._incoming.put(_Sequence(prompt_tokens, max_tokens, relay, future, stop_checker(cancel, stop)))
+        try:
+            text = await await_stoppable(asyncio.wrap_future(future), stop)
+            if relay is not None:
+                await relay.finish()  # deltas were scheduled before the future resolved
+            return text
+        finally:
+            if relay is not None:
+                relay.cancel()
+
+    def prefix_match_chars(self, prompt: str) -> int:
+        return 0  # slots are recycled per request, nothing to reuse across requests
+
+    def context_bytes(self) -> int:
+        return int(llama_cpp.llama_state_get_size(self._ctx.ctx))
+
+    def close(self):
+        self._running = False
+        self._incoming.put(None)
+        self._thread.join(timeout=5)
+        self._stack.close()
+        if self._owns_base:
+            # Our own weights, loaded just for this engine: free them with it
+            self._owns_base = False
+            self.base.close()
+
+    def _new_sampler(self):
+        chain = llama_cpp.llama_sampler_chain_init(llama_cpp.llama_sampler_chain_default_params())
+        if config.TEMPERATURE == 0:
+            llama_cpp.llama_sampler_chain_add(chain, llama_cpp.llama_sampler_init_greedy())
+        else:
+            # Same defaults create_chat_completion uses on the single-sequence path
+            llama_cpp.llama_sampler_chain_add(chain, llama_cpp.llama_sampler_init_top_k(40))
+            llama_cpp.llama_sampler_chain_add(chain, llama_cpp.llama_sampler_init_top_p(0.95, 1))
+            llama_cpp.llama_sampler_chain_add(chain, llama_cpp.llama_sampler_init_min_p(0.05, 1))
+            llama_cpp.llama_sampler_chain_add(chain, llama_cpp.llama_sampler_init_temp(config.TEMPERATURE))
+            llama_cpp.llama_sampler_chain_add(chain, llama_cpp.llama_sampler_init_dist(llama_cpp.LLAMA_DEFAULT_SEED))
+        return chain
+
+    def _admit(self, block: bool):
+        # Fill free slots at a token boundary; block only when nothing is decoding
+        for seq_id, slot in enumerate(self._slots):
+            if slot is not None:
+                continue
+            try:
+                seq = self._incoming.get(block=block)
+            except queue.Empty:
+                return
+            if seq is None:
+                self._running = False
+                return
+            block = False
+            seq.seq_id = seq_id
+            seq.sampler = self._new_sampler()
+            llama_cpp.llama_memory_seq_rm(self._memory, seq_id, -1, -1)
+            self._slots[seq_id] = seq
+
+    def _release(self, seq: _Sequence, error: Optional[Exception] = None):
+        if self._slots[seq.seq_id] is not seq:
+            return  # already released
+        llama_cpp.llama_memory_seq_rm(self._memory, seq.seq_id, -1, -1)
+        llama_cpp.llama_sampler_free(seq.sampler)
+        self._slots[seq.seq_id] = None
+        if error is not None:
+            seq.future.set_exception(error)
+        else:
+            seq.future.set_result(seq.text)
+
+    def _loop(self):
+        while self._running:
+            active = [seq for seq in self._slots if seq is not None]
+            self._admit(block=not active)
+            for seq in [seq for seq in self._slots if seq is not None and seq.should_stop()]:
+                # Abandoned or timed out: free the KV slot at this token boundary
+                WASTED_TOKENS_AVOIDED.inc(max(0, seq.max_tokens - seq.n_generated))
+                self._release(seq)
+            for seq in [seq for seq in self._slots if seq is not None and seq.relay is not None and seq.relay.error]:
+                self._release(seq, seq.relay.error)
+            active = [seq for seq in self._slots if seq is not None]
+            if not active:
+                continue
+            # A sequence whose reader is behind sits this step out; the others keep decoding
+            ready = [seq for seq in active if seq.relay is None or seq.relay.backlog < self.max_backlog]
+            if not ready:
+                time.sleep(PAUSED_POLL_SECONDS)
+                continue
+            try:
+                sampled = self._step(ready)
+            except Exception as e:
+                logging.error(f"[MODEL ERROR] continuous batch step failed: {e}")
+                for seq in ready:
+                    self._release(seq, e)
+                continue
+            for seq, batch_idx in sampled:
+                try:
+                    self._sample(seq, batch_idx)
+                except Exception as e:
+                    logging.error(f"[MODEL ERROR] sampling sequence {seq.seq_id} failed: {e}")
+                    self._release(seq, e)
+        for seq in [seq for seq in self._slots if seq is not None]:
+            self._release(seq, RuntimeError("Engine closed"))
+
+    def _step(self, active):
+        # One llama_decode over every active sequence; returns (sequence, batch index) pairs to sample
+        batch = self._batch.batch
+        batch.n_tokens = 0
+        to_sample = []
+        # Generating sequences (one pending token) go first, prompt prefill takes the remaining budget
+        for seq in sorted(active, key=lambda s: len(s.pending)):
+            room = self.n_batch - batch.n_tokens
+            if room <= 0:
+                break
+            chunk = seq.pending[:room]
+            for i, token in enumerate(chunk):
+                j = batch.n_tokens
+                batch.token[j] = token
+                batch.pos[j] = seq.n_past + i
+                batch.n_seq_id[j] = 1
+                batch.seq_id[j][0] = seq.seq_id
+                batch.logits[j] = False
+                batch.n_tokens += 1
+            seq.n_past += len(chunk)
+            del seq.pending[:len(chunk)]
+            if not seq.pending:
+                # Whole prompt (or the last sampled token) is in: sample the next token here
+                batch.logits[batch.n_tokens - 1] = True
+                to_sample.append((seq, batch.n_tokens - 1))
+        if llama_cpp.llama_decode(self._ctx.ctx, batch) != 0:
+            raise RuntimeError("llama_decode failed")
+        return to_sample
 
-    def scale_down(self):
-        if len(self.models) > 1:
-            removed = self.models.pop()
-            logging.info(f"[Manager] Scaling down: removing {removed.name}")
-            del removed.model  # Clean up model resources
\ No newline at end of file
+    def _sample(self, seq: _Sequence, batch_idx: int):
+        token = llama_cpp.llama_sampler_sample(seq.sampler, self._ctx.ctx, batch_idx)
+        if llama_cpp.llama_vocab_is_eog(self._vocab, token):
+            self._release(seq)
+            return
+        seq.n_generated += 1
+        delta = seq.decoder.decode(self.base.detokenize([token]))
+        if delta:
+            seq.text += delta
+            if seq.relay is not None:
+                seq.relay.push(delta)  # never waits for the reader
+        if seq.n_generated >= seq.max_tokens:
+            self._release(seq)
+        else:
+            seq.pending.append(token)
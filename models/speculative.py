@@ -0,0 +1,103 @@
+from typing import Any, Optional
+import numpy as np
+import numpy.typing as npt
+from llama_cpp import Llama
+from llama_cpp.llama_speculative import LlamaDraftModel, LlamaPromptLookupDecoding
+from prometheus_client import Counter, Histogram
+from utils import config
+
+MODES = ("off", "prompt_lookup", "draft_model")
+
+SPECULATIVE_DRAFTED = Counter("model_speculative_draft_tokens_total", "Tokens proposed by the draft", ["mode"])
+SPECULATIVE_ACCEPTED = Counter(
+    "model_speculative_accepted_tokens_total", "Drafted tokens the model accepted; divide by drafted for the acceptance rate", ["mode"]
+)
+SPECULATIVE_ACCEPTANCE = Histogram(
+    "model_speculative_acceptance_ratio", "Share of drafted tokens accepted, per request", ["mode"],
+    buckets=(0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+)
+DECODE_TOKENS_PER_SECOND = Histogram(
+    "model_decode_tokens_per_second", "Effective decode speed of a request after its first token, by decoding mode", ["mode"],
+    buckets=(1, 2, 5, 10, 20, 35, 50, 75, 100, 200, 500)
+)
+
+
+class GGUFDraftModel(LlamaDraftModel):
+    """Greedy drafts from a small GGUF that shares the target model's vocabulary.
+
+    Llama.generate hands over the whole context on every call; the draft context keeps the prefix
+    both models agree on and only evaluates what changed since the last call.
+    """
+
+    def __init__(self, model_path: str, num_pred_tokens: int, n_threads: int = 2):
+        self.llm = Llama(model_path=model_path, n_ctx=config.N_CTX, n_threads=n_threads, n_gpu_layers=0, verbose=False)
+        self.num_pred_tokens = num_pred_tokens
+
+    def __call__(self, input_ids: npt.NDArray[np.intc], /, **kwargs: Any) -> npt.NDArray[np.intc]:
+        llm = self.llm
+        limit = min(llm.n_tokens, len(input_ids) - 1)  # re-evaluate at least the last token for fresh logits
+        mismatch = np.nonzero(llm.input_ids[:limit] != input_ids[:limit])[0]
+        llm.n_tokens = int(mismatch[0]) if len(mismatch) else limit
+        llm.eval(input_ids[llm.n_tokens:].tolist())
+        draft = []
+        for _ in range(min(self.num_pred_tokens, llm.n_ctx() - llm.n_tokens)):
+            token = llm.sample(temp=0.0)
+            if token == llm.token_eos():
+                break
+            draft.append(token)
+            llm.eval([token])
+        return np.array(draft, dtype=np.intc)
+
+
+class MeasuredDraft(LlamaDraftModel):
+    """Wraps a draft model and counts how many of its proposals the target model accepted.
+
+    A draft proposed after position `n` was accepted for as many tokens as it agrees with what
+    actually follows position `n` in the context passed to the next call. Call `begin` before
+    each generation, and `finish` after it to export that request's numbers.
+    """
+
+    def __init__(self, draft: LlamaDraftModel, mode: str):
+        self.draft = draft
+        self.mode = mode
+        self.begin()
+
+    def begin(self):
+        self.drafted = 0
+        self.accepted = 0
+        self._pending: Optional[tuple] = None  # (position, proposed tokens) not scored yet
+
+    def __call__(self, input_ids: npt.NDArray[np.intc], /, **kwargs: Any) -> npt.NDArray[np.intc]:
+        if self._pending is not None:
+            start, proposed = self._pending
+            actual = input_ids[start:start + len(proposed)]
+            matches = proposed[:len(actual)] == actual
+            self.drafted += len(proposed)
+            self.accepted += len(matches) if matches.all() else int(np.argmin(matches))
+        proposed = np.asarray(self.draft(input_ids, **kwargs), dtype=np.intc)
+        self._pending = (len(input_ids), proposed) if len(proposed) else None
+        return proposed
+
+    def finish(self):
+        # The last draft of a generation is never checked, leave it out
+        if self.drafted:
+            SPECULATIVE_DRAFTED.labels(mode=self.mode).inc(self.drafted)
+            SPECULATIVE_ACCEPTED.labels(mode=self.mode).inc(self.accepted)
+            SPECULATIVE_ACCEPTANCE.labels(mode=self.mode).observe(self.accepted / self.drafted)
+
+
+def make_draft(mode: str) -> Optional[MeasuredDraft]:
+    """Draft model for `mode` (see config.SPECULATIVE), or None when speculation is off."""
+    if mode == "off":
+        return None
+    if mode == "prompt_lookup":
+        draft = LlamaPromptLookupDecoding(
+            max_ngram_size=config.SPECULATIVE_NGRAM_SIZE, num_pred_tokens=config.SPECULATIVE_DRAFT_TOKENS
+        )
+    elif mode == "draft_model":
+        if not config.SPECULATIVE_DRAFT_MODEL:
+            raise ValueError("Speculative mode 'draft_model' needs INFERSAFE_SPECULATIVE_DRAFT_MODEL")
+        draft = GGUFDraftModel(config.SPECULATIVE_DRAFT_MODEL, config.SPECULATIVE_DRAFT_TOKENS)
+    else:
+        raise ValueError(f"Unknown speculative decoding mode {mode!r}, expected one of {list(MODES)}")
+    return MeasuredDraft(draft, mode)
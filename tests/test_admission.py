@@ -0,0 +1,99 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import asyncio
+import pytest
+from prometheus_client import REGISTRY
+from utils.admission import RequestTooLargeError, TokenAdmission, TokenSlots
+
+
+class WordTokenizer:
+    """One token per word, plus two for the chat template."""
+
+    ready = True
+
+    def __init__(self):
+        self.calls = 0
+
+    def count(self, prompt):
+        self.calls += 1
+        return len(prompt.split()) + 2
+
+    def drop_head(self, prompt, n_tokens):
+        return " ".join(prompt.split()[n_tokens:])
+
+
+def _sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def test_counts_are_cached_per_prompt():
+    tokenizer = WordTokenizer()
+    admission = TokenAdmission(tokenizer, n_ctx=100)
+
+    for _ in range(3):
+        assert admission.admit("one two three", 10) == ("one two three", 10, 5)
+    assert tokenizer.calls == 1
+
+
+def test_truncates_answer_then_prompt_and_rejects_what_cannot_fit():
+    admission = TokenAdmission(WordTokenizer(), n_ctx=40, policy="truncate")
+    before_answer = _sample("inference_admission_truncated_total", part="max_tokens")
+    before_prompt = _sample("inference_admission_truncated_total", part="prompt")
+
+    # 20 prompt tokens: max_tokens shrinks to the 20 left
+    assert admission.admit(" ".join(["w"] * 18), 64)[1:] == (20, 20)
+    # 38 prompt tokens leave too little room to answer: keep the last words of the prompt
+    prompt, max_tokens, prompt_tokens = admission.admit(" ".join(str(i) for i in range(36)), 64)
+    assert max_tokens == 16 and prompt_tokens + max_tokens <= 40
+    assert prompt.endswith("35") and not prompt.startswith("0 ")
+
+    assert _sample("inference_admission_truncated_total", part="max_tokens") == before_answer + 1
+    assert _sample("inference_admission_truncated_total", part="prompt") == before_prompt + 1
+
+    rejecting = TokenAdmission(WordTokenizer(), n_ctx=40, policy="reject")
+    before = _sample("inference_admission_rejected_total", reason="too_large")
+    with pytest.raises(RequestTooLargeError):
+        rejecting.admit(" ".join(["w"] * 18), 64)
+    assert _sample("inference_admission_rejected_total", reason="too_large") == before + 1
+
+
+@pytest.mark.asyncio
+async def test_slots_reserve_tokens_in_arrival_order():
+    slots = TokenSlots(capacity=100, max_requests=4)
+    order = []
+
+    async def run(name, tokens, hold):
+        async with slots.reserve(tokens):
+            order.append(name)
+            await hold.wait()
+
+    big_done, small_done = asyncio.Event(), asyncio.Event()
+    first = asyncio.ensure_future(run("first", 80, big_done))
+    await asyncio.sleep(0)
+    # 50 doesn't fit next to 80; the 10 behind it must not jump the queue
+    waiting = asyncio.ensure_future(run("waiting", 50, small_done))
+    behind = asyncio.ensure_future(run("behind", 10, small_done))
+    await asyncio.sleep(0.01)
+    assert order == ["first"] and slots.reserved == 80
+
+    big_done.set()
+    await asyncio.sleep(0.01)
+    assert order == ["first", "waiting", "behind"] and slots.reserved == 60
+
+    small_done.set()
+    await asyncio.gather(first, waiting, behind)
+    assert slots.reserved == 0 and slots.holders == 0
+
+
+@pytest.mark.asyncio
+async def test_cancelled_waiter_gives_its_turn_away():
+    slots = TokenSlots(capacity=100, max_requests=4)
+    await slots.acquire(90)
+    blocked = asyncio.ensure_future(slots.acquire(50))
+    small = asyncio.ensure_future(slots.acquire(10))
+    await asyncio.sleep(0)
+
+    blocked.cancel()
+    await asyncio.sleep(0.01)
+    assert small.done() and slots.reserved == 100
@@ -0,0 +1,108 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import random
+from utils.autoscaler import Autoscaler, LoadSignals
+
+TICK = 5.0  # seconds between autoscaler evaluations
+SERVICE_RATE = 1.0  # requests per second one worker completes
+
+
+def synthetic_trace(seed=7, ticks=360):
+    # Arrivals per tick: a noisy baseline with two bursts, Poisson-sampled
+    rng = random.Random(seed)
+    trace = []
+    for tick in range(ticks):
+        rate = 3.0
+        if 60 <= tick < 120 or 220 <= tick < 250:
+            rate = 7.0
+        rate *= rng.uniform(0.6, 1.4)
+        # Poisson sample via exponential gaps
+        count, t = 0, rng.expovariate(rate)
+        while t < TICK:
+            count += 1
+            t += rng.expovariate(rate)
+        trace.append(count)
+    return trace
+
+
+class SimManager:
+    def __init__(self, workers=2):
+        self.models = list(range(workers))
+        self.backlog = 0.0
+
+    def total_in_flight(self):
+        return int(self.backlog)
+
+    def scale_up(self):
+        self.models.append(len(self.models))
+
+    def scale_down(self):
+        self.models.pop()
+
+
+def legacy_decision(manager, state, now, up=5, down=1, min_workers=1, cooldown=15):
+    # The threshold-plus-cooldown rule the autoscaler used before SLO-driven scaling
+    if now - state["last"] < cooldown:
+        return 0
+    load = manager.total_in_flight() / len(manager.models)
+    if load > up:
+        return 1
+    if load < down and len(manager.models) > min_workers:
+        return -1
+    return 0
+
+
+def simulate(decide, manager, signals=None):
+    actions, latencies = [], []
+    for tick, arrivals in enumerate(synthetic_trace()):
+        now = tick * TICK
+        capacity = len(manager.models) * SERVICE_RATE * TICK
+        manager.backlog = max(0.0, manager.backlog + arrivals - capacity)
+        latency = 1.0 / SERVICE_RATE + manager.backlog / (len(manager.models) * SERVICE_RATE)
+        latencies.append(latency)
+        if signals is not None:
+            for _ in range(arrivals):
+                signals.latency.add(latency, now)
+                signals.queue_wait.add(latency - 1.0 / SERVICE_RATE, now)
+        change = decide(now)
+        if change > 0:
+            manager.scale_up()
+        elif change < 0:
+            manager.scale_down()
+        if change:
+            actions.append(change)
+    latencies.sort()
+    return actions, latencies[int(0.99 * len(latencies))]
+
+
+def reversals(actions):
+    return sum(1 for a, b in zip(actions, actions[1:]) if a != b)
+
+
+def test_slo_autoscaler_oscillates_less_than_threshold_rule():
+    legacy_manager = SimManager()
+    state = {"last": float("-inf")}
+
+    def legacy(now):
+        change = legacy_decision(legacy_manager, state, now)
+        if change:
+            state["last"] = now
+        return change
+
+    legacy_actions, legacy_p99 = simulate(legacy, legacy_manager)
+
+    manager, signals = SimManager(), LoadSignals(window=60)
+    scaler = Autoscaler(manager, scale_interval=TICK, window=60, signals=signals)
+
+    def slo(now):
+        change = scaler.evaluate(now)
+        if change:
+            scaler.scaled(now)
+        return change
+
+    actions, p99 = simulate(slo, manager, signals)
+
+    assert actions.count(1) > 0  # it still reacts to the bursts
+    assert reversals(actions) < reversals(legacy_actions)
+    assert p99 <= legacy_p99  # and it does not buy stability with worse tail latency
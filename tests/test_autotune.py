@@ -0,0 +1,52 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import json
+import pytest
+pytest.importorskip("llama_cpp")  # the sweep drives the real manager through benchmarks/serving.py
+from utils import config
+from benchmarks.autotune import better, context_sizes, pool_shapes, request_queue
+
+
+def test_env_wins_over_tuned_file_which_wins_over_defaults(tmp_path, monkeypatch):
+    tuned = tmp_path / "tuned.json"
+    tuned.write_text(json.dumps({"settings": {"INFERSAFE_N_THREADS": 6, "INFERSAFE_USE_MLOCK": True}}))
+    monkeypatch.setattr(config, "TUNED", config._load_tuned(str(tuned)))
+    monkeypatch.setenv("INFERSAFE_N_THREADS", "2")
+
+    assert config._setting("INFERSAFE_N_THREADS", 4, int) == 2
+    assert config._setting("INFERSAFE_USE_MLOCK", False, config._flag) is True
+    assert config._setting("INFERSAFE_N_BATCH", 512, int) == 512
+    assert config._load_tuned(str(tmp_path / "missing.json")) == {}
+
+
+def test_sweep_prefers_throughput_within_slo_and_never_oversubscribes_cores():
+    within = {"failed": 0, "latency_p95_s": 2.0, "tokens_per_s": 100.0}
+    faster_but_slow = {"failed": 0, "latency_p95_s": 9.0, "tokens_per_s": 300.0}
+    marginal = {"failed": 0, "latency_p95_s": 1.5, "tokens_per_s": 101.0}
+
+    assert not better(faster_but_slow, within, slo=5.0)
+    assert not better(marginal, within, slo=5.0)  # within noise, the earlier (cheaper) setting stays
+    assert better(within, faster_but_slow, slo=5.0)
+    assert all(shape["workers"] * shape["n_threads"] <= 8 for shape in pool_shapes(8))
+    # Worker processes size their llama.cpp threads from their cores, a tuned n_threads wouldn't reach them
+    assert pool_shapes(8, backend="process") == [{"workers": n} for n in (1, 2, 3, 4, 6, 8)]
+
+
+def test_context_sweep_stays_at_or_above_the_current_size_without_replay():
+    short_trace = [(0.0, "Write a haiku about autumn", 64)]
+
+    assert context_sizes(short_trace) == [512, 1024, 2048, 4096]  # --replay: real prompts may go small
+    assert context_sizes(short_trace, floor=2048) == [2048, 4096]
+    assert context_sizes(short_trace, floor=3000) == [3000, 4096]
+
+
+def test_each_candidate_gets_admission_and_batch_budget_for_its_own_n_ctx(monkeypatch):
+    monkeypatch.delenv("INFERSAFE_BATCH_TOKEN_BUDGET", raising=False)
+    monkeypatch.setattr(config, "TUNED", {})
+    monkeypatch.setattr(config, "CONTINUOUS_BATCHING", False)
+
+    queue = request_queue(1024)
+    assert queue.admission.n_ctx == 1024
+    assert queue.batch_token_budget == 1024
+    queue.close()
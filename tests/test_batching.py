@@ -0,0 +1,116 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import asyncio
+import pytest
+from utils import config
+from utils.batching import RequestQueueManager, QueueFullError
+
+
+@pytest.mark.asyncio
+async def test_identical_requests_share_one_generation():
+    manager = RequestQueueManager()
+
+    first = manager.enqueue("same prompt", 20)
+    second = manager.enqueue("same prompt", 20)
+    other = manager.enqueue("different prompt", 20)
+
+    assert manager.depth() == 2  # the duplicate never reached the queue
+    manager.queue.get_nowait().future.set_result("shared answer")
+    assert await first == "shared answer"
+    assert await second == "shared answer"
+    assert not other.done()
+
+
+@pytest.mark.asyncio
+async def test_greedy_results_are_served_from_cache(monkeypatch):
+    monkeypatch.setattr(config, "RESPONSE_CACHE_SIZE", 8)
+    monkeypatch.setattr(config, "TEMPERATURE", 0.0)
+    manager = RequestQueueManager()
+
+    first = manager.enqueue("cached prompt", 20)
+    manager.queue.get_nowait().future.set_result("cached answer")
+    assert await first == "cached answer"
+
+    again = manager.enqueue("cached prompt", 20)
+    assert again.done() and again.result() == "cached answer"
+    assert manager.depth() == 0
+
+
+@pytest.mark.asyncio
+async def test_full_batch_dispatches_without_waiting_for_deadline():
+    manager = RequestQueueManager(max_batch_wait_ms=10_000, batch_size_limit=3)
+    batches = []
+
+    async def process_batch(batch):
+        batches.append(len(batch))
+        for req in batch:
+            req.future.set_result("ok")
+
+    loop_task = asyncio.create_task(manager.start_loop(process_batch))
+    futures = [manager.enqueue(f"prompt {i}", 8) for i in range(3)]
+    results = await asyncio.wait_for(asyncio.gather(*futures), timeout=1)
+    loop_task.cancel()
+
+    assert results == ["ok"] * 3
+    assert batches == [3]
+
+
+@pytest.mark.asyncio
+async def test_lone_request_is_not_held_for_the_full_window():
+    manager = RequestQueueManager(max_batch_wait_ms=5_000)
+
+    async def process_batch(batch):
+        for req in batch:
+            req.future.set_result("ok")
+
+    loop_task = asyncio.create_task(manager.start_loop(process_batch))
+    assert await asyncio.wait_for(manager.enqueue("alone", 8), timeout=1) == "ok"
+    loop_task.cancel()
+
+
+@pytest.mark.asyncio
+async def test_enqueue_raises_with_retry_hint_when_full():
+    manager = RequestQueueManager(max_queue_size=1)
+    manager.enqueue("first", 8)
+
+    with pytest.raises(QueueFullError) as exc:
+        manager.enqueue("second", 8)
+    assert exc.value.retry_after >= 1
+
+
+@pytest.mark.asyncio
+async def test_generation_is_cancelled_only_when_every_caller_leaves():
+    manager = RequestQueueManager()
+
+    first = manager.enqueue("abandoned prompt", 20)
+    second = manager.enqueue("abandoned prompt", 20)
+    req = manager.queue.get_nowait()
+
+    first.cancel()
+    await asyncio.sleep(0)
+    assert not req.cancel_event.is_set()  # the coalesced caller still wants the answer
+
+    second.cancel()
+    await asyncio.sleep(0)
+    assert req.cancel_event.is_set()
+
+
+@pytest.mark.asyncio
+async def test_batches_are_cut_at_the_token_budget():
+    manager = RequestQueueManager(max_batch_wait_ms=50, batch_size_limit=10, batch_token_budget=300)
+    batches = []
+
+    async def process_batch(batch):
+        batches.append([req.tokens for req in batch])
+        for req in batch:
+            req.future.set_result("ok")
+
+    loop_task = asyncio.create_task(manager.start_loop(process_batch, lambda: 4))
+    futures = [manager.enqueue(f"prompt {i}", 100) for i in range(4)]
+    futures.append(manager.enqueue("long prompt " * 200, 100))  # over the budget on its own
+    await asyncio.wait_for(asyncio.gather(*futures), timeout=1)
+    loop_task.cancel()
+
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    assert all(sum(batch) <= 300 for batch in batches[:2])
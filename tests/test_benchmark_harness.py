@@ -0,0 +1,45 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import pytest
+pytest.importorskip("llama_cpp")  # the harness drives the real manager and api modules
+from api import main
+from benchmarks.serving import FakeModelManager, bursty_trace, poisson_trace, run_benchmark
+
+
+def test_traces_are_reproducible():
+    assert poisson_trace(10, 5, seed=3) == poisson_trace(10, 5, seed=3)
+    bursty = bursty_trace(2, 50, duration=10, burst_every=5, burst_length=1, seed=3)
+    in_bursts = [t for t, _, _ in bursty if t % 5 >= 4]
+    assert len(in_bursts) > len(bursty) / 2  # most arrivals land in the 20% of time spent bursting
+
+
+@pytest.mark.asyncio
+async def test_harness_reports_latency_percentiles(monkeypatch):
+    # run_benchmark rewires api.main's globals, put them back afterwards
+    for name in ("model_manager", "request_manager", "load_signals"):
+        monkeypatch.setattr(main, name, getattr(main, name))
+    manager = FakeModelManager(2, {"prompt_ms_per_token": 0.1, "token_ms": 1.0})
+    trace = poisson_trace(rate=40, duration=0.5, seed=1, max_tokens=8)
+
+    report = await run_benchmark(trace, manager)
+
+    assert report["completed"] == report["requests"] == len(trace)
+    for stage in ("queue_wait_s", "ttft_s", "latency_s"):
+        assert report[stage]["p50"] <= report[stage]["p95"] <= report[stage]["p99"]
+    assert report["ttft_s"]["p50"] <= report["latency_s"]["p50"]
+    assert report["throughput_rps"] > 0
+
+
+@pytest.mark.asyncio
+async def test_interactive_latency_stays_within_slo_with_a_bulk_job_running(monkeypatch):
+    for name in ("model_manager", "request_manager", "load_signals"):
+        monkeypatch.setattr(main, name, getattr(main, name))
+    manager = FakeModelManager(3, {"prompt_ms_per_token": 0.1, "token_ms": 2.0})
+    trace = poisson_trace(rate=20, duration=1.0, seed=2, max_tokens=8)
+
+    report = await run_benchmark(trace, manager, bulk_lines=500, bulk_max_tokens=64)
+
+    assert report["completed"] == len(trace)
+    assert report["bulk"]["written"] > 0  # bulk work got the idle capacity
+    assert report["slo"]["within"]
@@ -0,0 +1,82 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import asyncio
+import json
+import pytest
+from utils.bulk_jobs import BulkJob, LineRejected
+
+
+def _write_input(path, n):
+    with open(path, "w") as f:
+        for i in range(n):
+            f.write(json.dumps({"id": f"q{i}", "prompt": f"prompt {i}", "max_tokens": 8}) + "\n")
+
+
+def _read(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+@pytest.mark.asyncio
+async def test_output_is_in_input_order_and_resumes_after_the_checkpoint(tmp_path):
+    _write_input(tmp_path / "in.jsonl", 6)
+    output = tmp_path / "out.jsonl"
+    # A crash left two lines and half of a third
+    output.write_text('{"line": 1, "id": "q0", "output": "old 0"}\n{"line": 2, "id": "q1", "output": "old 1"}\n{"line": 3, "i')
+    generated = []
+
+    async def generate(prompt, max_tokens, model):
+        generated.append(prompt)
+        await asyncio.sleep(0.01 * (6 - int(prompt.split()[-1])))  # later lines finish first
+        return prompt.upper()
+
+    job = BulkJob("test", str(tmp_path / "in.jsonl"), str(output))
+    await job.run(generate, concurrency=lambda: 4)
+
+    assert sorted(generated) == [f"prompt {i}" for i in range(2, 6)]
+    assert [record["id"] for record in _read(output)] == [f"q{i}" for i in range(6)]
+    assert _read(output)[5]["output"] == "PROMPT 5"
+    assert job.status == "done" and job.done == job.total == 6
+
+
+@pytest.mark.asyncio
+async def test_no_line_starts_while_paused_and_bad_lines_do_not_stop_the_job(tmp_path):
+    (tmp_path / "in.jsonl").write_text('{"prompt": "first"}\nnot json\n\n{"prompt": "last"}\n')
+    held = True
+    generated = []
+
+    async def generate(prompt, max_tokens, model):
+        generated.append(prompt)
+        return "ok"
+
+    job = BulkJob("test", str(tmp_path / "in.jsonl"), str(tmp_path / "out.jsonl"))
+    run = asyncio.create_task(job.run(generate, paused=lambda: held))
+    await asyncio.sleep(0.2)
+    assert generated == []  # interactive traffic is waiting
+
+    held = False
+    await asyncio.wait_for(run, timeout=2)
+    records = _read(tmp_path / "out.jsonl")
+    assert [record["line"] for record in records] == [1, 2, 4]
+    assert "error" in records[1] and records[2]["output"] == "ok"
+    assert job.errors == 1
+
+
+@pytest.mark.asyncio
+async def test_line_for_an_unknown_model_gets_an_error_without_retries(tmp_path):
+    (tmp_path / "in.jsonl").write_text('{"prompt": "a", "model": "nope"}\n{"prompt": "b"}\n')
+    calls = []
+
+    async def generate(prompt, max_tokens, model):
+        calls.append(model)
+        if model is not None:
+            raise LineRejected(f"Unknown model {model!r}")
+        return "ok"
+
+    job = BulkJob("test", str(tmp_path / "in.jsonl"), str(tmp_path / "out.jsonl"))
+    await job.run(generate)
+
+    records = _read(tmp_path / "out.jsonl")
+    assert records[0]["error"] == "Unknown model 'nope'" and records[1]["output"] == "ok"
+    assert calls == ["nope", None]
@@ -0,0 +1,162 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import asyncio
+import contextlib
+import threading
+import pytest
+llama_cpp = pytest.importorskip("llama_cpp")
+from models.inference_engine import ContinuousBatchingEngine
+from utils.admission import RequestTooLargeError
+
+EOG = 0
+
+
+class FakeBatch:
+    def __init__(self, n_tokens):
+        self.token, self.pos, self.n_seq_id, self.logits = [0] * n_tokens, [0] * n_tokens, [0] * n_tokens, [False] * n_tokens
+        self.seq_id = [[0] for _ in range(n_tokens)]
+        self.n_tokens = 0
+
+
+class FakeLlama:
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+    def detokenize(self, tokens):
+        return "".join(f"t{token} " for token in tokens).encode("utf-8")
+
+
+class Script:
+    """Stands in for a sequence's sampler: the tokens it will sample, in order."""
+
+    def __init__(self, tokens, gate=None):
+        self.tokens = list(tokens)
+        self.gate = gate  # sampling waits on it, to keep a sequence busy
+
+    def sample(self):
+        if self.gate is not None:
+            self.gate.wait(timeout=5)
+        token = self.tokens.pop(0)
+        if isinstance(token, Exception):
+            raise token
+        return token
+
+
+@pytest.fixture
+def make_engine(monkeypatch):
+    # The engine's scheduling against a fake llama.cpp context: every sequence samples from its own script
+    engines, scripts = [], []
+    cleared = []
+    monkeypatch.setattr(llama_cpp, "llama_decode", lambda ctx, batch: 0)
+    monkeypatch.setattr(llama_cpp, "llama_sampler_sample", lambda sampler, ctx, idx: sampler.sample())
+    monkeypatch.setattr(llama_cpp, "llama_vocab_is_eog", lambda vocab, token: token == EOG)
+    monkeypatch.setattr(llama_cpp, "llama_memory_seq_rm", lambda memory, seq_id, p0, p1: cleared.append(seq_id))
+    monkeypatch.setattr(llama_cpp, "llama_sampler_free", lambda sampler: None)
+
+    def make(n_slots=2, n_ctx_per_slot=32):
+        engine = ContinuousBatchingEngine.__new__(ContinuousBatchingEngine)
+        engine.base, engine.n_batch, engine._formatter = FakeLlama(), 64, None
+        engine._owns_base = True
+        engine._ctx, engine._batch = type("Ctx", (), {"ctx": None}), type("Batch", (), {"batch": FakeBatch(64)})
+        engine._memory = engine._vocab = None
+        engine._stack = contextlib.ExitStack()
+        engine._prompt_tokens = lambda prompt: [1] * len(prompt.split())
+        engine._new_sampler = lambda: scripts.pop(0)
+        engine._start(n_slots, n_ctx_per_slot)
+        engine.cleared = cleared
+        engines.append(engine)
+        return engine
+
+    make.scripts = scripts
+    yield make
+    for engine in engines:
+        engine.close()
+
+
+@pytest.mark.asyncio
+async def test_slot_is_released_at_end_of_generation_and_reused(make_engine):
+    engine = make_engine(n_slots=1)
+    make_engine.scripts.extend([Script([5, 6, EOG]), Script([7, EOG])])
+
+    assert await engine.generate("first prompt", 8) == "t5 t6 "
+    assert await engine.generate("second prompt", 8) == "t7 "
+    assert engine._slots == [None]
+
+
+@pytest.mark.asyncio
+async def test_cancel_frees_the_slot_at_the_next_token(make_engine):
+    engine = make_engine(n_slots=1)
+    gate = threading.Event()
+    make_engine.scripts.extend([Script([5] * 100, gate), Script([7, EOG])])
+    cancel = threading.Event()
+
+    first = asyncio.ensure_future(engine.generate("long one", 100, cancel=cancel))
+    await asyncio.sleep(0.05)
+    cancel.set()
+    gate.set()
+    partial = await first
+    assert len(partial) < len("t5 ") * 100
+
+    assert await engine.generate("next", 8) == "t7 "  # got the only slot
+    assert engine.cleared.count(0) >= 2
+
+
+@pytest.mark.asyncio
+async def test_one_failing_sequence_leaves_the_others_running(make_engine):
+    engine = make_engine(n_slots=3)
+    make_engine.scripts.extend([Script([5, 6, EOG]), Script([8, RuntimeError("sampler broke")]), Script([9, EOG])])
+
+    results = await asyncio.gather(
+        engine.generate("a", 8), engine.generate("b", 8), engine.generate("c", 8), return_exceptions=True
+    )
+
+    assert results[0] == "t5 t6 "
+    assert isinstance(results[1], RuntimeError)
+    assert results[2] == "t9 "
+    assert engine._thread.is_alive()
+
+
+@pytest.mark.asyncio
+async def test_prompt_longer_than_a_slot_is_rejected_alone(make_engine):
+    engine = make_engine(n_slots=2, n_ctx_per_slot=8)
+    make_engine.scripts.extend([Script([5] * 10)])
+
+    with pytest.raises(RequestTooLargeError):
+        await engine.generate("one two three four five six seven eight nine", 4)
+    # Fits, but only with max_tokens cut to what is left of the slot
+    assert await engine.generate("one two three", 100) == "t5 " * 5
+
+
+@pytest.mark.asyncio
+async def test_slow_reader_pauses_only_its_own_sequence(make_engine):
+    engine = make_engine(n_slots=2)
+    engine.max_backlog = 2
+    make_engine.scripts.extend([Script([5] * 20 + [EOG]), Script([6] * 10 + [EOG])])
+    reader_free = asyncio.Event()
+    streamed = []
+
+    async def slow_reader(delta):
+        await reader_free.wait()
+        streamed.append(delta)
+
+    slow = asyncio.ensure_future(engine.generate("slow", 30, on_token=slow_reader))
+    fast = await asyncio.wait_for(engine.generate("fast", 30), timeout=5)
+
+    assert fast == "t6 " * 10
+    assert not slow.done()
+    assert engine._slots[0].n_generated <= engine.max_backlog + 1  # held back instead of decoding ahead
+    reader_free.set()
+    assert await slow == "t5 " * 20
+    assert streamed == ["t5 "] * 20
+
+
+@pytest.mark.asyncio
+async def test_close_frees_the_weights_the_engine_loaded_itself(make_engine):
+    engine = make_engine()
+    engine.close()
+
+    assert engine.base.closed
+    assert not engine._thread.is_alive()
@@ -0,0 +1,85 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import asyncio
+import random
+import pytest
+pytest.importorskip("llama_cpp")  # multi_model_manager imports the inference engine
+from utils.load_balancing import ExpectedCompletionPolicy, LeastInFlightPolicy, request_cost
+from utils.multi_model_manager import ModelWorker
+
+
+class FakeModel:
+    def __init__(self, delay: float):
+        self.delay = delay
+
+    async def generate(self, prompt, max_tokens, on_token=None, cancel=None):
+        await asyncio.sleep(self.delay)
+        return "x" * 4 * max_tokens
+
+
+def make_worker(name, delay=0.0):
+    return ModelWorker(name=name, model_path="unused.gguf", model=FakeModel(delay))
+
+
+def test_token_cost_prefers_less_queued_work_over_fewer_requests():
+    short_jobs, long_job = make_worker("short_jobs"), make_worker("long_job")
+    short_jobs.in_flight_requests, short_jobs.outstanding_tokens = 3, 30
+    long_job.in_flight_requests, long_job.outstanding_tokens = 1, 2000
+    workers = [short_jobs, long_job]
+    cost = request_cost("hello", 64)
+
+    assert LeastInFlightPolicy().choose(workers, cost) is long_job
+    assert ExpectedCompletionPolicy(rng=random.Random(0)).choose(workers, cost) is short_jobs
+
+
+def test_token_cost_accounts_for_worker_speed():
+    slow, fast = make_worker("slow"), make_worker("fast")
+    slow.outstanding_tokens = fast.outstanding_tokens = 100
+    slow.tokens_per_sec, fast.tokens_per_sec = 5.0, 50.0
+
+    assert ExpectedCompletionPolicy().choose([slow, fast], request_cost("hi", 32)) is fast
+
+
+@pytest.mark.asyncio
+async def test_worker_tracks_outstanding_tokens_and_throughput():
+    worker = make_worker("worker_0", delay=0.05)
+    before = worker.tokens_per_sec
+
+    task = asyncio.ensure_future(worker.generate("prompt", 100))
+    await asyncio.sleep(0.01)
+    assert worker.outstanding_tokens == pytest.approx(request_cost("prompt", 100))
+    await task
+
+    assert worker.outstanding_tokens == 0
+    assert worker.tokens_per_sec > before  # ~2000 tokens/s measured pulls the EWMA up
+
+
+@pytest.mark.asyncio
+async def test_concurrently_routed_requests_spread_over_the_workers(monkeypatch):
+    from api import main
+    from utils.batching import BatchedRequest
+    from utils.multi_model_manager import MultiModelManager
+
+    class Manager(MultiModelManager):
+        def _new_model(self, cores=None):
+            return FakeModel(0.01)
+
+    # A full scan, so the only thing spreading the batch is what each choice sees already routed
+    manager = Manager(3, model_path="unused.gguf", backend="thread", policy=ExpectedCompletionPolicy(choices=3))
+    monkeypatch.setattr(main, "model_manager", manager)
+    loop = asyncio.get_running_loop()
+    batch = [BatchedRequest(f"prompt {i}", 16, loop.create_future()) for i in range(9)]
+    routed = []
+    original = manager.select_worker
+
+    def select_worker(*args):
+        worker = original(*args)
+        routed.append(worker.name)
+        return worker
+
+    monkeypatch.setattr(manager, "select_worker", select_worker)
+    await main.process_batch(batch)
+
+    assert sorted(routed.count(worker.name) for worker in manager.models) == [3, 3, 3]
+    assert all(worker.is_idle() and worker.outstanding_tokens == pytest.approx(0) for worker in manager.models)
@@ -0,0 +1,43 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import logging
+import queue
+from utils.logger import REQUEST, DeferredQueueHandler, RequestRateLimit, configure
+
+
+def _record(level, msg, *args):
+    return logging.LogRecord("test", level, __file__, 0, msg, args, None)
+
+
+def test_rate_limit_caps_request_records_per_template():
+    limit = RequestRateLimit(rate=0.001, burst=3)
+
+    passed = sum(limit.filter(_record(REQUEST, "[QUEUE] Enqueuing prompt: %s", i)) for i in range(50))
+    assert passed == 3
+    # Separate message templates get separate budgets, and other levels are never limited
+    assert limit.filter(_record(REQUEST, "[BATCH] Request %d processed", 1))
+    assert all(limit.filter(_record(logging.WARNING, "[QUEUE] Enqueuing prompt: %s", i)) for i in range(50))
+
+
+def test_handler_defers_formatting_to_listener():
+    records = queue.Queue(maxsize=1)
+    handler = DeferredQueueHandler(records)
+    handler.handle(_record(REQUEST, "prompt %.5s", "a long prompt"))
+    handler.handle(_record(REQUEST, "dropped %d", 2))  # queue full: dropped, not blocking
+
+    queued = records.get_nowait()
+    assert queued.msg == "prompt %.5s" and queued.args == ("a long prompt",)
+    assert records.empty()
+
+
+def test_configured_logger_writes_from_background_thread(tmp_path):
+    path = tmp_path / "inference.log"
+    log = configure("test_inference_logger", str(path))
+    log.log(REQUEST, "[QUEUE] Enqueuing prompt: %.10s", "hello world, how are you")
+    log.error("worker %s failed", "worker_0")
+    log.handlers[0].listener.stop()  # drains the queue
+
+    lines = path.read_text().splitlines()
+    assert lines[0].endswith("REQUEST - [QUEUE] Enqueuing prompt: hello worl")
+    assert lines[1].endswith("ERROR - worker worker_0 failed")
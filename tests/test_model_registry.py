@@ -0,0 +1,145 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import asyncio
+import pytest
+pytest.importorskip("llama_cpp")  # multi_model_manager imports the inference engine
+from prometheus_client import REGISTRY
+from utils.model_registry import ModelMemoryError, ModelRegistry, UnknownModelError
+from utils.multi_model_manager import MultiModelManager
+from utils.process_worker import CorePool
+
+MODEL_BYTES = 100
+
+
+class FakeModel:
+    def __init__(self):
+        self.closed = False
+
+    async def generate(self, prompt, max_tokens, on_token=None, cancel=None):
+        return "ok"
+
+    def context_bytes(self):
+        return 0
+
+    def close(self):
+        self.closed = True
+
+
+class FakeManager(MultiModelManager):
+    loads = 0
+
+    def _new_model(self, cores=None):
+        FakeManager.loads += 1
+        return FakeModel()
+
+
+def make_registry(tmp_path, budget=0):
+    paths = {}
+    for name in ("a", "b"):
+        path = tmp_path / f"{name}.gguf"
+        path.write_bytes(b"\0" * MODEL_BYTES)
+        paths[name] = str(path)
+    default = FakeManager(1, model_path=str(tmp_path / "default.gguf"))
+    return ModelRegistry(
+        paths, "default", default, memory_budget=budget,
+        pool_factory=lambda name, path: FakeManager(1, model_path=path, lazy=True, name=name),
+        measure=lambda pool: MODEL_BYTES if pool.models else 0,
+    )
+
+
+def _evictions(name):
+    return REGISTRY.get_sample_value("model_evictions_total", {"model": name}) or 0
+
+
+@pytest.mark.asyncio
+async def test_models_load_once_on_first_use(tmp_path):
+    registry = make_registry(tmp_path)
+    loads = FakeManager.loads
+
+    first, second = await asyncio.gather(registry.get("a"), registry.get("a"))
+    assert first is second and FakeManager.loads == loads + 1
+    assert first.models[0].name == "a/worker_0"
+    assert await registry.get() is registry.pools["default"]
+    with pytest.raises(UnknownModelError):
+        await registry.get("missing")
+
+
+@pytest.mark.asyncio
+async def test_least_recently_used_idle_model_is_evicted(tmp_path):
+    registry = make_registry(tmp_path, budget=2 * MODEL_BYTES)  # default plus one more
+    before = _evictions("a")
+
+    a = await registry.get("a")
+    await registry.get("b")
+    assert list(registry.pools) == ["default", "b"]
+    assert a.models == [] and _evictions("a") == before + 1
+
+    # A busy model is never evicted; with nothing else idle the new one can't load
+    registry.pools["b"].models[0].assigned_requests = 1
+    with pytest.raises(ModelMemoryError):
+        await registry.get("a")
+
+
+@pytest.mark.asyncio
+async def test_held_or_queued_models_are_not_evicted(tmp_path):
+    registry = make_registry(tmp_path, budget=2 * MODEL_BYTES)
+    queued = set()
+    registry.queued = lambda name: name in queued
+
+    async with registry.hold("a") as a:
+        # Routed to a but not generating yet: every worker still looks idle
+        with pytest.raises(ModelMemoryError):
+            await registry.get("b")
+        assert a.models
+
+    queued.add("a")
+    with pytest.raises(ModelMemoryError):
+        await registry.get("b")
+
+    queued.clear()
+    await registry.get("b")
+    assert list(registry.pools) == ["default", "b"] and not registry._holds
+
+
+@pytest.mark.asyncio
+async def test_workers_go_to_the_model_with_more_work(tmp_path):
+    registry = make_registry(tmp_path)
+    busy = await registry.get("a")
+    busy.models[0].outstanding_tokens = 500
+
+    await registry.scale_up()
+    assert len(busy.models) == 2 and len(registry.models) == 3
+
+    await registry.scale_down()
+    assert len(busy.models) == 1  # half the work per worker now, but the others can't go below one
+
+
+@pytest.mark.asyncio
+async def test_registry_errors_fail_the_request_without_retries(monkeypatch):
+    from api import main
+    from utils.batching import BatchedRequest
+    calls = []
+
+    async def unservable(name=None):
+        calls.append(name)
+        raise ModelMemoryError("no room for b")
+
+    monkeypatch.setattr(main.model_registry, "get", unservable)
+    req = BatchedRequest("hi", 8, asyncio.get_running_loop().create_future(), model="b")
+
+    assert await main._process_with_retries(0, req) is False
+    assert calls == ["b"]
+    with pytest.raises(ModelMemoryError):
+        req.future.result()
+
+
+def test_process_pools_of_every_model_share_one_core_pool(tmp_path):
+    default = MultiModelManager(2, model_path=str(tmp_path / "default.gguf"), backend="process", lazy=True,
+                                core_pool=CorePool(2, cores=[0, 1, 2, 3]))
+    registry = ModelRegistry({"a": str(tmp_path / "a.gguf")}, "default", default)
+
+    pool = registry.pool_factory("a", registry.paths["a"])
+    assert pool.backend == "process" and pool.core_pool is default.core_pool
+    taken = default.core_pool.acquire()
+    assert pool.core_pool.acquire() != taken  # a's first worker doesn't land on the default's cores
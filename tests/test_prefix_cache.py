@@ -0,0 +1,63 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import pytest
+from utils.prefix_cache import PrefixCache
+
+
+class FakeBuffer(list):
+    @property
+    def nbytes(self):
+        return 4 * len(self)
+
+
+class FakeState:
+    def __init__(self, tokens, size=100):
+        self.input_ids = FakeBuffer(tokens)
+        self.scores = FakeBuffer()
+        self.llama_state_size = size
+
+
+def test_restores_longest_cached_prefix():
+    cache = PrefixCache(capacity_bytes=10_000, block_size=4)
+    system = list(range(8))
+    short = FakeState(system[:4] + [90, 91, 92, 93])
+    long = FakeState(system + [50, 51, 52, 53])
+    cache[short.input_ids] = short
+    cache[long.input_ids] = long
+
+    assert cache[system + [77, 78, 79, 80]] is long
+    with pytest.raises(KeyError):
+        cache[[99, 98, 97, 96, 95]]
+
+
+def test_evicts_least_recently_used_within_budget():
+    cache = PrefixCache(capacity_bytes=400, block_size=4)
+    states = [FakeState([i] * 8) for i in range(3)]
+    for state in states:
+        cache[state.input_ids] = state
+    cache[states[0].input_ids]  # touch, so states[1] becomes the oldest
+
+    cache[[7] * 8] = FakeState([7] * 8)
+
+    assert [0] * 8 in cache
+    assert [1] * 8 not in cache
+    assert cache.cache_size <= 400
+
+
+def test_counts_a_hit_only_when_the_state_is_restored():
+    from prometheus_client import REGISTRY
+    live = []
+    cache = PrefixCache(capacity_bytes=10_000, block_size=4, context_tokens=lambda: live)
+    state = FakeState(list(range(8)))
+    cache[state.input_ids] = state
+    hits = lambda: REGISTRY.get_sample_value("prefix_cache_hits_total") or 0
+    before = hits()
+
+    cache[list(range(8)) + [9]]
+    assert hits() == before + 1
+
+    # The context already holds the whole prefix: llama-cpp keeps it and skips the cached state
+    live[:] = list(range(8))
+    assert cache[list(range(8)) + [9]] is state
+    assert hits() == before + 1
@@ -0,0 +1,75 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import multiprocessing
+import threading
+import pytest
+from utils.process_worker import CorePool, _worker_main, available_cores
+from utils.streaming import STREAM_BUFFER_SIZE
+
+
+def test_core_pool_hands_out_disjoint_sets():
+    pool = CorePool(num_workers=3, cores=list(range(16)))
+
+    sets = [pool.acquire() for _ in range(3)]
+
+    assert all(len(s) == 5 for s in sets)
+    assert len(set().union(*sets)) == 15  # no core shared between workers
+
+
+def test_core_pool_shares_least_used_set_when_exhausted():
+    pool = CorePool(num_workers=2, cores=[0, 1, 2, 3])
+    first, second = pool.acquire(), pool.acquire()
+
+    pool.release(first)
+    assert pool.acquire() == first  # freed set is reused before doubling up
+
+    third = pool.acquire()
+    assert third in (first, second)
+
+
+class CountingModel:
+    """Stands in for TinyLLamaModel in the child: streams one delta per token until stopped."""
+
+    tokens_avoided = 0
+
+    def __init__(self, model_path, n_threads=None):
+        pass
+
+    def context_bytes(self):
+        return 0
+
+    def _sync_generate(self, prompt, max_tokens, on_token, should_stop):
+        text = ""
+        for i in range(max_tokens):
+            if should_stop():
+                break
+            text += f"{i} "
+            on_token(f"{i} ")
+        return text
+
+    def close(self):
+        pass
+
+
+def test_child_streams_only_as_far_as_the_parent_has_granted_credit(monkeypatch):
+    engine = pytest.importorskip("models.inference_engine")
+    monkeypatch.setattr(engine, "TinyLLamaModel", CountingModel)
+    parent, child = multiprocessing.Pipe()
+    # The child's loop on a thread, on the cores we already have
+    threading.Thread(target=_worker_main, args=(child, "unused.gguf", tuple(available_cores())), daemon=True).start()
+    assert parent.recv()[0] == "ready"
+
+    parent.send((7, "prompt", 1000, True))
+    for i in range(STREAM_BUFFER_SIZE):
+        assert parent.recv() == ("token", 7, f"{i} ")
+    assert not parent.poll(0.2)  # out of credit: decoding waits for the reader
+
+    parent.send(("credit", 7, 2))
+    assert [parent.recv()[2] for _ in range(2)] == [f"{STREAM_BUFFER_SIZE} ", f"{STREAM_BUFFER_SIZE + 1} "]
+    assert not parent.poll(0.2)
+
+    parent.send(("cancel", 7))  # wakes the wait and stops the token loop
+    kind, request_id, (text, _, _) = parent.recv()
+    assert (kind, request_id) == ("done", 7) and len(text.split()) == STREAM_BUFFER_SIZE + 3
+    parent.send(None)
@@ -0,0 +1,113 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import asyncio
+import pytest
+from utils.batching import RequestQueueManager
+from utils.queue_backend import SQLiteQueue
+from utils.streaming import TokenChannel
+
+
+def _process(tmp_path, name):
+    # Two managers on one queue file stand in for two uvicorn workers
+    return RequestQueueManager(max_batch_wait_ms=1, queue=SQLiteQueue(str(tmp_path / "queue.db"), poll_interval=0.005, name=name))
+
+
+@pytest.mark.asyncio
+async def test_request_enqueued_by_one_process_is_served_by_another(tmp_path):
+    front, back = _process(tmp_path, "front"), _process(tmp_path, "back")
+
+    async def process_batch(batch):
+        for req in batch:
+            req.emit("Hello")
+            req.emit(" world")
+            req.future.set_result("Hello world")
+
+    channel = TokenChannel()
+    future = front.enqueue("remote prompt", 8, channel=channel)
+    await front.queue.refresh()  # runs after the insert, both go through front's database thread
+    await back.queue.refresh()
+    assert back.depth() == 1  # the backlog is visible to every process
+
+    loop_task = asyncio.create_task(back.start_loop(process_batch))  # only the back process has workers
+    assert await asyncio.wait_for(future, timeout=2) == "Hello world"
+    loop_task.cancel()
+
+    assert [channel.queue.get_nowait() for _ in range(channel.queue.qsize())] == ["Hello", " world"]
+    assert front.depth() == 0
+    front.close()
+    back.close()
+
+
+@pytest.mark.asyncio
+async def test_cancelling_on_the_enqueuer_stops_the_remote_generation(tmp_path):
+    front, back = _process(tmp_path, "front"), _process(tmp_path, "back")
+    started = asyncio.Event()
+
+    async def process_batch(batch):
+        req = batch[0]
+        started.set()
+        while not req.cancel_event.is_set():
+            await asyncio.sleep(0.005)
+        req.future.cancel()
+
+    future = front.enqueue("abandoned prompt", 8)
+    leader = front.pending[("abandoned prompt", 8, None)]
+    loop_task = asyncio.create_task(back.start_loop(process_batch))
+    await asyncio.wait_for(started.wait(), timeout=2)
+
+    future.cancel()  # the only caller walks away
+    for _ in range(200):
+        if leader.future.done():
+            break
+        await asyncio.sleep(0.005)
+    loop_task.cancel()
+
+    assert leader.future.cancelled()
+    front.close()
+    back.close()
+
+
+@pytest.mark.asyncio
+async def test_autoscaler_share_splits_the_backlog_between_processes(tmp_path):
+    front, back = _process(tmp_path, "front"), _process(tmp_path, "back")
+    for i in range(3):
+        front.enqueue(f"prompt {i}", 8)
+    # Heartbeats: both processes count as live
+    await front.queue.refresh()
+    await back.queue.refresh()
+
+    assert front.depth() == back.depth() == 3
+    assert back.share() == 2
+    front.close()
+    back.close()
+
+
+@pytest.mark.asyncio
+async def test_idle_consumers_only_read_and_back_off(tmp_path):
+    queue = SQLiteQueue(str(tmp_path / "queue.db"), poll_interval=0.005, name="idle")
+    statements = []
+    execute = queue._execute
+
+    def recording(sql, params=()):
+        statements.append(sql.split()[0])
+        return execute(sql, params)
+
+    queue._execute = recording
+    loop = asyncio.get_running_loop()
+
+    getter = asyncio.ensure_future(queue.get())
+    await asyncio.sleep(0.3)
+    assert "UPDATE" not in statements  # an empty queue is never claimed from
+    claims = statements.count("SELECT")
+    assert claims < 0.3 / 0.005 / 2  # fixed-interval polling would be ~60 reads
+
+    # A local enqueue wakes the getter at once instead of waiting out the backoff
+    from utils.batching import BatchedRequest
+    req = BatchedRequest("prompt", 8, loop.create_future())
+    started = loop.time()
+    queue.put_nowait(req)
+    assert await asyncio.wait_for(getter, timeout=1) is req
+    assert loop.time() - started < 0.05
+    req.future.set_result("done")
+    queue.close()
@@ -0,0 +1,77 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import asyncio
+import itertools
+import pytest
+pytest.importorskip("llama_cpp")  # multi_model_manager imports the inference engine
+from utils.multi_model_manager import MultiModelManager
+
+_generation = itertools.count()
+
+
+class FakeModel:
+    def __init__(self, fail_warm_up=False):
+        self.generation = next(_generation)
+        self.fail_warm_up = fail_warm_up
+        self.closed = False
+        self.release = asyncio.Event()
+
+    async def generate(self, prompt, max_tokens, on_token=None, cancel=None):
+        if self.fail_warm_up:
+            raise RuntimeError("bad weights")
+        if prompt == "slow":
+            await self.release.wait()
+        return f"answer from model {self.generation}"
+
+    def close(self):
+        self.closed = True
+
+
+class FakeManager(MultiModelManager):
+    fail_warm_up = False
+
+    def _new_model(self, cores=None):
+        return FakeModel(self.fail_warm_up)
+
+
+@pytest.mark.asyncio
+async def test_rolling_reload_keeps_capacity_and_drains_old_workers():
+    manager = FakeManager(num_workers=2, model_path="unused.gguf")
+    old_workers = list(manager.models)
+    busy = old_workers[0]
+    request = asyncio.ensure_future(busy.generate("slow", 8))
+    await asyncio.sleep(0)
+
+    assert manager.start_reload()
+    assert not manager.start_reload()  # one reload at a time
+    for _ in range(20):
+        await asyncio.sleep(0.01)
+        assert len(manager.models) == 2
+    assert busy not in manager.models  # replaced and draining...
+    assert not busy.model.closed  # ...but not closed under the in-flight request
+
+    busy.model.release.set()
+    assert await request == "answer from model 0"
+    while manager.reload_status["state"] == "running":
+        await asyncio.sleep(0.01)
+
+    assert manager.reload_status["state"] == "done"
+    assert manager.reload_status["completed"] == 2
+    assert not set(manager.models) & set(old_workers)
+
+
+@pytest.mark.asyncio
+async def test_failed_warm_up_leaves_serving_workers_untouched():
+    manager = FakeManager(num_workers=2, model_path="unused.gguf")
+    old_workers = list(manager.models)
+    manager.fail_warm_up = True
+
+    assert manager.start_reload()
+    while manager.reload_status["state"] == "running":
+        await asyncio.sleep(0.01)
+
+    assert manager.reload_status["state"] == "failed"
+    assert "bad weights" in manager.reload_status["error"]
+    assert manager.models == old_workers
+    assert not any(worker.model.closed for worker in old_workers)
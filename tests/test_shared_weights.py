@@ -0,0 +1,37 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import pytest
+pytest.importorskip("llama_cpp")
+from llama_cpp import Llama
+from utils import config
+from models.inference_engine import SharedWeights
+
+# Any GGUF works, the tiniest is best; skipped when there is none
+MODEL = os.getenv("INFERSAFE_TEST_MODEL", config.MODEL_PATH)
+pytestmark = pytest.mark.skipif(not os.path.exists(MODEL), reason=f"no model at {MODEL}, set INFERSAFE_TEST_MODEL")
+
+
+def complete(llm, prompt):
+    return llm.create_completion(prompt, max_tokens=8, temperature=0)["choices"][0]["text"]
+
+
+def test_contexts_share_one_model_and_decode_independently():
+    weights = SharedWeights.get(MODEL)
+    first = weights.new_context(n_ctx=256, n_threads=1)
+    second = weights.new_context(n_ctx=256, n_threads=1)
+
+    assert first._model is second._model is weights.base._model
+    assert first._ctx is not second._ctx and first.input_ids is not second.input_ids
+
+    alone = Llama(model_path=MODEL, n_ctx=256, n_threads=1, verbose=False)
+    expected = complete(alone, "The capital of France is")
+    alone.close()
+
+    assert complete(first, "The capital of France is") == expected
+    n_tokens = first.n_tokens
+    complete(second, "Once upon a time, in a land far away")
+    # Decoding on the other context leaves this one's tokens and KV cache alone
+    assert first.n_tokens == n_tokens
+    assert complete(first, "The capital of France is") == expected
+    SharedWeights.forget(MODEL)
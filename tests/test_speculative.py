@@ -0,0 +1,62 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import numpy as np
+import pytest
+pytest.importorskip("llama_cpp")
+from prometheus_client import REGISTRY
+from utils import config
+from models.speculative import MeasuredDraft, make_draft
+
+
+class ScriptedDraft:
+    def __init__(self, proposals):
+        self.proposals = list(proposals)
+
+    def __call__(self, input_ids, **kwargs):
+        return np.array(self.proposals.pop(0), dtype=np.intc)
+
+
+def test_acceptance_is_the_agreeing_prefix_of_each_draft():
+    draft = MeasuredDraft(ScriptedDraft([[6, 7, 8], [10, 11], []]), "prompt_lookup")
+    before = REGISTRY.get_sample_value("model_speculative_accepted_tokens_total", {"mode": "prompt_lookup"}) or 0
+
+    draft(np.array([1, 2, 3, 4, 5], dtype=np.intc))
+    # The model kept 6 and 7, then sampled 9 instead of 8
+    draft(np.array([1, 2, 3, 4, 5, 6, 7, 9], dtype=np.intc))
+    # Both drafted tokens accepted, plus the model's own next token
+    draft(np.array([1, 2, 3, 4, 5, 6, 7, 9, 10, 11, 12], dtype=np.intc))
+    assert (draft.drafted, draft.accepted) == (5, 4)
+
+    draft.finish()
+    after = REGISTRY.get_sample_value("model_speculative_accepted_tokens_total", {"mode": "prompt_lookup"})
+    assert after == before + 4
+
+
+def test_prompt_lookup_drafts_from_repeated_input(monkeypatch):
+    monkeypatch.setattr(config, "SPECULATIVE_DRAFT_TOKENS", 3)
+    draft = make_draft("prompt_lookup")
+    # "... 5 6" appeared earlier followed by 7 8 9: that continuation is the draft
+    proposal = draft(np.array([4, 5, 6, 7, 8, 9, 1, 5, 6], dtype=np.intc))
+    assert proposal.tolist() == [7, 8, 9]
+
+    assert make_draft("off") is None
+    with pytest.raises(ValueError):
+        make_draft("medusa")
+
+
+def test_decode_rate_counts_only_content_chunks():
+    from models.inference_engine import TinyLLamaModel
+
+    class StreamedLlama:
+        def create_chat_completion(self, **kwargs):
+            chunks = [{"role": "assistant"}, {"content": "a"}, {"content": "b"}, {"content": "c"}, {}]
+            return iter([{"choices": [{"delta": delta}]} for delta in chunks])
+
+    model = TinyLLamaModel.__new__(TinyLLamaModel)
+    model.llm, model.prefix_cache, model.draft, model.speculative, model.tokens_avoided = StreamedLlama(), None, None, "off", 0
+    counted = []
+    model._record_speed = lambda n_tokens, first_token_at: counted.append(n_tokens)
+
+    assert model._decode("hi", 8, None, lambda: False) == "abc"
+    assert counted == [3]
@@ -0,0 +1,41 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import time
+import pytest
+pytest.importorskip("llama_cpp")  # multi_model_manager imports the inference engine
+from utils.multi_model_manager import MultiModelManager
+
+LOAD_SECONDS = 0.2
+
+
+class SlowLoadingManager(MultiModelManager):
+    def _new_model(self, cores=None):
+        time.sleep(LOAD_SECONDS)  # stands in for reading the GGUF weights
+        return object()
+
+
+@pytest.mark.asyncio
+async def test_lazy_manager_loads_workers_concurrently():
+    manager = SlowLoadingManager(num_workers=3, model_path="unused.gguf", lazy=True)
+    assert not manager.is_ready()
+
+    ready_at = []
+    started = time.monotonic()
+    await manager.start(on_worker_ready=lambda worker: ready_at.append(time.monotonic() - started))
+
+    assert manager.is_ready() and len(manager.models) == 3
+    assert ready_at[-1] < 2 * LOAD_SECONDS  # serial loading would take 3x
+
+
+def test_ready_endpoint_gates_on_first_worker(monkeypatch):
+    monkeypatch.setenv("TESTING", "1")  # keeps the lifespan hook from loading real models
+    from fastapi.testclient import TestClient
+    from api import main
+
+    with TestClient(main.app) as client:
+        assert client.get("/ready").status_code == 503
+        monkeypatch.setattr(main.model_manager, "models", [object()])
+        response = client.get("/ready")
+        assert response.status_code == 200 and response.json()["workers"] == 1
+        monkeypatch.setattr(main.model_manager, "models", [])  # nothing for shutdown to close
@@ -0,0 +1,59 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import asyncio
+import pytest
+import threading
+from utils.streaming import TokenChannel, TokenRelay
+
+
+@pytest.mark.asyncio
+async def test_channel_streams_deltas_from_executor_thread():
+    channel = TokenChannel(maxsize=1)  # tiny buffer so the producer has to wait for the reader
+
+    def produce():
+        for delta in ["Hello", ",", " world"]:
+            channel.put_threadsafe(delta)
+        return "Hello, world"
+
+    loop = asyncio.get_event_loop()
+    future = loop.run_in_executor(None, produce)
+
+    received = [delta async for delta in channel.iter_until(future, timeout=5)]
+
+    assert received == ["Hello", ",", " world"]
+    assert future.result() == "Hello, world"
+    assert channel.emitted == 3
+
+
+@pytest.mark.asyncio
+async def test_channel_times_out_when_nothing_arrives():
+    channel = TokenChannel()
+    future = asyncio.get_event_loop().create_future()
+
+    with pytest.raises(asyncio.TimeoutError):
+        async for _ in channel.iter_until(future, timeout=0.05):
+            pass
+
+
+@pytest.mark.asyncio
+async def test_relay_never_blocks_the_producer_thread_on_a_slow_reader():
+    channel = TokenChannel(maxsize=1)
+    relay = TokenRelay(channel.put)
+
+    def produce():
+        # Shared reader thread: pushes everything even though nobody is reading yet
+        for delta in ["a", "b", "c"]:
+            relay.push(delta)
+
+    thread = threading.Thread(target=produce)
+    thread.start()
+    thread.join(timeout=1)
+    assert not thread.is_alive()
+    await asyncio.sleep(0.01)
+    assert relay.backlog == 2  # one delta fills the channel, the rest wait in the relay
+
+    finished = asyncio.ensure_future(relay.finish())
+    received = [delta async for delta in channel.iter_until(finished, timeout=5)]
+    assert received == ["a", "b", "c"]
+    assert relay.backlog == 0
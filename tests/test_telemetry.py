@@ -0,0 +1,52 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import json
+import time
+from prometheus_client import REGISTRY
+from utils import config, telemetry
+from utils.telemetry import RequestTrace
+
+
+def _count(name):
+    return REGISTRY.get_sample_value(f"{name}_count") or 0
+
+
+def test_trace_observes_every_stage_once():
+    before = {name: _count(name) for name in (
+        "inference_queue_wait_seconds", "inference_dispatch_seconds", "inference_inter_token_seconds",
+        "inference_total_latency_seconds", "inference_tokens_per_second")}
+
+    trace = RequestTrace()
+    trace.dispatched()
+    trace.started("worker_0")
+    trace.started("worker_1")  # a retry doesn't observe dispatch time again
+    for _ in range(4):
+        time.sleep(0.001)
+        trace.token()
+    trace.finish("ok")
+
+    assert _count("inference_queue_wait_seconds") == before["inference_queue_wait_seconds"] + 1
+    assert _count("inference_dispatch_seconds") == before["inference_dispatch_seconds"] + 1
+    assert _count("inference_inter_token_seconds") == before["inference_inter_token_seconds"] + 3
+    assert _count("inference_total_latency_seconds") == before["inference_total_latency_seconds"] + 1
+    assert _count("inference_tokens_per_second") == before["inference_tokens_per_second"] + 1
+
+
+def test_sampled_trace_is_exported_as_spans(tmp_path, monkeypatch):
+    path = tmp_path / "traces.jsonl"
+    monkeypatch.setattr(config, "TRACE_SAMPLE_RATE", 1.0)
+    monkeypatch.setattr(config, "TRACE_FILE", str(path))
+    monkeypatch.setattr(telemetry, "_exporter", None)
+
+    trace = RequestTrace()
+    trace.dispatched()
+    trace.started("worker_0")
+    trace.token()
+    trace.token()
+    trace.finish("ok")
+    telemetry._exporter.close()
+
+    record = json.loads(path.read_text().splitlines()[0])
+    assert record["outcome"] == "ok" and record["worker"] == "worker_0" and record["tokens"] == 2
+    assert [span["name"] for span in record["spans"]] == ["queue", "dispatch", "prefill", "decode"]
@@ -0,0 +1,147 @@
+import asyncio
+import contextlib
+from collections import OrderedDict, deque
+from typing import Tuple
+from prometheus_client import Counter
+from utils import config
+from utils.load_balancing import CHARS_PER_TOKEN, estimate_tokens
+
+CHAT_TEMPLATE_TOKENS = 12  # tokens the chat template adds around a prompt, used until the tokenizer is loaded
+MIN_OUTPUT_TOKENS = 16  # truncation leaves at least this much room to answer, otherwise the request is rejected
+
+ADMISSION_REJECTED = Counter(
+    "inference_admission_rejected_total", "Requests refused at enqueue because they can't fit the context window", ["reason"]
+)
+ADMISSION_TRUNCATED = Counter(
+    "inference_admission_truncated_total", "Requests shortened at enqueue to fit the context window, by what was cut", ["part"]
+)
+
+
+class RequestTooLargeError(Exception):
+    """Raised by admission when prompt plus max_tokens can't be made to fit the context window."""
+
+    def __init__(self, prompt_tokens: int, max_tokens: int, n_ctx: int):
+        super().__init__(
+            f"Prompt ({prompt_tokens} tokens) plus max_tokens ({max_tokens}) exceeds the {n_ctx} token context window"
+        )
+        self.prompt_tokens = prompt_tokens
+        self.max_tokens = max_tokens
+
+
+class TokenAdmission:
+    """Counts a request's prompt tokens once, at enqueue, and makes sure it fits the context.
+
+    `tokenizer` needs `ready`, `count(prompt)` (chat template included) and `drop_head(prompt, n)`;
+    without one, or until it is loaded, counts are estimated from the prompt length. Exact counts
+    are cached per prompt, so retries, coalesced duplicates and repeated prompts skip tokenizing.
+    """
+
+    def __init__(self, tokenizer=None, n_ctx: int = config.N_CTX, policy: str = config.OVERSIZE_POLICY,
+                 cache_size: int = config.TOKEN_COUNT_CACHE_SIZE):
+        self.tokenizer = tokenizer
+        self.n_ctx = n_ctx
+        self.policy = policy
+        self.cache_size = cache_size
+        self.counts: "OrderedDict[str, int]" = OrderedDict()
+
+    def count(self, prompt: str) -> int:
+        if self.tokenizer is None or not self.tokenizer.ready:
+            return estimate_tokens(prompt) + CHAT_TEMPLATE_TOKENS  # not cached, the real count replaces it later
+        n = self.counts.get(prompt)
+        if n is None:
+            n = self.counts[prompt] = self.tokenizer.count(prompt)
+            while len(self.counts) > self.cache_size:
+                self.counts.popitem(last=False)
+        self.counts.move_to_end(prompt)
+        return n
+
+    def _drop_head(self, prompt: str, n_tokens: int) -> str:
+        if self.tokenizer is None or not self.tokenizer.ready:
+            return prompt[n_tokens * CHARS_PER_TOKEN:]
+        return self.tokenizer.drop_head(prompt, n_tokens)
+
+    def admit(self, prompt: str, max_tokens: int) -> Tuple[str, int, int]:
+        """Return (prompt, max_tokens, prompt_tokens) that fit, or raise RequestTooLargeError."""
+        prompt_tokens = self.count(prompt)
+        if prompt_tokens + max_tokens <= self.n_ctx:
+            return prompt, max_tokens, prompt_tokens
+        if self.policy == "reject":
+            ADMISSION_REJECTED.labels(reason="too_large").inc()
+            raise RequestTooLargeError(prompt_tokens, max_tokens, self.n_ctx)
+
+        # Shorten the answer first; only cut the prompt if it leaves too little room to answer at all
+        if self.n_ctx - prompt_tokens >= MIN_OUTPUT_TOKENS:
+            ADMISSION_TRUNCATED.labels(part="max_tokens").inc()
+            return prompt, self.n_ctx - prompt_tokens, prompt_tokens
+        max_tokens = min(max_tokens, MIN_OUTPUT_TOKENS)
+        # Keep the end of the prompt, where the actual question usually is
+        truncated = self._drop_head(prompt, prompt_tokens + max_tokens - self.n_ctx)
+        truncated_tokens = self.count(truncated) if truncated else 0
+        if not truncated or truncated_tokens + max_tokens > self.n_ctx:
+            ADMISSION_REJECTED.labels(reason="prompt_too_long").inc()
+            raise RequestTooLargeError(prompt_tokens, max_tokens, self.n_ctx)
+        ADMISSION_TRUNCATED.labels(part="prompt").inc()
+        return truncated, max_tokens, truncated_tokens
+
+
+class TokenSlots:
+    """Worker concurrency counted in context tokens instead of requests.
+
+    A request reserves its prompt plus max_tokens and waits until that fits in what's left of
+    `capacity`, with at most `max_requests` running. Waiters are served in arrival order so a long
+    request is not starved by a stream of short ones slipping past it.
+    """
+
+    def __init__(self, capacity: int, max_requests: int):
+        self.capacity = capacity
+        self.max_requests = max_requests
+        self.reserved = 0
+        self.holders = 0
+        self._waiters: deque = deque()  # (tokens, future) in arrival order
+
+    def _fits(self, tokens: int) -> bool:
+        return self.holders < self.max_requests and self.reserved + tokens <= self.capacity
+
+    def _take(self, tokens: int):
+        self.reserved += tokens
+        self.holders += 1
+
+    def _wake(self):
+        while self._waiters and self._fits(self._waiters[0][0]):
+            tokens, waiter = self._waiters.popleft()
+            if not waiter.done():
+                self._take(tokens)
+                waiter.set_result(None)
+
+    async def acquire(self, tokens: int) -> int:
+        # A request bigger than the whole budget runs alone rather than never
+        tokens = min(tokens, self.capacity)
+        if not self._waiters and self._fits(tokens):
+            self._take(tokens)
+            return tokens
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiters.append((tokens, waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.cancelled():
+                with contextlib.suppress(ValueError):
+                    self._waiters.remove((tokens, waiter))
+                self._wake()  # the head of the line may have been us
+            else:
+                self.release(tokens)  # granted just as we were cancelled
+            raise
+        return tokens
+
+    def release(self, tokens: int):
+        self.reserved -= tokens
+        self.holders -= 1
+        self._wake()
+
+    @contextlib.asynccontextmanager
+    async def reserve(self, tokens: int):
+        tokens = await self.acquire(tokens)
+        try:
+            yield
+        finally:
+            self.release(tokens)
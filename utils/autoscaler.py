@@ -1,68 +1,171 @@
 import asyncio
+import inspect
 import logging
+import math
+from collections import deque
+from typing import Callable, Deque, Optional, Tuple
 from prometheus_client import Gauge
 import time
+from utils import config
 
 
 IN_FLIGHT_REQUESTS = Gauge("in_flight_requests", "Total in-flight concurrent requests")
 MODEL_WORKER_COUNT = Gauge("model_worker_count", "Number of model workers")
+SCALING_PRESSURE = Gauge("autoscaler_pressure", "Worst smoothed signal relative to its target (above 1 means over SLO)")
+
+SCALE_DOWN_HEADROOM = 0.7  # only remove a worker if pressure would stay below this with one fewer
+
+
+class SlidingWindow:
+    """Timestamped samples from the last `window` seconds."""
+
+    def __init__(self, window: float):
+        self.window = window
+        self.samples: Deque[Tuple[float, float]] = deque()
+
+    def add(self, value: float, now: Optional[float] = None):
+        now = time.monotonic() if now is None else now
+        self.samples.append((now, value))
+        self._trim(now)
+
+    def _trim(self, now: float):
+        while self.samples and self.samples[0][0] < now - self.window:
+            self.samples.popleft()
+
+    def values(self, now: Optional[float] = None, since: float = float("-inf")) -> list:
+        self._trim(time.monotonic() if now is None else now)
+        return [value for at, value in self.samples if at >= since]
+
+    def mean(self, now: Optional[float] = None, since: float = float("-inf")) -> Optional[float]:
+        values = self.values(now, since)
+        return sum(values) / len(values) if values else None
+
+    def percentile(self, q: float, now: Optional[float] = None, since: float = float("-inf")) -> Optional[float]:
+        values = sorted(self.values(now, since))
+        if not values:
+            return None
+        return values[min(len(values) - 1, math.ceil(q * len(values)) - 1)]
+
+
+class LoadSignals:
+    """Per-request queue wait and latency, fed by the request path and read by the autoscaler."""
+
+    def __init__(self, window: float = None):
+        window = window if window is not None else config.SCALE_WINDOW_SECONDS
+        self.queue_wait = SlidingWindow(window)
+        self.latency = SlidingWindow(window)
+
 
 class Autoscaler:
-    def __init__(self, manager, scale_interval=5, scale_up_threshold=None, scale_down_threshold=None, min_workers=None, cooldown=None):
+    """Adds or removes workers to keep smoothed load signals under their targets.
+
+    Every tick the signals (in-flight and queued requests per worker, p95 queue wait and
+    latency over the window) are turned into ratios against their targets; the worst one is
+    the pressure. Above 1 we scale up. We scale down only when pressure stayed low enough for
+    a whole window that it would still be under SCALE_DOWN_HEADROOM with one worker fewer, so
+    a short lull right after a burst doesn't undo the scale-up.
+    """
+
+    def __init__(self, manager, scale_interval=5, scale_up_threshold=None, scale_down_threshold=None, min_workers=None, cooldown=None,
+                 queue_depth: Optional[Callable[[], int]] = None, signals: Optional[LoadSignals] = None,
+                 max_workers=None, window=None, percentile=0.95):
         self.manager = manager
         self.scale_interval = scale_interval
         self.SCALE_UP_THRESHOLD = scale_up_threshold if scale_up_threshold is not None else 5    # Requests per worker threshold for scaling up
         self.SCALE_DOWN_THRESHOLD = scale_down_threshold if scale_down_threshold is not None else 1  # Requests per worker threshold for scaling down
-        self.MIN_WORKERS = min_workers if min_workers is not None else 1           # Minimum number of workers to maintain
+        self.MIN_WORKERS = min_workers if min_workers is not None else config.MIN_WORKERS  # Minimum number of workers to maintain
+        self.MAX_WORKERS = max_workers if max_workers is not None else config.MAX_WORKERS
         self.cooldown = cooldown if cooldown is not None else 15             # Seconds between scaling actions
-        self.last_scale_time = 0
-    
+        self.window = window if window is not None else config.SCALE_WINDOW_SECONDS
+        self.percentile = percentile
+        self.queue_depth = queue_depth
+        self.signals = signals
+        self.last_scale_time = float("-inf")
+        self.load = SlidingWindow(self.window)  # total in-flight requests per tick
+        self.queued = SlidingWindow(self.window)  # queue depth per tick
+        self.pressure_history = SlidingWindow(self.window)
+        self.history_start: Optional[float] = None  # first tick observed at the current worker count
+
+    def pressure(self, num_workers: int, now: float) -> float:
+        # Only samples taken at the current worker count: after a scale-up the old, slower
+        # samples would otherwise keep asking for more workers until they age out of the window
+        since = self.history_start
+        workers = max(1, num_workers)
+        ratios = [self.load.mean(now, since) / workers / self.SCALE_UP_THRESHOLD]
+        if self.queue_depth is not None:
+            ratios.append(self.queued.mean(now, since) / workers / config.SCALE_QUEUE_PER_WORKER)
+        if self.signals is not None:
+            queue_wait = self.signals.queue_wait.percentile(self.percentile, now, since)
+            if queue_wait is not None:
+                ratios.append(queue_wait / config.SLO_QUEUE_WAIT_SECONDS)
+            latency = self.signals.latency.percentile(self.percentile, now, since)
+            if latency is not None:
+                ratios.append(latency / config.SLO_LATENCY_SECONDS)
+        return max(ratios)
+
+    def evaluate(self, now: float) -> int:
+        """Record this tick's signals and return +1 to add a worker, -1 to remove one, 0 to hold."""
+        in_flight = self.manager.total_in_flight()
+        num_workers = len(self.manager.models)
+        self.load.add(in_flight, now)
+        if self.queue_depth is not None:
+            self.queued.add(self.queue_depth(), now)
+        if self.history_start is None:
+            self.history_start = now
+
+        IN_FLIGHT_REQUESTS.set(in_flight)
+        MODEL_WORKER_COUNT.set(num_workers)
+
+        pressure = self.pressure(num_workers, now)
+        self.pressure_history.add(pressure, now)
+        SCALING_PRESSURE.set(pressure)
+        logging.info(
+            f"[AUTOSCALER] Status: in_flight={in_flight}, "
+            f"workers={num_workers}, pressure={pressure:.2f}"
+        )
+
+        if num_workers < self.MIN_WORKERS:
+            return 1  # Force scale up if below minimum
+        if now - self.last_scale_time < self.cooldown:
+            return 0
+        if pressure > 1.0 and num_workers < self.MAX_WORKERS:
+            return 1
+        # Scale-down needs a full window at this worker count and is judged on that window's worst tick
+        if num_workers > self.MIN_WORKERS and now - self.history_start >= self.window:
+            projected = max(self.pressure_history.values(now)) * num_workers / (num_workers - 1)
+            load_per_worker = max(self.load.values(now, self.history_start)) / (num_workers - 1)
+            if projected < SCALE_DOWN_HEADROOM and load_per_worker < self.SCALE_DOWN_THRESHOLD:
+                return -1
+        return 0
+
+    def scaled(self, now: float):
+        # Old samples describe the previous worker count, the history restarts from here
+        self.last_scale_time = now
+        self.pressure_history.samples.clear()
+        self.history_start = now
+
     async def start_scaling(self):
         while True:
             try:
                 await asyncio.sleep(self.scale_interval)
-                now = time.time()
-                
-                # Skip if in cooldown
-                if now - self.last_scale_time < self.cooldown:
-                    continue
-                
-                # Get current metrics
-                in_flight = self.manager.total_in_flight()
-                num_workers = len(self.manager.models)
-                
-                # Update Prometheus metrics
-                IN_FLIGHT_REQUESTS.set(in_flight)
-                MODEL_WORKER_COUNT.set(num_workers)
-                
-                # Calculate load per worker (safely handle zero workers)
-                if num_workers < self.MIN_WORKERS:
-                    avg_load_per_worker = float('inf')  # Force scale up if below minimum
-                else:
-                    avg_load_per_worker = in_flight / num_workers
-                
-                logging.info(
-                    f"[AUTOSCALER] Status: in_flight={in_flight}, "
-                    f"workers={num_workers}, avg_load={avg_load_per_worker:.2f}"
-                )
-                
-                # Scale based on per-worker load
-                if avg_load_per_worker > self.SCALE_UP_THRESHOLD:
-                    logging.info(
-                        f"[AUTOSCALER] Scaling UP: avg_load={avg_load_per_worker:.2f} > "
-                        f"threshold={self.SCALE_UP_THRESHOLD}"
-                    )
-                    self.manager.scale_up()
-                    self.last_scale_time = now
-                elif (avg_load_per_worker < self.SCALE_DOWN_THRESHOLD 
-                      and num_workers > self.MIN_WORKERS):
-                    logging.info(
-                        f"[AUTOSCALER] Scaling DOWN: avg_load={avg_load_per_worker:.2f} < "
-                        f"threshold={self.SCALE_DOWN_THRESHOLD}"
-                    )
-                    self.manager.scale_down()
-                    self.last_scale_time = now
-                    
+                now = time.monotonic()  # same clock as the LoadSignals samples
+                change = self.evaluate(now)
+                if change > 0:
+                    logging.info(f"[AUTOSCALER] Scaling UP to {len(self.manager.models) + 1} workers")
+                    self.scaled(now)
+                    await _call(self.manager.scale_up)
+                elif change < 0:
+                    logging.info(f"[AUTOSCALER] Scaling DOWN to {len(self.manager.models) - 1} workers")
+                    self.scaled(now)
+                    await _call(self.manager.scale_down)
+
             except Exception as e:
                 logging.error(f"[AUTOSCALER] Error in scaling loop: {e}")
                 await asyncio.sleep(1)  # Back off on error
+
+
+async def _call(action: Callable):
+    # Managers may scale synchronously or, to load models off the event loop, asynchronously
+    result = action()
+    if inspect.isawaitable(result):
+        await result
@@ -1,51 +1,287 @@
 import asyncio
-from typing import List, Callable
+import math
+import threading
+from typing import Dict, List, Callable, Optional, Tuple
 import logging
+import time
+from prometheus_client import Counter
+from utils import config
+from utils.admission import TokenAdmission
+from utils.cancellation import CancelToken
+from utils.load_balancing import estimate_tokens
+from utils.logger import REQUEST, logger
+from utils.queue_backend import make_queue
+from utils.response_cache import ResponseCache
+from utils.streaming import TokenChannel
+from utils.telemetry import BATCH_SIZE, RequestTrace
 
-BATCH_SIZE_LIMIT = 10  # Maximum number of requests per batch
+BATCH_SIZE_LIMIT = config.BATCH_SIZE_LIMIT  # Maximum number of requests per batch
+ARRIVAL_EWMA_ALPHA = 0.2  # weight of the newest inter-arrival gap / batch duration
+
+class QueueFullError(Exception):
+    """Raised by enqueue when the queue is at capacity; retry_after is a hint in seconds."""
+
+    def __init__(self, retry_after: int):
+        super().__init__("Request queue is full, try again later")
+        self.retry_after = retry_after
+
+RESPONSE_CACHE_HITS = Counter("response_cache_hits_total", "Requests answered from the response cache")
+RESPONSE_CACHE_MISSES = Counter("response_cache_misses_total", "Requests that missed the response cache")
+COALESCED_REQUESTS = Counter("coalesced_requests_total", "Requests attached to an identical request already in flight")
 
 class BatchedRequest:
-    def __init__(self, prompt: str, max_tokens: int, future: asyncio.Future):
+    def __init__(self, prompt: str, max_tokens: int, future: asyncio.Future, channel: Optional[TokenChannel] = None,
+                 prompt_tokens: Optional[int] = None, model: Optional[str] = None):
         self.prompt = prompt
         self.max_tokens = max_tokens
+        self.model = model  # registry name, None for the default model
+        self.prompt_tokens = prompt_tokens  # counted at admission, None if the request bypassed it
         self.future = future
-        
+        self.enqueued_at = time.monotonic()
+        self.trace = RequestTrace(self.enqueued_at)
+        # Every caller waiting on this generation; coalesced duplicates subscribe here too
+        self.channels: List[TokenChannel] = [channel] if channel is not None else []
+        self.callers = 0
+        self.cancel_event = CancelToken()  # set once every caller has given up
+        self.deltas: List[str] = []
+        self._lock = threading.Lock()
+
+    @property
+    def tokens(self) -> int:
+        # Context the request occupies on a worker: its prompt plus everything it may generate
+        prompt_tokens = self.prompt_tokens if self.prompt_tokens is not None else estimate_tokens(self.prompt)
+        return prompt_tokens + self.max_tokens
+
+    @property
+    def emitted(self) -> int:
+        return len(self.deltas)
+
+    def emit(self, delta: str):
+        # Called from the model's executor thread for every decoded delta
+        self.trace.token()
+        with self._lock:
+            self.deltas.append(delta)
+            channels = list(self.channels)
+        for channel in channels:
+            channel.put_threadsafe(delta)
+
+    async def emit_async(self, delta: str):
+        # Event-loop counterpart of emit, for models that relay deltas on the loop and queues fed by other processes
+        self.trace.token()
+        with self._lock:
+            self.deltas.append(delta)
+            channels = list(self.channels)
+        for channel in channels:
+            await channel.put(delta)
+
+    def add_caller(self, future: asyncio.Future):
+        self.callers += 1
+        future.add_done_callback(self._caller_done)
+
+    def _caller_done(self, future: asyncio.Future):
+        # A caller future cancelled before the result arrived means that caller walked away
+        if future.cancelled():
+            self.callers -= 1
+            if self.callers <= 0:
+                self.cancel_event.set()
+
+    def subscribe(self, channel: TokenChannel):
+        # Called on the event loop; a late subscriber first gets everything decoded so far as one delta
+        with self._lock:
+            if self.deltas:
+                channel.put_nowait("".join(self.deltas))
+            self.channels.append(channel)
+
+
+def _propagate(source: asyncio.Future, target: asyncio.Future):
+    if target.done():
+        return
+    if source.cancelled():
+        target.cancel()
+    elif source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
 
 class RequestQueueManager:
-    def __init__(self, batch_interval: int = 100, max_queue_size: int = 100):
-        self.queue: List[BatchedRequest] = []
-        self.batch_interval = batch_interval / 1000
+    """Collects requests into batches and dispatches them as soon as they are worth running.
+
+    Requests are admitted against the context window on enqueue (see TokenAdmission). A batch
+    leaves when the next request would take it over `batch_token_budget` tokens, when it reaches
+    `batch_size_limit` requests, or when its wait window expires, whichever comes first. The window
+    adapts to the arrival rate: if the next request is not expected within `max_batch_wait`, the
+    batch is dispatched right away instead of idling.
+
+    `queue` is the backend requests wait in (see utils.queue_backend), by default the one picked by
+    INFERSAFE_QUEUE_BACKEND. With a shared backend every process's loop pulls from the same queue,
+    so work goes to whichever process has a free batch slot first.
+    """
+
+    def __init__(self, max_batch_wait_ms: float = config.BATCH_MAX_WAIT_MS, max_queue_size: int = 100,
+                 batch_size_limit: int = BATCH_SIZE_LIMIT, batch_token_budget: int = config.BATCH_TOKEN_BUDGET,
+                 admission: Optional[TokenAdmission] = None, queue=None):
+        self.queue = queue if queue is not None else make_queue(max_queue_size)
+        self.max_batch_wait = max_batch_wait_ms / 1000
         self.max_queue_size = max_queue_size
+        self.batch_size_limit = batch_size_limit
+        self.batch_token_budget = batch_token_budget
+        self.admission = admission or TokenAdmission()
+        self._held: Optional[BatchedRequest] = None  # didn't fit the last batch, opens the next one
+        self._arrival_gap = self.max_batch_wait  # EWMA of seconds between enqueues
+        self._last_arrival: Optional[float] = None
+        self._batch_seconds = 1.0  # EWMA of batch duration, used for Retry-After
+        self._running_batches = 0
+        self._capacity_changed = asyncio.Condition()
+        self._max_concurrent_batches: Callable[[], int] = lambda: 1
+        # Identical (prompt, max_tokens, model) requests share one generation while it is pending
+        self.pending: Dict[Tuple[str, int, Optional[str]], BatchedRequest] = {}
+        self.response_cache: Optional[ResponseCache] = None
+        if config.RESPONSE_CACHE_SIZE > 0:
+            if config.TEMPERATURE == 0:
+                self.response_cache = ResponseCache(config.RESPONSE_CACHE_SIZE, config.RESPONSE_CACHE_TTL)
+            else:
+                logging.warning("[QUEUE] Response cache needs greedy decoding (INFERSAFE_TEMPERATURE=0), leaving it off")
 
-    def enqueue(self, prompt: str, max_tokens: int) -> asyncio.Future:
-        if len(self.queue) >= self.max_queue_size:
-            # Return error future if queue is full
-            loop = asyncio.get_event_loop()
-            future = loop.create_future()
-            future.set_exception(Exception("Request queue is full, try again later"))
-            return future
+    def depth(self) -> int:
+        # Queued requests; with a shared backend that's every process's queue
+        return self.queue.depth() + (self._held is not None)
 
+    def share(self) -> int:
+        # Queued requests this process can expect to serve, what its autoscaler should scale on
+        return math.ceil(self.depth() / max(1, self.queue.consumers()))
+
+    def queued_for(self, model: str) -> bool:
+        # Waiting or running here for that model; pending holds each generation until it finishes
+        return any(key[2] == model for key in self.pending)
+
+    def enqueue(self, prompt: str, max_tokens: int, channel: Optional[TokenChannel] = None,
+                model: Optional[str] = None) -> asyncio.Future:
+        # Raises RequestTooLargeError; may shorten max_tokens or the prompt under the truncate policy
+        prompt, max_tokens, prompt_tokens = self.admission.admit(prompt, max_tokens)
         loop = asyncio.get_event_loop()
+        # Each caller gets its own future, so one caller timing out never cancels the shared generation
         future = loop.create_future()
-        logging.info(f"[QUEUE] Enqueuing prompt: {prompt[:30]}, queue size: {len(self.queue)}")
-        self.queue.append(BatchedRequest(prompt, max_tokens, future))
+        key = (prompt, max_tokens, model)
+
+        if self.response_cache is not None:
+            cached = self.response_cache.get(key)
+            if cached is not None:
+                RESPONSE_CACHE_HITS.inc()
+                future.set_result(cached)
+                return future
+            RESPONSE_CACHE_MISSES.inc()
+
+        leader = self.pending.get(key)
+        if leader is not None and not leader.cancel_event.is_set():  # an abandoned leader is winding down
+            COALESCED_REQUESTS.inc()
+            if channel is not None:
+                leader.subscribe(channel)
+            leader.add_caller(future)
+            leader.future.add_done_callback(lambda done: _propagate(done, future))
+            return future
+
+        req = BatchedRequest(prompt, max_tokens, loop.create_future(), channel, prompt_tokens, model)
+        try:
+            self.queue.put_nowait(req)
+        except asyncio.QueueFull:
+            raise QueueFullError(self._retry_after())
+
+        logger.log(REQUEST, "[QUEUE] Enqueuing prompt: %.30s, queue size: %d", prompt, self.queue.qsize())
+        self._record_arrival(req.enqueued_at)
+        self.pending[key] = req
+        req.add_caller(future)
+        req.future.add_done_callback(lambda done: self._finish(key, req, future))
         return future
 
-    async def start_loop(self, process_batch: Callable[[List[BatchedRequest]], None]):
+    def _finish(self, key: Tuple[str, int, Optional[str]], req: BatchedRequest, future: asyncio.Future):
+        if self.pending.get(key) is req:
+            del self.pending[key]
+        if self.response_cache is not None and not req.future.cancelled() and req.future.exception() is None:
+            self.response_cache.put(key, req.future.result())
+        _propagate(req.future, future)
+
+    def _record_arrival(self, now: float):
+        if self._last_arrival is not None:
+            gap = now - self._last_arrival
+            self._arrival_gap += ARRIVAL_EWMA_ALPHA * (gap - self._arrival_gap)
+        self._last_arrival = now
+
+    def _batch_window(self, batch_len: int) -> float:
+        # Wait only as long as it should take for the rest of the batch to arrive
+        if self._arrival_gap >= self.max_batch_wait:
+            return 0.0
+        return min(self.max_batch_wait, self._arrival_gap * (self.batch_size_limit - batch_len))
+
+    def _retry_after(self) -> int:
+        batches_ahead = self.queue.depth() / self.batch_size_limit
+        concurrency = max(1, self._max_concurrent_batches()) * max(1, self.queue.consumers())
+        return max(1, math.ceil(batches_ahead / concurrency * self._batch_seconds))
+
+    async def _collect_batch(self) -> List[BatchedRequest]:
+        loop = asyncio.get_event_loop()
+        if self._held is not None:
+            batch, self._held = [self._held], None
+        else:
+            batch = [await self.queue.get()]
+        tokens = batch[0].tokens  # a single request over the budget still goes, alone
+        deadline = loop.time() + self._batch_window(1)
+        while len(batch) < self.batch_size_limit:
+            try:
+                req = self.queue.get_nowait()
+            except asyncio.QueueEmpty:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                getter = asyncio.ensure_future(self.queue.get())
+                done, _ = await asyncio.wait({getter}, timeout=remaining)
+                if getter not in done:
+                    getter.cancel()  # a cancelled get leaves the item in the queue
+                    break
+                req = getter.result()
+            if tokens + req.tokens > self.batch_token_budget:
+                self._held = req
+                break
+            batch.append(req)
+            tokens += req.tokens
+        return batch
+
+    async def _run_batch(self, process_batch: Callable[[List[BatchedRequest]], None], batch: List[BatchedRequest]):
+        started = time.monotonic()
+        BATCH_SIZE.observe(len(batch))
+        for req in batch:
+            req.trace.dispatched(started)
+        try:
+            await process_batch(batch)
+        finally:
+            self._batch_seconds += ARRIVAL_EWMA_ALPHA * (time.monotonic() - started - self._batch_seconds)
+            async with self._capacity_changed:
+                self._running_batches -= 1
+                self._capacity_changed.notify()
+
+    async def start_loop(self, process_batch: Callable[[List[BatchedRequest]], None],
+                         max_concurrent_batches: Optional[Callable[[], int]] = None):
+        # max_concurrent_batches is re-read before every dispatch so it can follow autoscaling
+        if max_concurrent_batches is not None:
+            self._max_concurrent_batches = max_concurrent_batches
         while True:
             try:
-                await asyncio.sleep(self.batch_interval)
-                if self.queue:
-                    # Process in chunks of BATCH_SIZE_LIMIT
-                    remaining = len(self.queue)
-                    start_idx = 0
-                    while remaining > 0:
-                        batch_size = min(BATCH_SIZE_LIMIT, remaining)
-                        batch = self.queue[start_idx:start_idx + batch_size]
-                        asyncio.create_task(process_batch(batch))
-                        start_idx += batch_size
-                        remaining -= batch_size
-                    self.queue = self.queue[start_idx:]
+                # Only take work off the queue once there's room to run it, so with a shared queue a
+                # busy process leaves it to an idle one
+                async with self._capacity_changed:
+                    await self._capacity_changed.wait_for(
+                        lambda: self._running_batches < max(1, self._max_concurrent_batches())
+                    )
+                    self._running_batches += 1
+                try:
+                    batch = await self._collect_batch()
+                except BaseException:
+                    self._running_batches -= 1
+                    raise
+                asyncio.create_task(self._run_batch(process_batch, batch))
             except Exception as e:
                 logging.error(f"Error in batch processing loop: {e}")
                 await asyncio.sleep(1)  # Back off on error
+
+    def close(self):
+        self.queue.close()
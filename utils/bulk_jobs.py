@@ -0,0 +1,325 @@
+"""Bulk JSONL inference jobs, run behind interactive traffic.
+
+Each input line is {"prompt": ..., "max_tokens": ..., "model": ..., "id": ...} (only "prompt" is
+required). The output has one line per input line, in input order: {"line": n, "id": ...,
+"output": ...} or {"line": n, "id": ..., "error": ...}. The output file doubles as the checkpoint,
+so running a job again with the same output resumes after the last line written.
+
+    python -m utils.bulk_jobs prompts.jsonl results.jsonl --workers 2
+
+A line's "model" picks a model by registry name, like the `model` field of a request: --model
+serves INFERSAFE_DEFAULT_MODEL, the others come from INFERSAFE_MODELS. A line naming an unknown
+model gets an error record.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, Iterator, Optional, Tuple
+from prometheus_client import Counter, Gauge
+from utils import config
+from utils.admission import RequestTooLargeError
+
+DEFAULT_MAX_TOKENS = 128
+LINE_RETRIES = 2
+YIELD_POLL_SECONDS = 0.05  # how often a paused job checks whether interactive traffic has cleared
+READ_AHEAD = 4  # finished lines held for in-order writing, per line in flight
+
+BULK_LINES = Counter("bulk_job_lines_total", "Bulk job lines written, by outcome", ["outcome"])
+BULK_PROGRESS = Gauge("bulk_job_progress_ratio", "Share of a bulk job's lines written", ["job"])
+BULK_THROUGHPUT = Gauge("bulk_job_lines_per_second", "Lines a bulk job has written per second since it (re)started", ["job"])
+BULK_YIELD_SECONDS = Counter("bulk_job_yield_seconds_total", "Time bulk jobs held back new lines for interactive requests")
+
+class LineRejected(Exception):
+    """A line that fails the same way on every attempt (unknown model, too long), so it isn't retried."""
+
+
+# (prompt, max_tokens, model) -> generated text
+Generate = Callable[[str, int, Optional[str]], Awaitable[str]]
+
+
+def _input_lines(path: str) -> Iterator[Tuple[int, str]]:
+    # (1-based line number, text) of every non-blank line
+    with open(path) as f:
+        for line_no, line in enumerate(f, 1):
+            if line.strip():
+                yield line_no, line
+
+
+def _checkpoint(path: str) -> int:
+    """Complete lines already in `path`; a line cut short by a crash is dropped."""
+    if not os.path.exists(path):
+        return 0
+    with open(path, "rb+") as f:
+        data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            f.truncate(end)
+    return data.count(b"\n", 0, end)
+
+
+class BulkJob:
+    """One JSONL file through the model, with its state saved next to the output."""
+
+    def __init__(self, job_id: str, input_path: str, output_path: str, state_path: Optional[str] = None):
+        self.id = job_id
+        self.input_path = input_path
+        self.output_path = output_path
+        self.state_path = state_path
+        self.status = "queued"  # queued, running, done, failed or cancelled
+        self.total: Optional[int] = None
+        self.done = 0
+        self.errors = 0
+        self.error: Optional[str] = None
+        self.lines_per_second = 0.0
+        self.cancel_requested = False
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id, "status": self.status, "input": self.input_path, "output": self.output_path,
+            "total": self.total, "done": self.done, "errors": self.errors, "error": self.error,
+            "lines_per_second": round(self.lines_per_second, 3),
+        }
+
+    def save(self):
+        if self.state_path is None:
+            return
+        tmp = f"{self.state_path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.to_dict(), f)
+        os.replace(tmp, self.state_path)
+
+    @classmethod
+    def load(cls, state_path: str) -> "BulkJob":
+        with open(state_path) as f:
+            state = json.load(f)
+        job = cls(state["id"], state["input"], state["output"], state_path)
+        job.status, job.total, job.done, job.errors, job.error = (
+            state["status"], state["total"], state["done"], state["errors"], state["error"]
+        )
+        return job
+
+    async def _line(self, generate: Generate, line_no: int, text: str) -> dict:
+        try:
+            item = json.loads(text)
+            prompt = item["prompt"]
+            max_tokens = int(item.get("max_tokens", DEFAULT_MAX_TOKENS))
+        except (ValueError, KeyError, TypeError) as e:
+            return {"line": line_no, "error": f"Invalid line: {e!r}"}
+        record = {"line": line_no}
+        if "id" in item:
+            record["id"] = item["id"]
+        for attempt in range(LINE_RETRIES + 1):
+            try:
+                record["output"] = await generate(prompt, max_tokens, item.get("model"))
+                return record
+            except (RequestTooLargeError, LineRejected) as e:
+                record["error"] = str(e)  # the same on every attempt
+                return record
+            except Exception as e:
+                logging.warning(f"[BULK] Job {self.id} line {line_no} attempt {attempt + 1} failed: {e}")
+                record["error"] = str(e) or type(e).__name__
+        return record
+
+    async def run(self, generate: Generate, concurrency: Callable[[], int] = lambda: 1,
+                  paused: Callable[[], bool] = lambda: False):
+        """Generate every line not yet in the output, writing results in input order.
+
+        Up to `concurrency()` lines run at once, sized for throughput rather than latency: there is
+        no per-request streaming or batch window, just as many lines as the workers are given. No
+        new line starts while `paused()` is true, e.g. while interactive requests are queued.
+        Cancelling leaves the output as a checkpoint to resume from.
+        """
+        self.status = "running"
+        self.total = sum(1 for _ in _input_lines(self.input_path))
+        self.done = resumed_from = _checkpoint(self.output_path)
+        self.save()
+        started = time.monotonic()
+        finished: Dict[int, dict] = {}  # index -> record, waiting for the lines before it
+        in_flight: set = set()
+
+        async def run_line(index: int, line_no: int, text: str):
+            finished[index] = await self._line(generate, line_no, text)
+
+        def write_ready(out):
+            while self.done in finished:
+                record = finished.pop(self.done)
+                out.write(json.dumps(record) + "\n")
+                self.done += 1
+                if "error" in record:
+                    self.errors += 1
+                BULK_LINES.labels(outcome="error" if "error" in record else "ok").inc()
+            out.flush()
+            self.lines_per_second = (self.done - resumed_from) / max(1e-9, time.monotonic() - started)
+            BULK_PROGRESS.labels(job=self.id).set(self.done / self.total if self.total else 1.0)
+            BULK_THROUGHPUT.labels(job=self.id).set(self.lines_per_second)
+
+        try:
+            with open(self.output_path, "a") as out:
+                for index, (line_no, text) in enumerate(_input_lines(self.input_path)):
+                    if index < resumed_from:
+                        continue
+                    while True:
+                        limit = max(1, concurrency())
+                        held = paused()
+                        if len(in_flight) < limit and index - self.done < limit * READ_AHEAD and not held:
+                            break
+                        waited_from = time.monotonic()
+                        if in_flight:
+                            await asyncio.wait(in_flight, timeout=YIELD_POLL_SECONDS, return_when=asyncio.FIRST_COMPLETED)
+                        else:
+                            await asyncio.sleep(YIELD_POLL_SECONDS)
+                        if held:
+                            BULK_YIELD_SECONDS.inc(time.monotonic() - waited_from)
+                        write_ready(out)
+                    task = asyncio.ensure_future(run_line(index, line_no, text))
+                    in_flight.add(task)
+                    task.add_done_callback(in_flight.discard)
+                    await asyncio.sleep(0)  # let it claim its worker before `paused` is asked again
+                while in_flight:
+                    await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                    write_ready(out)
+                write_ready(out)
+            self.status = "done"
+        except asyncio.CancelledError:
+            # A shutdown leaves the job "running" so the next start resumes it
+            if self.cancel_requested:
+                self.status = "cancelled"
+            raise
+        except Exception as e:
+            logging.exception(f"[BULK] Job {self.id} failed: {e}")
+            self.status, self.error = "failed", str(e)
+        finally:
+            for task in in_flight:
+                task.cancel()
+            self.save()
+
+
+class BulkJobManager:
+    """Bulk jobs submitted to the service, run one after another.
+
+    Inputs, outputs and job state live in `directory`, so jobs interrupted by a restart are picked
+    up again by `resume`.
+    """
+
+    def __init__(self, generate: Generate, directory: str = config.BULK_JOB_DIR,
+                 concurrency: Callable[[], int] = lambda: 1, paused: Callable[[], bool] = lambda: False):
+        self.generate = generate
+        self.directory = directory
+        self.concurrency = concurrency
+        self.paused = paused
+        self.jobs: Dict[str, BulkJob] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._turn = asyncio.Lock()
+
+    def _path(self, job_id: str, suffix: str) -> str:
+        return os.path.join(self.directory, f"{job_id}.{suffix}")
+
+    def submit(self, data: bytes) -> BulkJob:
+        """Queue a job for uploaded JSONL `data`."""
+        os.makedirs(self.directory, exist_ok=True)
+        job_id = uuid.uuid4().hex[:12]
+        with open(self._path(job_id, "input.jsonl"), "wb") as f:
+            f.write(data)
+        job = BulkJob(job_id, self._path(job_id, "input.jsonl"), self._path(job_id, "output.jsonl"), self._path(job_id, "json"))
+        job.save()
+        self._start(job)
+        return job
+
+    def resume(self) -> int:
+        """Restart jobs that were queued or running when the service stopped."""
+        if not os.path.isdir(self.directory):
+            return 0
+        resumed = 0
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(".json"):
+                continue
+            job = BulkJob.load(os.path.join(self.directory, name))
+            if job.status in ("queued", "running") and job.id not in self._tasks:
+                logging.info(f"[BULK] Resuming job {job.id} after line {job.done}")
+                self._start(job)
+                resumed += 1
+        return resumed
+
+    def _start(self, job: BulkJob):
+        self.jobs[job.id] = job
+        task = asyncio.ensure_future(self._run(job))
+        self._tasks[job.id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job.id, None))
+
+    async def _run(self, job: BulkJob):
+        try:
+            async with self._turn:
+                await job.run(self.generate, self.concurrency, self.paused)
+        except asyncio.CancelledError:
+            if job.cancel_requested and job.status == "queued":
+                job.status = "cancelled"  # never got its turn
+                job.save()
+            raise
+
+    def get(self, job_id: str) -> Optional[BulkJob]:
+        return self.jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> bool:
+        task = self._tasks.get(job_id)
+        if task is None:
+            return False
+        self.jobs[job_id].cancel_requested = True
+        task.cancel()
+        return True
+
+    async def close(self):
+        # Interrupted, not cancelled: their state still says queued/running
+        for task in list(self._tasks.values()):
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+
+async def _cli(args):
+    # Offline: a worker pool of its own, no server needed
+    from models.inference_engine import PromptTokenizer
+    from utils.admission import TokenAdmission
+    from utils.model_registry import ModelRegistry, UnknownModelError
+    from utils.multi_model_manager import MultiModelManager
+
+    manager = MultiModelManager(args.workers, model_path=args.model, lazy=True)
+    registry = ModelRegistry(config.MODELS, config.DEFAULT_MODEL, manager)
+    tokenizer = PromptTokenizer(args.model)
+    await manager.start()
+    tokenizer.load()
+    admission = TokenAdmission(tokenizer)
+
+    async def generate(prompt, max_tokens, model=None):
+        # Counted with the default model's tokenizer, as the server does at enqueue
+        prompt, max_tokens, prompt_tokens = admission.admit(prompt, max_tokens)
+        try:
+            async with registry.hold(model) as pool:  # other models load on first use
+                worker = pool.select_worker(prompt, max_tokens, pool.routing_policy(), prompt_tokens)
+                with worker.reserve(prompt, max_tokens, prompt_tokens):
+                    return await asyncio.wait_for(
+                        worker.generate(prompt, max_tokens, prompt_tokens=prompt_tokens, reserved=True),
+                        config.BULK_LINE_TIMEOUT
+                    )
+        except UnknownModelError as e:
+            raise LineRejected(str(e))
+
+    job = BulkJob("cli", args.input, args.output)
+    try:
+        await job.run(generate, lambda: args.concurrency or len(manager.models))
+    finally:
+        await registry.close()
+        await manager.close()
+    print(json.dumps(job.to_dict()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a JSONL file of prompts through the model, resuming from OUTPUT")
+    parser.add_argument("input", help="JSONL with a prompt per line")
+    parser.add_argument("output", help="JSONL results, in input order; an existing file is resumed")
+    parser.add_argument("--model", default=config.MODEL_PATH, help="GGUF of the default model")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--concurrency", type=int, default=config.BULK_CONCURRENCY, help="lines at once, 0: one per worker")
+    asyncio.run(_cli(parser.parse_args()))
@@ -0,0 +1,59 @@
+import asyncio
+import threading
+from typing import Callable, Optional
+from prometheus_client import Counter
+
+WASTED_TOKENS_AVOIDED = Counter(
+    "inference_wasted_tokens_avoided_total",
+    "Tokens of max_tokens not decoded because the request was abandoned or timed out"
+)
+
+
+class CancelToken(threading.Event):
+    """A threading.Event that also runs callbacks, on the setting thread, when it is set.
+
+    Decoding threads poll it; backends that cannot poll (a model subprocess) register a callback.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._callbacks: list = []
+
+    def set(self):
+        if self.is_set():
+            return
+        super().set()
+        for callback in list(self._callbacks):
+            callback()
+
+    def add_callback(self, callback: Callable[[], None]):
+        if self.is_set():
+            callback()
+        else:
+            self._callbacks.append(callback)
+
+    def remove_callback(self, callback: Callable[[], None]):
+        if callback in self._callbacks:
+            self._callbacks.remove(callback)
+
+
+def stop_checker(*events: Optional[threading.Event]) -> Callable[[], bool]:
+    # Decoders poll this once per token; any set event stops generation
+    events = [event for event in events if event is not None]
+    return lambda: any(event.is_set() for event in events)
+
+
+async def await_stoppable(job: asyncio.Future, stop: threading.Event):
+    """Await work running off the event loop; if the caller is cancelled, flag `stop` and wait for it.
+
+    The caller stays cancelled, but only returns once the decoder has actually stopped, so
+    worker slots and in-flight counts are released when the capacity is really free.
+    """
+    try:
+        return await asyncio.shield(job)
+    except asyncio.CancelledError:
+        stop.set()
+        await asyncio.wait({job})
+        if not job.cancelled():
+            job.exception()  # outcome is discarded, mark it retrieved
+        raise
@@ -0,0 +1,147 @@
+import json
+import os
+
+# Service settings, read once at import. Every value can be overridden with an INFERSAFE_* env var,
+# which wins over the tuned config file written by benchmarks/autotune.py, which wins over the defaults.
+
+TUNED_CONFIG_PATH = os.getenv(
+    "INFERSAFE_TUNED_CONFIG", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "infersafe-tuned.json")
+)
+
+
+def _load_tuned(path: str) -> dict:
+    # {"settings": {"INFERSAFE_N_THREADS": 6, ...}, ...}; a missing file just means nothing was tuned
+    try:
+        with open(path) as f:
+            return json.load(f)["settings"]
+    except FileNotFoundError:
+        return {}
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError(f"Tuned config {path} is not valid: {e!r}")
+
+
+TUNED = _load_tuned(TUNED_CONFIG_PATH)
+
+
+def _setting(name: str, default, cast=str):
+    value = os.getenv(name)
+    if value is None or value == "":
+        value = TUNED.get(name)
+    if value is None or value == "":
+        return default
+    return cast(str(value))
+
+
+def _flag(value: str) -> bool:
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def _model_paths(value: str) -> dict:
+    # "name=path,name=path"
+    pairs = (item.split("=", 1) for item in value.split(",") if item.strip())
+    return {name.strip(): path.strip() for name, path in pairs}
+
+
+# Served models: the default one at MODEL_PATH, plus "name=path" pairs in INFERSAFE_MODELS picked per
+# request with the `model` field. Extra models load on first use and are evicted least recently used
+# when the resident bytes of all models (weights + contexts) would exceed MODEL_MEMORY_BUDGET_BYTES (0: no limit)
+MODEL_PATH = _setting(
+    "INFERSAFE_MODEL_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "models", "tinyllama-1.1b-chat-v1.0.Q4_K_M.gguf")
+)
+DEFAULT_MODEL = _setting("INFERSAFE_DEFAULT_MODEL", "tinyllama")
+MODELS = _setting("INFERSAFE_MODELS", {}, _model_paths)
+MODEL_MEMORY_BUDGET_BYTES = _setting("INFERSAFE_MODEL_MEMORY_BUDGET_BYTES", 0, int)
+
+# Worker pool of the default model, and requests one single-sequence worker takes at once
+NUM_WORKERS = _setting("INFERSAFE_NUM_WORKERS", 3, int)
+WORKER_CONCURRENCY = _setting("INFERSAFE_WORKER_CONCURRENCY", 4, int)
+
+
+# Load GGUF weights once per process (mmap-backed) and give each worker only its own context/KV cache
+SHARED_WEIGHTS = _setting("INFERSAFE_SHARED_WEIGHTS", False, _flag)
+
+# "thread": workers share this process and the default executor. "process": one pinned subprocess per worker
+WORKER_BACKEND = _setting("INFERSAFE_WORKER_BACKEND", "thread", str.lower)
+
+# Per-worker byte budget for saved llama.cpp prefix states (0 disables the prefix cache)
+PREFIX_CACHE_BYTES = _setting("INFERSAFE_PREFIX_CACHE_BYTES", 0, int)
+# Route to a worker holding a prompt prefix of at least this many characters if it is not much busier
+PREFIX_ROUTING_MIN_CHARS = _setting("INFERSAFE_PREFIX_ROUTING_MIN_CHARS", 64, int)
+
+# Sampling temperature for every generation; 0 means greedy (deterministic) decoding
+TEMPERATURE = _setting("INFERSAFE_TEMPERATURE", 0.2, float)
+# Finished generations kept for identical requests (0 disables); only used with greedy decoding
+RESPONSE_CACHE_SIZE = _setting("INFERSAFE_RESPONSE_CACHE_SIZE", 0, int)
+RESPONSE_CACHE_TTL = _setting("INFERSAFE_RESPONSE_CACHE_TTL", 300.0, float)  # seconds
+
+# Most requests dispatched together, and the longest a partial batch waits for company
+BATCH_SIZE_LIMIT = _setting("INFERSAFE_BATCH_SIZE_LIMIT", 10, int)
+BATCH_MAX_WAIT_MS = _setting("INFERSAFE_BATCH_MAX_WAIT_MS", 20.0, float)
+
+# Where queued requests wait: "memory" is per process, "sqlite" is a queue file every process on the
+# host (uvicorn --workers, or pods sharing a volume) pulls from, with replies routed back to the enqueuer
+QUEUE_BACKEND = _setting("INFERSAFE_QUEUE_BACKEND", "memory", str.lower)
+QUEUE_PATH = _setting("INFERSAFE_QUEUE_PATH", "infersafe-queue.db")
+QUEUE_POLL_MS = _setting("INFERSAFE_QUEUE_POLL_MS", 5.0, float)  # how often an idle process checks for work and replies
+
+# Bulk JSONL jobs run behind interactive traffic: at most BULK_CONCURRENCY lines at once (0: one per
+# worker), each on an idle worker, none while interactive requests are queued, and never on the last
+# BULK_IDLE_RESERVE idle workers
+BULK_JOB_DIR = _setting("INFERSAFE_BULK_JOB_DIR", "bulk_jobs")
+BULK_CONCURRENCY = _setting("INFERSAFE_BULK_CONCURRENCY", 0, int)
+BULK_IDLE_RESERVE = _setting("INFERSAFE_BULK_IDLE_RESERVE", 1, int)
+BULK_LINE_TIMEOUT = _setting("INFERSAFE_BULK_LINE_TIMEOUT", 300.0, float)  # seconds per line, no streaming deadline
+
+# Decode a worker's concurrent requests together in one llama.cpp context (thread backend only)
+CONTINUOUS_BATCHING = _setting("INFERSAFE_CONTINUOUS_BATCHING", False, _flag)
+BATCH_SLOTS = _setting("INFERSAFE_BATCH_SLOTS", 4, int)  # KV slots (concurrent sequences) per worker
+
+# Context window per sequence, in tokens; a request's prompt plus max_tokens must fit in it
+N_CTX = _setting("INFERSAFE_N_CTX", 2048, int)
+N_THREADS = _setting("INFERSAFE_N_THREADS", 4, int)  # llama.cpp threads per thread-backend worker
+N_BATCH = _setting("INFERSAFE_N_BATCH", 512, int)  # prompt tokens llama.cpp evaluates per step
+# Weights are memory-mapped; mlock also pins them in RAM so they are never paged out (needs RLIMIT_MEMLOCK)
+USE_MMAP = _setting("INFERSAFE_USE_MMAP", True, _flag)
+USE_MLOCK = _setting("INFERSAFE_USE_MLOCK", False, _flag)
+# Requests that don't fit N_CTX: "truncate" (cut max_tokens, then the start of the prompt) or "reject" (413)
+OVERSIZE_POLICY = _setting("INFERSAFE_OVERSIZE_POLICY", "truncate", str.lower)
+TOKEN_COUNT_CACHE_SIZE = _setting("INFERSAFE_TOKEN_COUNT_CACHE_SIZE", 4096, int)  # distinct prompts remembered
+# Prompt plus max_tokens of all requests in one batch; defaults to what one worker can hold at once
+BATCH_TOKEN_BUDGET = _setting("INFERSAFE_BATCH_TOKEN_BUDGET", N_CTX * (BATCH_SLOTS if CONTINUOUS_BATCHING else 1), int)
+
+# Speculative decoding on single-sequence workers: "off", "prompt_lookup" (drafts from n-grams already in
+# the context, no extra model) or "draft_model" (a small GGUF with the same vocabulary)
+SPECULATIVE = _setting("INFERSAFE_SPECULATIVE", "off", str.lower)
+SPECULATIVE_DRAFT_MODEL = _setting("INFERSAFE_SPECULATIVE_DRAFT_MODEL", "")
+SPECULATIVE_DRAFT_TOKENS = _setting("INFERSAFE_SPECULATIVE_DRAFT_TOKENS", 10, int)  # proposed per step
+SPECULATIVE_NGRAM_SIZE = _setting("INFERSAFE_SPECULATIVE_NGRAM_SIZE", 2, int)  # longest n-gram prompt lookup matches
+
+# Worker selection: "token_cost" (expected completion time, power of two choices), "least_busy"
+# (fewest requests in flight) or "ab" (random split between the two, latency labelled by policy)
+LOAD_BALANCER = _setting("INFERSAFE_LOAD_BALANCER", "token_cost", str.lower)
+LOAD_BALANCER_AB_SPLIT = _setting("INFERSAFE_LOAD_BALANCER_AB_SPLIT", 0.5, float)  # share of "ab" traffic on token_cost
+
+# Autoscaling: loaded workers kept out of rotation so scale-up is instant, and the worker count bounds
+WARM_SPARES = _setting("INFERSAFE_WARM_SPARES", 0, int)
+MIN_WORKERS = _setting("INFERSAFE_MIN_WORKERS", 1, int)
+MAX_WORKERS = _setting("INFERSAFE_MAX_WORKERS", 8, int)
+# Scaling targets: p95 end-to-end latency and queue wait, and queued requests per worker
+SLO_LATENCY_SECONDS = _setting("INFERSAFE_SLO_LATENCY_SECONDS", 5.0, float)
+SLO_QUEUE_WAIT_SECONDS = _setting("INFERSAFE_SLO_QUEUE_WAIT_SECONDS", 1.0, float)
+SCALE_QUEUE_PER_WORKER = _setting("INFERSAFE_SCALE_QUEUE_PER_WORKER", 8.0, float)
+# Signals are smoothed over this many seconds, and scale-down waits for a whole window below target
+SCALE_WINDOW_SECONDS = _setting("INFERSAFE_SCALE_WINDOW_SECONDS", 30.0, float)
+
+# Share of requests whose per-stage timings are appended to TRACE_FILE as JSON lines (0 disables)
+TRACE_SAMPLE_RATE = _setting("INFERSAFE_TRACE_SAMPLE_RATE", 0.0, float)
+TRACE_FILE = _setting("INFERSAFE_TRACE_FILE", "traces.jsonl")
+
+# Logging: records are written by a background thread to a size-rotated file. Per-request lines
+# use the REQUEST level (between DEBUG and INFO) and are capped at LOG_REQUEST_RATE per message per second
+LOG_FILE = _setting("INFERSAFE_LOG_FILE", "inference.log")
+LOG_LEVEL = _setting("INFERSAFE_LOG_LEVEL", "REQUEST", str.upper)
+LOG_MAX_BYTES = _setting("INFERSAFE_LOG_MAX_BYTES", 10 * 1024 * 1024, int)
+LOG_BACKUPS = _setting("INFERSAFE_LOG_BACKUPS", 3, int)
+LOG_QUEUE_SIZE = _setting("INFERSAFE_LOG_QUEUE_SIZE", 10000, int)
+LOG_REQUEST_RATE = _setting("INFERSAFE_LOG_REQUEST_RATE", 20.0, float)
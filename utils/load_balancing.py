@@ -0,0 +1,84 @@
+import random
+from typing import Optional, Sequence
+from prometheus_client import Counter, Histogram
+
+CHARS_PER_TOKEN = 4  # rough English average, close enough for routing without running the tokenizer
+PREFILL_COST = 0.1  # a prompt token is evaluated in a batch, roughly 10x cheaper than a generated one
+DEFAULT_TOKENS_PER_SEC = 20.0  # assumed throughput of a worker that has not finished anything yet
+RATE_EWMA_ALPHA = 0.3  # weight of the newest throughput sample
+
+ROUTED_REQUESTS = Counter("load_balancer_routed_total", "Requests routed, by balancing policy", ["policy"])
+ROUTED_LATENCY = Histogram(
+    "load_balancer_request_duration_seconds",
+    "Worker latency of successful requests, by the policy that routed them (compare p99 per policy)",
+    ["policy"],
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 7.5, 10.0, 15.0, 20.0, 30.0, 60.0),
+)
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+
+def request_cost(prompt: str, max_tokens: int, prompt_tokens: Optional[int] = None) -> float:
+    """Work a request puts on a worker, in generated-token equivalents."""
+    if prompt_tokens is None:
+        prompt_tokens = estimate_tokens(prompt)
+    return prompt_tokens * PREFILL_COST + max_tokens
+
+
+class LeastInFlightPolicy:
+    """The original policy: fewest requests in flight, whatever their size."""
+
+    name = "least_busy"
+
+    def choose(self, workers: Sequence, cost: float):
+        return min(workers, key=lambda worker: worker.in_flight_requests)
+
+
+class ExpectedCompletionPolicy:
+    """Power-of-two-choices on expected completion time.
+
+    Samples `choices` workers and picks the one that would finish this request soonest given
+    the token work already queued on it and its measured throughput. Sampling instead of a full
+    scan keeps a burst of requests from all landing on the one worker that just looked best.
+    """
+
+    name = "token_cost"
+
+    def __init__(self, choices: int = 2, rng: Optional[random.Random] = None):
+        self.choices = choices
+        self.rng = rng or random.Random()
+
+    def choose(self, workers: Sequence, cost: float):
+        candidates = workers if len(workers) <= self.choices else self.rng.sample(list(workers), self.choices)
+        return min(candidates, key=lambda worker: worker.expected_completion(cost))
+
+
+class ABPolicy:
+    """Routes a random `split` fraction of requests with `a` and the rest with `b`."""
+
+    name = "ab"
+
+    def __init__(self, a, b, split: float = 0.5, rng: Optional[random.Random] = None):
+        self.a = a
+        self.b = b
+        self.split = split
+        self.rng = rng or random.Random()
+
+    def arm(self):
+        return self.a if self.rng.random() < self.split else self.b
+
+
+POLICIES = {
+    LeastInFlightPolicy.name: LeastInFlightPolicy,
+    ExpectedCompletionPolicy.name: ExpectedCompletionPolicy,
+}
+
+
+def make_policy(name: str, ab_split: float = 0.5):
+    if name == ABPolicy.name:
+        return ABPolicy(ExpectedCompletionPolicy(), LeastInFlightPolicy(), split=ab_split)
+    if name not in POLICIES:
+        raise ValueError(f"Unknown load balancing policy {name!r}, expected one of {sorted(POLICIES) + [ABPolicy.name]}")
+    return POLICIES[name]()
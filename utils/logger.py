@@ -1,17 +1,97 @@
+import atexit
 import logging
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from prometheus_client import Counter
+from utils import config
+
+# Per-request messages go out at this level, between DEBUG and INFO, and are rate limited
+REQUEST = 15
+logging.addLevelName(REQUEST, "REQUEST")
+
+LOG_RECORDS_DROPPED = Counter("log_records_dropped_total", "Log records dropped by rate limiting or a full log queue", ["reason"])
+
+
+class RequestRateLimit(logging.Filter):
+    """Token bucket per message template for REQUEST-level records; other levels always pass.
+
+    Keyed by the unformatted message, so "[QUEUE] Enqueuing prompt: %s" is one stream whatever
+    the prompt, and a burst of traffic logs at most `rate` lines a second for it.
+    """
+
+    def __init__(self, rate: float, burst: float = None):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self.buckets = {}  # template -> (tokens, last refill)
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno != REQUEST:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self.buckets.get(record.msg, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            allowed = tokens >= 1
+            self.buckets[record.msg] = (tokens - 1 if allowed else tokens, now)
+        if not allowed:
+            LOG_RECORDS_DROPPED.labels(reason="rate_limited").inc()
+        return allowed
+
+
+class DeferredQueueHandler(QueueHandler):
+    """QueueHandler that leaves formatting to the listener thread.
+
+    The stock `prepare` renders the message on the calling thread, which is the event loop here.
+    Records are passed as-is instead, so call sites must only pass immutable args (str, numbers).
+    A full queue drops the record rather than blocking the loop.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.labels(reason="queue_full").inc()
+
+
+def _stop(listener: QueueListener):
+    # QueueListener.stop raises if called twice, e.g. after a test already stopped it
+    if listener._thread is not None:
+        listener.stop()
+
+
+def configure(name: str = "inference_logger", path: str = None) -> logging.Logger:
+    """Logger whose records are written to a size-rotated file by a background thread."""
+    log = logging.getLogger(name)
+    log.setLevel(config.LOG_LEVEL)
+    log.propagate = False
+
+    #formatter for readibility
+    formatter = logging.Formatter(
+        "%(asctime)s - %(levelname)s - %(message)s", "%Y-%m-%d %H:%M:%S"
+    )
+    file_handler = RotatingFileHandler(
+        path or config.LOG_FILE, maxBytes=config.LOG_MAX_BYTES, backupCount=config.LOG_BACKUPS, delay=True
+    )
+    file_handler.setFormatter(formatter)
+
+    records: "queue.Queue" = queue.Queue(maxsize=config.LOG_QUEUE_SIZE)
+    handler = DeferredQueueHandler(records)
+    handler.addFilter(RequestRateLimit(config.LOG_REQUEST_RATE))
+    log.addHandler(handler)
+
+    listener = QueueListener(records, file_handler, respect_handler_level=True)
+    handler.listener = listener  # so tests and shutdown code can flush it
+    listener.start()
+    atexit.register(_stop, listener)  # flush what is still queued on shutdown
+    return log
+
 
 #configure the logger
-logger = logging.getLogger("inference_logger")
-logger.setLevel(logging.INFO)
-
-# Create a file handler
-file_handler = logging.FileHandler("inference.log")
-file_handler.setLevel(logging.INFO)
-
-#formatter for readibility
-formatter = logging.Formatter(
-    "%(asctime)s - %(levelname)s - %(message)s", "%Y-%m-%d %H:%M:%S"
-)
-file_handler.setFormatter(formatter)
-# Add the file handler to the logger
-logger.addHandler(file_handler)
\ No newline at end of file
+logger = configure()
@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, List, Optional
+from prometheus_client import Counter, Gauge, Histogram
+from models.inference_engine import mapped_rss_bytes
+from utils import config
+from utils.multi_model_manager import ModelWorker, MultiModelManager
+
+MODEL_COLD_LOAD_SECONDS = Histogram(
+    "model_cold_load_seconds", "First request for a model not in memory until its first worker is ready", ["model"],
+    buckets=(0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+)
+MODEL_RESIDENT_BYTES = Gauge("model_resident_bytes", "Resident weights (PSS) plus the llama.cpp state size of every worker context of a loaded model", ["model"])
+MODEL_EVICTIONS = Counter("model_evictions_total", "Idle models unloaded to stay within the memory budget", ["model"])
+
+
+class UnknownModelError(Exception):
+    def __init__(self, name: str, known: List[str]):
+        super().__init__(f"Unknown model {name!r}, available: {', '.join(known)}")
+
+
+class ModelMemoryError(Exception):
+    """Raised when a model doesn't fit the memory budget and nothing idle can be evicted."""
+
+
+def pool_bytes(pool: MultiModelManager) -> int:
+    # PSS, so weights mapped by every worker of the pool count once
+    workers = pool.models + pool.spares
+    return mapped_rss_bytes(pool.model_path, "Pss") + sum(worker.model.context_bytes() for worker in workers)
+
+
+def _file_bytes(path: str) -> int:
+    # Estimate for a model not loaded yet: its weights end up resident more or less whole
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+class ModelRegistry:
+    """Named GGUF models on one node, each served by its own MultiModelManager pool.
+
+    The default model's pool is handed in and never evicted. Other models load on first use and
+    stay resident while `memory_budget` allows; loading one that doesn't fit first unloads the
+    least recently used idle models. A model is idle when none of its workers is busy, no request
+    holds its pool (see `hold`) and `queued(name)` reports nothing waiting for it. The registry
+    also speaks the manager interface the Autoscaler drives: the autoscaler picks the total worker
+    count, and each added or removed worker goes to or comes from the model with the most or least
+    queued work per worker.
+    """
+
+    def __init__(self, paths: Dict[str, str], default: str, default_pool: MultiModelManager,
+                 memory_budget: int = config.MODEL_MEMORY_BUDGET_BYTES,
+                 pool_factory: Optional[Callable[[str, str], MultiModelManager]] = None,
+                 measure: Callable[[MultiModelManager], int] = pool_bytes,
+                 queued: Callable[[str], bool] = lambda name: False):
+        self.paths = {default: default_pool.model_path, **paths}
+        self.default = default
+        self.pools: "OrderedDict[str, MultiModelManager]" = OrderedDict({default: default_pool})  # LRU first
+        self.memory_budget = memory_budget
+        # Same backend as the default pool, and worker processes of every model take their cores from its CorePool
+        self.pool_factory = pool_factory or (lambda name, path: MultiModelManager(
+            1, model_path=path, lazy=True, name=name, backend=default_pool.backend, core_pool=default_pool.core_pool
+        ))
+        self.measure = measure
+        self.queued = queued
+        self._holds: Dict[str, int] = {}  # requests between picking a pool and finishing on it, per model
+        self._loading: Dict[str, asyncio.Future] = {}
+
+    async def get(self, name: Optional[str] = None) -> MultiModelManager:
+        """The pool serving `name`, loading the model first if it isn't resident."""
+        name = name or self.default
+        if name not in self.paths:
+            raise UnknownModelError(name, sorted(self.paths))
+        pool = self.pools.get(name)
+        if pool is not None:
+            self.pools.move_to_end(name)
+            return pool
+        if name not in self._loading:
+            # Concurrent first requests share one load
+            load = asyncio.ensure_future(self._load(name))
+            self._loading[name] = load
+            load.add_done_callback(lambda _: self._loading.pop(name, None))
+        return await asyncio.shield(self._loading[name])
+
+    @asynccontextmanager
+    async def hold(self, name: Optional[str] = None):
+        """Like `get`, but the pool can't be evicted until the block exits."""
+        name = name or self.default
+        self._holds[name] = self._holds.get(name, 0) + 1
+        try:
+            yield await self.get(name)
+        finally:
+            self._holds[name] -= 1
+            if not self._holds[name]:
+                del self._holds[name]
+
+    async def _load(self, name: str) -> MultiModelManager:
+        path = self.paths[name]
+        started = time.monotonic()
+        await self._make_room(_file_bytes(path), keep=name)
+        pool = self.pool_factory(name, path)
+        logging.info(f"[REGISTRY] Loading model {name} from {path}")
+        await pool.start()
+        MODEL_COLD_LOAD_SECONDS.labels(model=name).observe(time.monotonic() - started)
+        self.pools[name] = pool
+        self.report_memory()
+        await self._make_room(0, keep=name)  # the estimate can be low once contexts are allocated
+        return pool
+
+    def resident_bytes(self) -> int:
+        return sum(self.measure(pool) for pool in self.pools.values())
+
+    def _is_idle(self, name: str, pool: MultiModelManager) -> bool:
+        # Routed but not yet generating, or still queued, would find the workers closed under them
+        if self._holds.get(name) or self.queued(name):
+            return False
+        return all(worker.is_idle() for worker in pool.models)
+
+    async def _make_room(self, needed: int, keep: str):
+        # Evict least recently used idle models until `needed` more bytes fit
+        if self.memory_budget <= 0:
+            return
+        while self.resident_bytes() + needed > self.memory_budget:
+            victim = next((name for name, pool in self.pools.items()
+                           if name not in (self.default, keep) and self._is_idle(name, pool)), None)
+            if victim is None:
+                if needed > 0:
+                    raise ModelMemoryError(f"Model {keep!r} doesn't fit the memory budget and no loaded model is idle")
+                logging.warning("[REGISTRY] Over the memory budget, but every other model is busy")
+                return
+            await self.evict(victim)
+
+    async def evict(self, name: str):
+        pool = self.pools.pop(name)
+        logging.info(f"[REGISTRY] Evicting idle model {name}")
+        await pool.close()
+        MODEL_EVICTIONS.labels(model=name).inc()
+        try:
+            MODEL_RESIDENT_BYTES.remove(name)
+        except KeyError:
+            pass
+
+    def report_memory(self):
+        for name, pool in self.pools.items():
+            MODEL_RESIDENT_BYTES.labels(model=name).set(self.measure(pool))
+
+    async def close(self):
+        # The default pool belongs to whoever created it
+        for name in [name for name in self.pools if name != self.default]:
+            await self.pools.pop(name).close()
+
+    # Manager interface for the Autoscaler, aggregated over every loaded model
+
+    @property
+    def models(self) -> List[ModelWorker]:
+        return [worker for pool in self.pools.values() for worker in pool.models]
+
+    def total_in_flight(self) -> int:
+        return sum(pool.total_in_flight() for pool in self.pools.values())
+
+    @staticmethod
+    def _load_per_worker(pool: MultiModelManager) -> float:
+        # Seconds of routed work each worker of the pool still has to get through
+        if not pool.models:
+            return 0.0
+        return sum(worker.expected_completion(0) for worker in pool.models) / len(pool.models)
+
+    async def scale_up(self):
+        name, pool = max(self.pools.items(), key=lambda item: self._load_per_worker(item[1]))
+        if pool.models:
+            try:
+                await self._make_room(max(worker.model.context_bytes() for worker in pool.models), keep=name)
+            except ModelMemoryError:
+                logging.warning(f"[REGISTRY] Not adding a worker to {name}: memory budget reached")
+                return
+        await pool.scale_up()
+
+    async def scale_down(self):
+        pools = [pool for pool in self.pools.values() if len(pool.models) > 1]
+        if pools:
+            await min(pools, key=self._load_per_worker).scale_down()
@@ -1,60 +1,378 @@
 import asyncio
+import itertools
 import random
 import logging
-from typing import List
-from models.inference_engine import TinyLLamaModel
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Callable, List, Optional
+from models.inference_engine import ContinuousBatchingEngine, TinyLLamaModel, SharedWeights, mapped_rss_bytes
+from utils import config
+from utils.admission import TokenSlots
+from utils.load_balancing import (
+    DEFAULT_TOKENS_PER_SEC, RATE_EWMA_ALPHA, ROUTED_REQUESTS, ABPolicy, estimate_tokens, make_policy, request_cost,
+)
+from utils.logger import REQUEST, logger
+from utils.process_worker import CorePool, ProcessModel
+from utils.telemetry import WORKER_BATCH_SIZE, WORKER_BUSY_SECONDS, RequestTrace, forget_worker
+from prometheus_client import Gauge
+
+# llama_state_get_size of the worker's context (KV cache, logits, RNG): what a state save copies, not the worker's RSS
+WORKER_STATE_BYTES = Gauge("model_worker_state_bytes", "Per-worker llama.cpp context state size (KV cache + logits), not RSS", ["worker"])
+WEIGHTS_RSS_BYTES = Gauge("model_weights_rss_bytes", "Resident bytes of the GGUF weight mappings in this process")
+WARM_SPARE_WORKERS = Gauge("model_warm_spare_workers", "Loaded workers kept out of rotation for instant scale-up")
+DRAINING_WORKERS = Gauge("model_draining_workers", "Workers out of rotation, finishing their requests before removal")
+
+RELOAD_PROGRESS = Gauge("model_reload_progress_ratio", "Fraction of workers replaced by the current or last rolling reload")
+RELOAD_IN_PROGRESS = Gauge("model_reload_in_progress", "1 while a rolling reload is running")
+
+DRAIN_POLL_INTERVAL = 0.05  # seconds between checks while waiting for a worker to go idle
+RELOAD_WARMUP_PROMPT = "Say hello."
+RELOAD_WARMUP_TOKENS = 8
+RELOAD_WARMUP_TIMEOUT = 120  # seconds; the first decode on a fresh model also pages the weights in
 
 class ModelWorker:
-    def __init__(self,name:str, model_path: str):
+    def __init__(self,name:str, model_path: str, model=None, max_concurrency: Optional[int] = None,
+                 token_capacity: Optional[int] = None):
         self.name = name
-        self.model = TinyLLamaModel(model_path)
+        self.model = model if model is not None else TinyLLamaModel(model_path)
         self.lock = asyncio.Lock() #simulate load balancing by locking access
         self.in_flight_requests = 0 #track active concurrent requests
-        self.semaphore = asyncio.Semaphore(4) # allow 2 concurrent prompts per worker
+        # Concurrent prompts per worker, reserved by their prompt + max_tokens against the KV capacity
+        self.slots = TokenSlots(token_capacity or config.N_CTX, max_concurrency or config.WORKER_CONCURRENCY)
+        # Token work routed here but not finished yet (waiting for a slot or decoding)
+        self.outstanding_tokens = 0.0
+        self.assigned_requests = 0  # requests routed here and not finished, queued ones included
+        self.tokens_per_sec = DEFAULT_TOKENS_PER_SEC  # EWMA of measured throughput
+        self._busy_since: Optional[float] = None
+        self._busy_mark: Optional[float] = None  # start of busy time not yet added to WORKER_BUSY_SECONDS
+        self._last_completion = 0.0
 
-    async def generate(self, prompt: str, max_tokens: int):
-        logging.info(f"[{self.name}] Attempting to acquire lock (in-flight: {self.in_flight_requests})")
-        async with self.semaphore:
-            self.in_flight_requests += 1
-            try:
-                logging.info(f"[{self.name}] Processing prompt: {prompt[:30]}...")
-                result = await self.model.generate(prompt, max_tokens)
-                logging.info(f"[{self.name}] Completed prompt: {prompt[:30]}")
-                return result
-            finally:
-                self.in_flight_requests -= 1
+    @property
+    def tokens_on_loop(self) -> bool:
+        # Whether the model awaits `on_token` on the event loop (async) instead of calling it from its own thread
+        return getattr(self.model, "tokens_on_loop", False)
+
+    def expected_completion(self, cost: float) -> float:
+        # Seconds until a request of `cost` would finish here if it joined now
+        return (self.outstanding_tokens + cost) / self.tokens_per_sec
+
+    def _record_throughput(self, tokens: float):
+        # Throughput of the whole worker: work finished over time spent busy since the last completion,
+        # so concurrent requests on a batching worker are not mistaken for slow ones
+        now = time.monotonic()
+        elapsed = now - max(self._last_completion, self._busy_since or now)
+        self._last_completion = now
+        if elapsed > 0:
+            self.tokens_per_sec += RATE_EWMA_ALPHA * (tokens / elapsed - self.tokens_per_sec)
+
+    @contextmanager
+    def reserve(self, prompt: str, max_tokens: int, prompt_tokens: Optional[int] = None):
+        # Counts a request against this worker from the moment it is routed here. Take it right after
+        # select_worker, before any await, or requests routed concurrently all see the worker empty
+        cost = request_cost(prompt, max_tokens, prompt_tokens)
+        self.outstanding_tokens += cost
+        self.assigned_requests += 1
+        try:
+            yield
+        finally:
+            self.outstanding_tokens -= cost
+            self.assigned_requests -= 1
+
+    async def generate(self, prompt: str, max_tokens: int, on_token: Optional[Callable[[str], None]] = None,
+                       cancel: Optional[threading.Event] = None, trace: Optional[RequestTrace] = None,
+                       prompt_tokens: Optional[int] = None, reserved: bool = False):
+        # reserved: the caller already holds reserve() for this request
+        logger.log(REQUEST, "[%s] Attempting to acquire lock (in-flight: %d)", self.name, self.in_flight_requests)
+        if prompt_tokens is None:
+            prompt_tokens = estimate_tokens(prompt)
+        with nullcontext() if reserved else self.reserve(prompt, max_tokens, prompt_tokens):
+            async with self.slots.reserve(prompt_tokens + max_tokens):
+                if self.in_flight_requests == 0:
+                    self._busy_since = self._busy_mark = time.monotonic()
+                self.in_flight_requests += 1
+                WORKER_BATCH_SIZE.labels(worker=self.name).observe(self.in_flight_requests)
+                if trace is not None:
+                    trace.started(self.name)
+                try:
+                    logger.log(REQUEST, "[%s] Processing prompt: %.30s...", self.name, prompt)
+                    result = await self.model.generate(prompt, max_tokens, on_token=on_token, cancel=cancel)
+                    # Measure what was actually produced, generation often stops well before max_tokens
+                    self._record_throughput(request_cost(prompt, estimate_tokens(result or ""), prompt_tokens))
+                    logger.log(REQUEST, "[%s] Completed prompt: %.30s", self.name, prompt)
+                    return result
+                finally:
+                    self.in_flight_requests -= 1
+                    if self.in_flight_requests == 0:
+                        self.account_busy()
+
+    def account_busy(self):
+        # Adds busy time since the last mark; called when the worker goes idle and on every scrape
+        if self._busy_mark is not None:
+            now = time.monotonic()
+            WORKER_BUSY_SECONDS.labels(worker=self.name).inc(now - self._busy_mark)
+            self._busy_mark = now if self.in_flight_requests > 0 else None
+
+    def is_idle(self) -> bool:
+        return self.assigned_requests == 0
 
 class MultiModelManager:
-    def __init__(self, num_workers: int, *, model_path: str):
+    def __init__(self, num_workers: int, *, model_path: str, backend: Optional[str] = None, policy=None,
+                 lazy: bool = False, name: Optional[str] = None, core_pool: Optional[CorePool] = None):
         self.num_workers = num_workers
         self.model_path = model_path
-        self.models: List[ModelWorker] = [
-            ModelWorker(name=f"worker_{i}", model_path=model_path) for i in range(num_workers)
-        ]
+        self.name = name  # registry model name; prefixes worker names so pools of different models don't collide
+        self.backend = backend or config.WORKER_BACKEND
+        self.policy = policy or make_policy(config.LOAD_BALANCER, config.LOAD_BALANCER_AB_SPLIT)
+        # "process" runs each worker in its own subprocess pinned to a disjoint core set. Pools of one
+        # node should share a core_pool, or each one hands out the same cores from the start
+        self.core_pool = None
+        if self.backend == "process":
+            self.core_pool = core_pool or CorePool(num_workers)
+        self._worker_ids = itertools.count()
+        # lazy: load nothing here, start() brings the workers up concurrently later
+        self.models: List[ModelWorker] = [] if lazy else [self._new_worker(self._next_name()) for _ in range(num_workers)]
+        self.spares: List[ModelWorker] = []  # loaded but out of rotation, handed out first on scale-up
+        self._spares_loading = 0
+        self._background: set = set()
+        self.reload_status = {"state": "idle"}
+        self._reported_workers = set()
 
-    def get_least_busy_model(self)->ModelWorker:
+    def _next_name(self) -> str:
+        # Names are never reused, so a drained worker's metrics can't collide with a new one
+        worker = f"worker_{next(self._worker_ids)}"
+        return f"{self.name}/{worker}" if self.name else worker
+
+    def _new_model(self, cores=None):
+        if self.backend == "process":
+            return ProcessModel(self.model_path, cores)
+        if config.CONTINUOUS_BATCHING:
+            return ContinuousBatchingEngine(self.model_path, n_slots=config.BATCH_SLOTS)
+        return TinyLLamaModel(self.model_path)
+
+    def _new_worker(self, name: str) -> ModelWorker:
+        if self.backend == "process":
+            model = self._new_model(self.core_pool.acquire())
+            return ModelWorker(name=name, model_path=self.model_path, model=model, max_concurrency=1)
+        if config.CONTINUOUS_BATCHING:
+            # One request per KV slot; more would just wait inside the engine
+            return ModelWorker(name=name, model_path=self.model_path, model=self._new_model(),
+                               max_concurrency=config.BATCH_SLOTS, token_capacity=config.BATCH_SLOTS * config.N_CTX)
+        return ModelWorker(name=name, model_path=self.model_path, model=self._new_model())
+
+    def _close_model(self, model):
+        model.close()
+        if self.backend == "process":
+            self.core_pool.release(model.cores)
+
+    def get_least_busy_model(self, prompt: Optional[str] = None)->ModelWorker:
         #pick the least loaded model worker
         chosen =  min(self.models, key=lambda worker: worker.in_flight_requests)
-        logging.info(f"[Manager] Selected {chosen.name} (in-flight: {chosen.in_flight_requests})")
+        if prompt is not None and config.PREFIX_CACHE_BYTES > 0:
+            chosen = self._prefer_cached_prefix(prompt, chosen)
+        logger.log(REQUEST, "[Manager] Selected %s (in-flight: %d)", chosen.name, chosen.in_flight_requests)
         return chosen
     
-    def scale_up(self):
-        idx = len(self.models)
-        logging.info(f"[Manager] Scaling up: spawning worker_{idx}")
-        self.models.append(ModelWorker(name=f"worker_{idx}", model_path=self.model_path))
-    
-    def scale_down(self):
-        if len(self.models) > 1:
-            removed = self.models.pop()
-            del removed.model  # Free resources
+    def routing_policy(self):
+        # With an A/B policy every request is assigned an arm, so latency can be compared per arm
+        if isinstance(self.policy, ABPolicy):
+            return self.policy.arm()
+        return self.policy
+
+    def select_worker(self, prompt: Optional[str] = None, max_tokens: int = 128, policy=None,
+                      prompt_tokens: Optional[int] = None) -> ModelWorker:
+        policy = policy or self.routing_policy()
+        cost = request_cost(prompt or "", max_tokens, prompt_tokens)
+        chosen = policy.choose(self.models, cost)
+        if prompt is not None and config.PREFIX_CACHE_BYTES > 0:
+            chosen = self._prefer_cached_prefix(prompt, chosen)
+        ROUTED_REQUESTS.labels(policy=policy.name).inc()
+        logger.log(REQUEST, "[Manager] %s selected %s (in-flight: %d, outstanding tokens: %.0f)",
+                   policy.name, chosen.name, chosen.in_flight_requests, chosen.outstanding_tokens)
+        return chosen
+
+    def _prefer_cached_prefix(self, prompt: str, least_busy: ModelWorker) -> ModelWorker:
+        # Reusing a KV prefix beats perfect balance, as long as the worker is at most one request busier
+        best, best_match = least_busy, config.PREFIX_ROUTING_MIN_CHARS - 1
+        for worker in self.models:
+            if worker.in_flight_requests > least_busy.in_flight_requests + 1:
+                continue
+            match = worker.model.prefix_match_chars(prompt)
+            if match > best_match:
+                best, best_match = worker, match
+        return best
+
+    async def start(self, on_worker_ready: Optional[Callable[[ModelWorker], None]] = None):
+        """Load the missing initial workers concurrently; each joins the rotation as soon as it is ready."""
+        loads = [self._load_worker() for _ in range(self.num_workers - len(self.models))]
+        for load in asyncio.as_completed(loads):
+            try:
+                worker = await load
+            except Exception as e:
+                logging.error(f"[Manager] Failed to load an initial worker: {e}")
+                continue
+            self.models.append(worker)
+            logging.info(f"[Manager] {worker.name} ready ({len(self.models)}/{self.num_workers})")
+            if on_worker_ready is not None:
+                on_worker_ready(worker)
+        if not self.models:
+            raise RuntimeError("No model worker could be loaded")
+
+    def is_ready(self) -> bool:
+        return len(self.models) > 0
+
+    async def close(self):
+        for worker in self.models + self.spares:
+            await self.retire(worker)
+        self.models, self.spares = [], []
+
+    async def _load_worker(self) -> ModelWorker:
+        # Loading a model takes seconds; doing it in the executor keeps serving requests meanwhile
+        name = self._next_name()
+        logging.info(f"[Manager] Loading {name} in the background")
+        return await asyncio.get_event_loop().run_in_executor(None, self._new_worker, name)
+
+    async def scale_up(self):
+        if self.spares:
+            worker = self.spares.pop()
+            logging.info(f"[Manager] Scaling up: promoting warm spare {worker.name}")
+        else:
+            worker = await self._load_worker()
+            logging.info(f"[Manager] Scaling up: {worker.name} loaded")
+        self.models.append(worker)
+        WARM_SPARE_WORKERS.set(len(self.spares))
+        self.replenish_spares()
+
+    def replenish_spares(self):
+        # Start background loads until config.WARM_SPARES workers are ready or on their way
+        for _ in range(config.WARM_SPARES - len(self.spares) - self._spares_loading):
+            self._spares_loading += 1
+            task = asyncio.ensure_future(self._load_spare())
+            self._background.add(task)
+            task.add_done_callback(self._background.discard)
+
+    async def _load_spare(self):
+        try:
+            self.spares.append(await self._load_worker())
+            WARM_SPARE_WORKERS.set(len(self.spares))
+        except Exception as e:
+            logging.error(f"[Manager] Failed to load warm spare: {e}")
+        finally:
+            self._spares_loading -= 1
+
+    async def scale_down(self):
+        if len(self.models) <= 1:
+            return
+        # Take out the worker with the least unfinished work, it drains soonest
+        worker = min(self.models, key=lambda w: (w.outstanding_tokens, w.assigned_requests))
+        self.models.remove(worker)  # no new requests are routed to it from here on
+        logging.info(f"[Manager] Scaling down: draining {worker.name} ({worker.assigned_requests} requests left)")
+        await self.drain(worker)
+        if len(self.spares) < config.WARM_SPARES:
+            self.spares.append(worker)
+            WARM_SPARE_WORKERS.set(len(self.spares))
+            logging.info(f"[Manager] {worker.name} drained, kept as warm spare")
+            return
+        await self.retire(worker)
+        logging.info(f"[Manager] {worker.name} drained and closed")
+
+    async def drain(self, worker: ModelWorker):
+        DRAINING_WORKERS.inc()
+        try:
+            while not worker.is_idle():
+                await asyncio.sleep(DRAIN_POLL_INTERVAL)
+        finally:
+            DRAINING_WORKERS.dec()
+
+    async def retire(self, worker: ModelWorker):
+        if worker.name in self._reported_workers:
+            WORKER_STATE_BYTES.remove(worker.name)
+            self._reported_workers.discard(worker.name)
+        forget_worker(worker.name)
+        await asyncio.get_event_loop().run_in_executor(None, self._close_model, worker.model)
+        del worker.model  # Free resources
+
+    def report_memory(self):
+        # Refreshed on every /metrics scrape; with shared weights the weight RSS stays flat as workers are added
+        for worker in self.models:
+            worker.account_busy()
+            WORKER_STATE_BYTES.labels(worker=worker.name).set(worker.model.context_bytes())
+            self._reported_workers.add(worker.name)
+        WEIGHTS_RSS_BYTES.set(mapped_rss_bytes(self.model_path))
 
     def total_in_flight(self)->int:
         return sum(w.in_flight_requests for w in self.models)
     
-    def reload_model(self):
-        logging.info("[Manager] Reloading all model workers...")
-        for worker in self.models:
-            worker.model = TinyLLamaModel(self.model_path)
-            logging.info(f"[Manager] Reloaded model for {worker.name}")
+    def start_reload(self) -> bool:
+        """Kick off a rolling reload in the background; False if one is already running."""
+        if self.reload_status["state"] == "running":
+            return False
+        self.reload_status = {
+            "state": "running", "total": len(self.models), "completed": 0, "current": None,
+            "started_at": time.time(), "finished_at": None, "error": None,
+        }
+        RELOAD_IN_PROGRESS.set(1)
+        RELOAD_PROGRESS.set(0)
+        task = asyncio.ensure_future(self.reload_model())
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        return True
+
+    async def reload_model(self):
+        """Replace every worker's model one at a time without losing capacity.
+
+        Each replacement loads in the executor while the old worker keeps serving, answers a
+        warm-up prompt, then takes the old worker's place in rotation; the old worker drains and
+        is closed. Only one old worker is ever out of rotation, and a replacement that fails to
+        load or warm up stops the reload with the remaining workers untouched.
+        """
+        status = self.reload_status
+        logging.info("[Manager] Rolling reload of all model workers...")
+        if config.SHARED_WEIGHTS:
+            SharedWeights.forget(self.model_path)  # replacements map the weights from disk again
+        try:
+            for old in list(self.models):
+                if old not in self.models:
+                    continue  # scaled down while we were busy
+                status["current"] = old.name
+                replacement = await self._load_worker()
+                try:
+                    await self._warm_up(replacement)
+                except Exception:
+                    await self.retire(replacement)
+                    raise
+                if old not in self.models:
+                    await self.retire(replacement)
+                    continue
+                self.models[self.models.index(old)] = replacement
+                logging.info(f"[Manager] {replacement.name} replaced {old.name}, draining the old worker")
+                await self.drain(old)
+                await self.retire(old)
+                status["completed"] += 1
+                RELOAD_PROGRESS.set(status["completed"] / max(1, status["total"]))
+
+            # Spares still hold the old model, swap them for fresh ones
+            stale, self.spares = self.spares, []
+            for worker in stale:
+                await self.retire(worker)
+            WARM_SPARE_WORKERS.set(0)
+            self.replenish_spares()
+        except Exception as e:
+            logging.error(f"[Manager] Rolling reload failed on {status['current']}: {e}")
+            status.update(state="failed", error=f"{type(e).__name__}: {e}")
+            return False
+        finally:
+            status.update(current=None, finished_at=time.time())
+            RELOAD_IN_PROGRESS.set(0)
+        status["state"] = "done"
         logging.info("[Manager] All workers reloaded successfully.")
         return True
+
+    async def _warm_up(self, worker: ModelWorker):
+        # Talk to the model directly so the warm-up doesn't count towards the worker's throughput
+        text = await asyncio.wait_for(
+            worker.model.generate(RELOAD_WARMUP_PROMPT, RELOAD_WARMUP_TOKENS),
+            timeout=RELOAD_WARMUP_TIMEOUT
+        )
+        if not isinstance(text, str):
+            raise RuntimeError(f"Warm-up returned {type(text).__name__} instead of text")
@@ -0,0 +1,149 @@
+import os.path
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Sequence
+from prometheus_client import Counter, Gauge
+
+PREFIX_CACHE_HITS = Counter("prefix_cache_hits_total", "Prompts that restored a cached KV prefix")
+PREFIX_CACHE_MISSES = Counter("prefix_cache_misses_total", "Prompts with no cached KV prefix")
+PREFIX_CACHE_SKIPPED = Counter("prefix_cache_skipped_total", "Cached prefixes not restored because the context already held a longer one")
+PREFIX_CACHE_REUSED_TOKENS = Counter("prefix_cache_reused_tokens_total", "Prompt tokens restored from cache instead of re-evaluated")
+PREFIX_CACHE_REUSED_BYTES = Counter("prefix_cache_reused_bytes_total", "Bytes of llama.cpp state restored from cache")
+PREFIX_CACHE_BYTES = Gauge("prefix_cache_bytes", "Bytes of llama.cpp state held by all prefix caches")
+PREFIX_CACHE_EVICTIONS = Counter("prefix_cache_evictions_total", "Prefix cache entries evicted to stay within budget")
+
+BLOCK_SIZE = 32  # prefixes are matched at multiples of this many tokens
+
+
+class _Entry:
+    def __init__(self, state, hashes: List[int], nbytes: int, text: Optional[str]):
+        self.state = state
+        self.hashes = hashes
+        self.nbytes = nbytes
+        self.text = text
+
+
+def _block_hashes(tokens: Sequence[int], block_size: int) -> List[int]:
+    # Rolling hash per full block: hashes[i] identifies tokens[:(i + 1) * block_size]
+    hashes = []
+    h = 0
+    for end in range(block_size, len(tokens) + 1, block_size):
+        h = hash((h, tuple(tokens[end - block_size:end])))
+        hashes.append(h)
+    return hashes
+
+
+def _common_prefix(a: Sequence[int], b: Sequence[int]) -> int:
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+def _state_bytes(state) -> int:
+    return int(state.llama_state_size) + state.scores.nbytes + state.input_ids.nbytes
+
+
+class PrefixCache:
+    """LRU cache of llama.cpp states, looked up by the longest matching token prefix.
+
+    Plugs into `Llama.set_cache`: llama-cpp-python looks the prompt tokens up before decoding
+    (restoring the state if it beats what is already in the context) and stores the final state
+    after each completion. Entries are indexed by a rolling hash every BLOCK_SIZE tokens, so a
+    lookup is one dict probe per block instead of a scan over every cached key.
+
+    llama-cpp-python only loads the returned state when it shares more of the prompt than the
+    tokens already in the context, so `context_tokens` (the context's current tokens) lets hits
+    and reused tokens be counted for states that are actually restored.
+    """
+
+    def __init__(self, capacity_bytes: int, block_size: int = BLOCK_SIZE,
+                 context_tokens: Optional[Callable[[], Sequence[int]]] = None):
+        self.capacity_bytes = capacity_bytes
+        self.block_size = block_size
+        self.context_tokens = context_tokens or (lambda: ())
+        self.entries: "OrderedDict[int, _Entry]" = OrderedDict()
+        self.index: Dict[int, int] = {}  # prefix hash -> entry id
+        self.size = 0
+        self.pending_text: Optional[str] = None  # raw prompt of the completion being decoded, for routing
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    @property
+    def cache_size(self) -> int:
+        return self.size
+
+    def _lookup(self, tokens: Sequence[int]):
+        hashes = _block_hashes(tokens, self.block_size)
+        for n_blocks in range(len(hashes), 0, -1):
+            entry_id = self.index.get(hashes[n_blocks - 1])
+            if entry_id is None:
+                continue
+            entry = self.entries[entry_id]
+            matched = n_blocks * self.block_size
+            # Guard against hash collisions before handing the state to llama.cpp
+            if list(entry.state.input_ids[:matched]) == list(tokens[:matched]):
+                return entry_id, entry, matched
+        return None, None, 0
+
+    def __getitem__(self, key: Sequence[int]):
+        with self._lock:
+            entry_id, entry, matched = self._lookup(key)
+            if entry is None:
+                PREFIX_CACHE_MISSES.inc()
+                raise KeyError("No cached prefix")
+            self.entries.move_to_end(entry_id)
+            # Same test llama-cpp-python makes before load_state
+            restored = _common_prefix(list(entry.state.input_ids), key)
+            live = _common_prefix(list(self.context_tokens()), key)
+            if restored > live:
+                PREFIX_CACHE_HITS.inc()
+                PREFIX_CACHE_REUSED_TOKENS.inc(restored - live)
+                PREFIX_CACHE_REUSED_BYTES.inc(entry.nbytes)
+            else:
+                PREFIX_CACHE_SKIPPED.inc()
+            return entry.state
+
+    def __contains__(self, key: Sequence[int]) -> bool:
+        with self._lock:
+            return self._lookup(key)[1] is not None
+
+    def __setitem__(self, key: Sequence[int], state):
+        hashes = _block_hashes(key, self.block_size)
+        if not hashes:
+            return  # shorter than one block, nothing worth keeping
+        nbytes = _state_bytes(state)
+        if nbytes > self.capacity_bytes:
+            return
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self.entries[entry_id] = _Entry(state, hashes, nbytes, self.pending_text)
+            for h in hashes:
+                self.index[h] = entry_id  # newest entry wins for shared prefixes
+            self.size += nbytes
+            PREFIX_CACHE_BYTES.inc(nbytes)
+            while self.size > self.capacity_bytes:
+                self._evict_oldest()
+
+    def _evict_oldest(self):
+        entry_id, entry = self.entries.popitem(last=False)
+        for h in entry.hashes:
+            if self.index.get(h) == entry_id:
+                del self.index[h]
+        self.size -= entry.nbytes
+        PREFIX_CACHE_BYTES.dec(entry.nbytes)
+        PREFIX_CACHE_EVICTIONS.inc()
+
+    def longest_text_prefix(self, prompt: str) -> int:
+        """Characters of `prompt` shared with the longest cached prompt (cheap routing hint, no tokenizing)."""
+        with self._lock:
+            texts = [entry.text for entry in self.entries.values() if entry.text]
+        return max((len(os.path.commonprefix([prompt, text])) for text in texts), default=0)
+
+    def clear(self):
+        with self._lock:
+            while self.entries:
+                self._evict_oldest()
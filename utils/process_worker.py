@@ -0,0 +1,289 @@
+import asyncio
+import functools
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from utils.cancellation import WASTED_TOKENS_AVOIDED, CancelToken
+from utils.streaming import STREAM_BUFFER_SIZE, TokenRelay
+
+# Streamed deltas the parent lets through before granting the child more credit; a grant per delta
+# would double the pipe traffic
+CREDIT_BATCH = STREAM_BUFFER_SIZE // 4
+
+
+def available_cores() -> List[int]:
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+class CorePool:
+    """Hands out disjoint CPU core sets to worker processes.
+
+    Each worker gets `len(cores) // num_workers` cores. Once every set is taken, new workers
+    share the set with the fewest users so we degrade gracefully instead of failing scale-up.
+    """
+
+    def __init__(self, num_workers: int, cores: Optional[List[int]] = None):
+        cores = cores if cores is not None else available_cores()
+        per_worker = max(1, len(cores) // max(1, num_workers))
+        self.core_sets: List[Tuple[int, ...]] = [
+            tuple(cores[i:i + per_worker]) for i in range(0, len(cores) - per_worker + 1, per_worker)
+        ]
+        self.users: Dict[Tuple[int, ...], int] = {core_set: 0 for core_set in self.core_sets}
+
+    def acquire(self) -> Tuple[int, ...]:
+        core_set = min(self.core_sets, key=lambda s: self.users[s])
+        self.users[core_set] += 1
+        return core_set
+
+    def release(self, core_set: Tuple[int, ...]):
+        if self.users.get(core_set, 0) > 0:
+            self.users[core_set] -= 1
+
+
+class _Credit:
+    """Streamed deltas the child may still send for one request (child side).
+
+    The parent grants more as its relay hands deltas to the reader, so at most STREAM_BUFFER_SIZE
+    sit undelivered in the parent and a slow reader stalls its own request's decode instead.
+    """
+
+    def __init__(self, cancelled: threading.Event, credit: int = STREAM_BUFFER_SIZE):
+        self.credit = credit
+        self.cancelled = cancelled
+        self._cond = threading.Condition()
+
+    def grant(self, n: int):
+        # n=0 just wakes the token loop, e.g. to notice a cancellation
+        with self._cond:
+            self.credit += n
+            self._cond.notify()
+
+    def take(self) -> bool:
+        # Waits for credit; False if the request was cancelled meanwhile
+        with self._cond:
+            while self.credit <= 0 and not self.cancelled.is_set():
+                self._cond.wait()
+            if self.cancelled.is_set():
+                return False
+            self.credit -= 1
+            return True
+
+
+def _worker_main(conn, model_path: str, cores: Tuple[int, ...]):
+    # Runs in the child: pin first so llama.cpp's threads are created on our cores only
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    from models.inference_engine import TinyLLamaModel
+
+    model = TinyLLamaModel(model_path, n_threads=len(cores))
+    conn.send(("ready", None, model.context_bytes()))
+
+    # A reader thread keeps receiving while we decode, so cancellations reach the token loop
+    work: "queue.Queue" = queue.Queue()
+    cancelled: Dict[int, threading.Event] = {}
+    credits: Dict[int, _Credit] = {}
+
+    def read_requests():
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                message = None
+            if message is None:
+                for event in list(cancelled.values()):
+                    event.set()
+                for credit in list(credits.values()):
+                    credit.grant(0)  # the parent is gone, don't wait on it for credit
+                work.put(None)
+                return
+            if message[0] == "cancel":
+                event, credit = cancelled.get(message[1]), credits.get(message[1])
+                if event is not None:
+                    event.set()
+                if credit is not None:
+                    credit.grant(0)
+                continue
+            if message[0] == "credit":
+                credit = credits.get(message[1])
+                if credit is not None:
+                    credit.grant(message[2])
+                continue
+            cancelled[message[0]] = threading.Event()
+            credits[message[0]] = _Credit(cancelled[message[0]])
+            work.put(message)
+
+    threading.Thread(target=read_requests, daemon=True).start()
+    while True:
+        message = work.get()
+        if message is None:
+            break
+        request_id, prompt, max_tokens, stream = message
+        on_token = None
+        if stream:
+            def on_token(delta, request_id=request_id, credit=credits[request_id]):
+                # Out of credit: the parent's reader is behind, wait rather than flood the pipe
+                if credit.take():
+                    conn.send(("token", request_id, delta))
+        avoided_before = model.tokens_avoided
+        try:
+            text = model._sync_generate(prompt, max_tokens, on_token, cancelled[request_id].is_set)
+            conn.send(("done", request_id, (text, model.context_bytes(), model.tokens_avoided - avoided_before)))
+        except Exception as e:
+            conn.send(("error", request_id, f"{type(e).__name__}: {e}"))
+        finally:
+            cancelled.pop(request_id, None)
+            credits.pop(request_id, None)
+    model.close()
+
+
+class ProcessModel:
+    """Drop-in for TinyLLamaModel that runs the model in a subprocess pinned to `cores`.
+
+    Requests and token deltas travel over a multiprocessing Pipe. A reader thread in the parent
+    resolves futures on the event loop; the child decodes one request at a time, so the owning
+    ModelWorker should allow a concurrency of 1 and keep the queue on the routing side.
+    The reader thread is shared by every request, so `on_token` is a coroutine function awaited on
+    the event loop (see TokenRelay), never called on the reader. Streaming is credit based: the child
+    sends at most STREAM_BUFFER_SIZE deltas ahead of what `on_token` has taken, and waits for more.
+    """
+
+    _ids = itertools.count()
+    tokens_on_loop = True
+
+    def __init__(self, model_path: str, cores: Tuple[int, ...]):
+        self.model_path = model_path
+        self.cores = cores
+        ctx = multiprocessing.get_context("spawn")  # forking a process that holds llama.cpp threads is unsafe
+        self.conn, child_conn = ctx.Pipe()
+        self._send_lock = threading.Lock()  # requests and credit go out from the loop, cancels from any thread
+        self.process = ctx.Process(target=_worker_main, args=(child_conn, model_path, cores), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+        kind, _, payload = self.conn.recv()  # blocks until the child has loaded the model
+        if kind != "ready":
+            raise RuntimeError(f"Model process failed to start: {payload}")
+        self._context_bytes = payload
+        self._pending: Dict[int, Tuple[asyncio.AbstractEventLoop, asyncio.Future, Optional[TokenRelay]]] = {}
+        self._reader = threading.Thread(target=self._read_replies, name=f"model-proc-{self.process.pid}", daemon=True)
+        self._reader.start()
+        logging.info(f"[PROCESS] Started model process {self.process.pid} on cores {list(cores)}")
+
+    def _read_replies(self):
+        while True:
+            try:
+                kind, request_id, payload = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            loop, future, relay = self._pending[request_id]
+            if kind == "token":
+                # Never waits for the client: a slow one would stall the replies of every other request.
+                # Bounded all the same, the child only sends what it has credit for
+                if relay is not None:
+                    relay.push(payload)
+                continue
+            del self._pending[request_id]
+            if kind == "done":
+                text, self._context_bytes, avoided = payload
+                WASTED_TOKENS_AVOIDED.inc(avoided)  # counted in the child, exported from here
+                loop.call_soon_threadsafe(_resolve, future, text, None)
+            else:
+                loop.call_soon_threadsafe(_resolve, future, None, RuntimeError(payload))
+
+        # Child went away: fail whatever was still waiting so the caller can retry elsewhere
+        for request_id, (loop, future, _) in list(self._pending.items()):
+            loop.call_soon_threadsafe(_resolve, future, None, RuntimeError("Model process exited"))
+        self._pending.clear()
+
+    async def generate(self, prompt: str, max_tokens: int = 128, on_token: Optional[Callable[[str], Awaitable[None]]] = None,
+                       cancel: Optional[threading.Event] = None):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        request_id = next(self._ids)
+        relay = TokenRelay(self._granting_credit(request_id, on_token), loop) if on_token is not None else None
+        self._pending[request_id] = (loop, future, relay)
+        self._send((request_id, prompt, max_tokens, on_token is not None))
+        send_cancel = functools.partial(self._send_cancel, request_id)
+        if isinstance(cancel, CancelToken):
+            cancel.add_callback(send_cancel)  # every caller gave up: stop the child's token loop
+        try:
+            text = await asyncio.shield(future)
+            if relay is not None:
+                await relay.finish()  # the reader scheduled every delta before resolving the future
+                if relay.error is not None:
+                    raise relay.error
+            return text
+        except asyncio.CancelledError:
+            send_cancel()
+            await asyncio.wait({future})  # child answers "done" once its token loop has stopped
+            raise
+        finally:
+            if relay is not None:
+                relay.cancel()
+            if isinstance(cancel, CancelToken):
+                cancel.remove_callback(send_cancel)
+
+    def _send(self, message):
+        with self._send_lock:
+            self.conn.send(message)
+
+    def _granting_credit(self, request_id: int, on_token: Callable[[str], Awaitable[None]]):
+        # Wraps on_token: credit goes back to the child once the reader has taken the deltas
+        taken = 0
+
+        async def deliver(delta: str):
+            nonlocal taken
+            try:
+                await on_token(delta)
+            except Exception:
+                self._send_cancel(request_id)  # nobody to deliver to; generate raises the relay's error
+                raise
+            taken += 1
+            if taken >= CREDIT_BATCH and request_id in self._pending:
+                try:
+                    self._send(("credit", request_id, taken))
+                except (BrokenPipeError, OSError):
+                    return
+                taken = 0
+
+        return deliver
+
+    def _send_cancel(self, request_id: int):
+        if request_id in self._pending:
+            try:
+                self._send(("cancel", request_id))
+            except (BrokenPipeError, OSError):
+                pass
+
+    def prefix_match_chars(self, prompt: str) -> int:
+        # The child's prefix cache is not visible from here, so routing treats it as cold
+        return 0
+
+    def context_bytes(self) -> int:
+        # Last value the child reported, refreshed after every request
+        return self._context_bytes
+
+    def close(self):
+        try:
+            self._send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+
+
+def _resolve(future: asyncio.Future, result, error: Optional[Exception]):
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
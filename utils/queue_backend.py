@@ -0,0 +1,385 @@
+import asyncio
+import concurrent.futures
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Callable, Deque, Dict, Optional
+from prometheus_client import Gauge
+from utils import config
+
+CONSUMER_TIMEOUT = 10.0  # seconds without a heartbeat before a process counts as gone
+HEARTBEAT_SECONDS = 1.0
+IDLE_POLL_SECONDS = 0.1  # an idle process backs off to polling this often
+
+SHARED_QUEUE_DEPTH = Gauge("shared_queue_depth", "Requests waiting in the shared queue, across every process")
+SHARED_QUEUE_CONSUMERS = Gauge("shared_queue_consumers", "Processes pulling from the shared queue")
+
+
+class MemoryQueue(asyncio.Queue):
+    """The default backend: an asyncio.Queue private to this process."""
+
+    def depth(self) -> int:
+        return self.qsize()
+
+    def consumers(self) -> int:
+        return 1
+
+    def close(self):
+        pass
+
+
+class ReplyChannel:
+    """Stands in for the TokenChannel of a request enqueued by another process; deltas become replies."""
+
+    closed = False
+
+    def __init__(self, broker: "SQLiteQueue", job: int, owner: str):
+        self.broker = broker
+        self.job = job
+        self.owner = owner
+
+    def put_threadsafe(self, delta: str):
+        self.broker._reply(self.job, self.owner, "token", delta)
+
+
+class SQLiteQueue:
+    """A queue in a SQLite file, shared by every process that opens the same path.
+
+    Each process enqueues its requests as rows, and any process's batching loop may claim the
+    oldest one. A request claimed by the process that enqueued it runs as usual. One claimed
+    elsewhere gets a stand-in BatchedRequest whose token deltas, result or error are written back as
+    replies addressed to the enqueuer, which relays them to its waiting callers; cancelling on the
+    enqueuing side sets a flag the running side polls. Processes heartbeat, so depth can be split
+    between live consumers and the requests of a process that went away are cleaned up.
+
+    Every statement runs on one thread of our own, in submission order, so a write waiting on
+    another process's lock never stalls the event loop. put_nowait only queues the insert, `depth`
+    is the count from the last poll plus what we enqueued since, and `get` claims up to
+    `claim_size` rows in one write, which get_nowait then hands out. Empty polls back off to
+    IDLE_POLL_SECONDS; an enqueue in this process wakes its own getter at once.
+
+    Same interface as MemoryQueue: put_nowait, get, get_nowait, qsize, depth, consumers, close.
+    """
+
+    def __init__(self, path: str = config.QUEUE_PATH, maxsize: int = 0,
+                 poll_interval: float = config.QUEUE_POLL_MS / 1000, name: Optional[str] = None,
+                 claim_size: int = config.BATCH_SIZE_LIMIT):
+        self.path = path
+        self.maxsize = maxsize  # for the queue as a whole, not per process; checked against the polled depth
+        self.poll_interval = poll_interval
+        self.claim_size = claim_size
+        self.name = name or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.db = sqlite3.connect(path, timeout=5.0, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()  # held by the database thread, and by close
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-queue")
+        with self._lock:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, owner TEXT NOT NULL, claimed_by TEXT,
+                    prompt TEXT NOT NULL, max_tokens INTEGER NOT NULL, prompt_tokens INTEGER, model TEXT,
+                    stream INTEGER NOT NULL, enqueued_at REAL NOT NULL, cancelled INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE INDEX IF NOT EXISTS jobs_unclaimed ON jobs (claimed_by, id);
+                CREATE TABLE IF NOT EXISTS replies (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, job INTEGER NOT NULL, owner TEXT NOT NULL,
+                    kind TEXT NOT NULL, payload TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS replies_owner ON replies (owner, id);
+                CREATE TABLE IF NOT EXISTS consumers (name TEXT PRIMARY KEY, seen_at REAL NOT NULL);
+            """)
+            self._depth = self.db.execute("SELECT COUNT(*) FROM jobs WHERE claimed_by IS NULL").fetchone()[0]
+        self.local: Dict[int, object] = {}  # requests this process enqueued, by job id
+        self.remote: Dict[int, object] = {}  # other processes' requests running here
+        self._claimed: Deque[tuple] = deque()  # rows claimed by our last get, not handed out yet
+        self._inboxes: Dict[int, asyncio.Queue] = {}  # replies waiting to be relayed, per local job
+        self._relays: set = set()
+        self._last_reply = 0
+        self._last_heartbeat = 0.0
+        self._consumers = 1
+        self._poller: Optional[asyncio.Task] = None
+        self._enqueued: Optional[asyncio.Event] = None
+
+    def _execute(self, sql: str, params: tuple = ()) -> list:
+        # Database thread only
+        with self._lock:
+            return self.db.execute(sql, params).fetchall()
+
+    def _submit(self, fn: Callable, *args):
+        # Fire and forget, for writes nobody waits on; still runs in order with everything else
+        try:
+            self._executor.submit(fn, *args).add_done_callback(_log_failure)
+        except RuntimeError:
+            pass  # closed: a late reply or cleanup has nowhere to go
+
+    def _start(self):
+        if self._poller is None:
+            self._enqueued = asyncio.Event()
+            self._poller = asyncio.ensure_future(self._poll())
+
+    def _backoff(self, empty_polls: int) -> float:
+        return max(self.poll_interval, min(IDLE_POLL_SECONDS, self.poll_interval * 2 ** empty_polls))
+
+    # Queue interface
+
+    def qsize(self) -> int:
+        return self.depth()
+
+    def depth(self) -> int:
+        return self._depth + len(self._claimed)
+
+    def consumers(self) -> int:
+        return self._consumers
+
+    def put_nowait(self, req):
+        self._start()
+        if self.maxsize > 0 and self.depth() >= self.maxsize:
+            raise asyncio.QueueFull()
+        self._depth += 1  # until the next poll counts it
+        loop = asyncio.get_event_loop()
+        insert = self._executor.submit(
+            self._insert, req, (self.name, req.prompt, req.max_tokens, req.prompt_tokens, req.model,
+                                int(bool(req.channels)), time.time())
+        )
+        insert.add_done_callback(lambda done: loop.call_soon_threadsafe(_fail_if_not_queued, req, done))
+        # From whichever thread sets it; the insert has run by the time these do
+        req.cancel_event.add_callback(lambda: self._submit(self._cancel_job, insert))
+        req.future.add_done_callback(lambda _: self._submit(self._forget, insert))
+        self._enqueued.set()
+
+    def _insert(self, req, row: tuple) -> int:
+        (job,), = self._execute(
+            "INSERT INTO jobs (owner, prompt, max_tokens, prompt_tokens, model, stream, enqueued_at)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?) RETURNING id", row
+        )
+        self.local[job] = req  # before any claim of ours can return the row
+        return job
+
+    def get_nowait(self):
+        if not self._claimed:
+            raise asyncio.QueueEmpty()
+        job, owner, prompt, max_tokens, prompt_tokens, model, stream, enqueued_at, cancelled = self._claimed.popleft()
+        if owner == self.name and job in self.local:
+            return self.local[job]
+        return self._remote_request(job, owner, prompt, max_tokens, prompt_tokens, model, stream, enqueued_at, cancelled)
+
+    async def get(self):
+        self._start()
+        empty_polls = 0
+        while not self._claimed:
+            self._enqueued.clear()  # before claiming, so an enqueue during the claim still wakes us
+            claim = asyncio.get_event_loop().run_in_executor(self._executor, self._claim)
+            try:
+                rows = await asyncio.shield(claim)
+            except asyncio.CancelledError:
+                claim.add_done_callback(self._keep_claimed)
+                raise
+            if rows:
+                self._claimed.extend(rows)
+                break
+            empty_polls += 1
+            try:
+                await asyncio.wait_for(self._enqueued.wait(), self._backoff(empty_polls))
+            except asyncio.TimeoutError:
+                pass
+        return self.get_nowait()
+
+    def _keep_claimed(self, claim: asyncio.Future):
+        # The get that claimed these was cancelled, but the rows are ours now: hand them out next
+        if not claim.cancelled() and claim.exception() is None:
+            self._claimed.extend(claim.result())
+
+    def _claim(self) -> list:
+        # A read first: an empty queue never takes the write lock other processes are waiting on
+        if not self._execute("SELECT 1 FROM jobs WHERE claimed_by IS NULL LIMIT 1"):
+            return []
+        rows = self._execute(
+            "UPDATE jobs SET claimed_by = ? WHERE id IN"
+            " (SELECT id FROM jobs WHERE claimed_by IS NULL ORDER BY id LIMIT ?)"
+            " RETURNING id, owner, prompt, max_tokens, prompt_tokens, model, stream, enqueued_at, cancelled",
+            (self.name, self.claim_size)
+        )
+        return sorted(rows)
+
+    def close(self):
+        if self._poller is not None:
+            self._poller.cancel()
+        for relay in list(self._relays):
+            relay.cancel()
+        unclaimed = [row[0] for row in self._claimed]
+        self._claimed.clear()
+        self._submit(self._leave, unclaimed)
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            self.db.close()
+
+    def _leave(self, unclaimed: list):
+        # Claimed but never handed out: back to the queue for the other processes
+        for job in unclaimed:
+            self._execute("UPDATE jobs SET claimed_by = NULL WHERE id = ? AND claimed_by = ?", (job, self.name))
+        self._execute("DELETE FROM consumers WHERE name = ?", (self.name,))
+
+    # Running another process's request
+
+    def _remote_request(self, job, owner, prompt, max_tokens, prompt_tokens, model, stream, enqueued_at, cancelled):
+        from utils.batching import BatchedRequest  # batching builds its queue from this module
+
+        channel = ReplyChannel(self, job, owner) if stream else None
+        req = BatchedRequest(prompt, max_tokens, asyncio.get_event_loop().create_future(), channel, prompt_tokens, model)
+        # Queue wait started on the enqueuer's clock
+        req.enqueued_at = time.monotonic() - max(0.0, time.time() - enqueued_at)
+        req.trace.enqueued_at = req.enqueued_at
+        if cancelled:
+            req.cancel_event.set()
+        self.remote[job] = req
+        req.future.add_done_callback(lambda future: self._reply_outcome(job, owner, future))
+        return req
+
+    def _reply(self, job: int, owner: str, kind: str, payload: str):
+        # Any thread; the insert is queued behind earlier replies, so deltas stay in order
+        self._submit(
+            self._execute, "INSERT INTO replies (job, owner, kind, payload) VALUES (?, ?, ?, ?)", (job, owner, kind, payload)
+        )
+
+    def _reply_outcome(self, job: int, owner: str, future: asyncio.Future):
+        self.remote.pop(job, None)
+        if future.cancelled():
+            kind, payload = "cancelled", ""
+        elif future.exception() is not None:
+            kind, payload = "error", str(future.exception())
+        else:
+            kind, payload = "result", future.result()
+        self._reply(job, owner, kind, payload)
+
+    # Relaying replies to this process's callers
+
+    def _deliver(self, job: int, kind: str, payload: str):
+        inbox = self._inboxes.get(job)
+        if inbox is None:
+            req = self.local.get(job)
+            if req is None:
+                return  # finished already
+            inbox = self._inboxes[job] = asyncio.Queue()
+            relay = asyncio.ensure_future(self._relay(req, inbox))
+            self._relays.add(relay)
+            relay.add_done_callback(self._relays.discard)
+        inbox.put_nowait((kind, payload))
+
+    async def _relay(self, req, inbox: asyncio.Queue):
+        # One task per request, so a slow reader only holds up its own deltas
+        while True:
+            kind, payload = await inbox.get()
+            if kind == "token":
+                await req.emit_async(payload)
+                continue
+            if not req.future.done():
+                if kind == "result":
+                    req.future.set_result(payload)
+                elif kind == "error":
+                    req.future.set_exception(Exception(payload))
+                else:
+                    req.future.cancel()
+            return
+
+    def _cancel_job(self, insert: concurrent.futures.Future):
+        if insert.exception() is None:
+            self._execute("UPDATE jobs SET cancelled = 1 WHERE id = ?", (insert.result(),))
+
+    def _forget(self, insert: concurrent.futures.Future):
+        if insert.exception() is not None:
+            return
+        job = insert.result()
+        self.local.pop(job, None)
+        self._inboxes.pop(job, None)
+        try:
+            self._execute("DELETE FROM jobs WHERE id = ?", (job,))
+            self._execute("DELETE FROM replies WHERE job = ?", (job,))
+        except sqlite3.Error as e:
+            logging.warning(f"[QUEUE] Could not remove finished job {job}: {e}")
+
+    async def _poll(self):
+        empty_polls = 0
+        while True:
+            try:
+                await self.refresh()
+            except sqlite3.Error as e:
+                logging.warning(f"[QUEUE] Polling the shared queue failed: {e}")
+            # Replies only come for requests in flight; with none, and nothing queued, poll less often
+            busy = self.local or self.remote or self._depth
+            empty_polls = 0 if busy else empty_polls + 1
+            await asyncio.sleep(self._backoff(empty_polls))
+
+    async def refresh(self):
+        """One poll: relay new replies, notice cancellations, heartbeat and recount the depth."""
+        now = time.time()
+        replies, wanted, lost, self._depth = await asyncio.get_event_loop().run_in_executor(
+            self._executor, self._poll_once, now, self._last_reply, bool(self.remote)
+        )
+        for reply_id, job, kind, payload in replies:
+            self._last_reply = reply_id
+            self._deliver(job, kind, payload)
+        if wanted is not None:
+            # Enqueuer cancelled, or went away and its rows were cleaned up
+            for job, req in list(self.remote.items()):
+                if job not in wanted:
+                    req.cancel_event.set()
+        for job in lost:
+            self._deliver(job, "error", "The process running the request stopped")
+
+    def _poll_once(self, now: float, last_reply: int, running_remote: bool):
+        # Database thread: reads and heartbeat writes only, the event loop applies the results
+        replies = self._execute(
+            "SELECT id, job, kind, payload FROM replies WHERE owner = ? AND id > ? ORDER BY id", (self.name, last_reply)
+        )
+        wanted = None
+        if running_remote:
+            wanted = {job for job, in self._execute("SELECT id FROM jobs WHERE claimed_by = ? AND cancelled = 0", (self.name,))}
+        lost = self._heartbeat(now) if now - self._last_heartbeat >= HEARTBEAT_SECONDS else []
+        depth = self._execute("SELECT COUNT(*) FROM jobs WHERE claimed_by IS NULL")[0][0]
+        SHARED_QUEUE_DEPTH.set(depth)
+        return replies, wanted, lost, depth
+
+    def _heartbeat(self, now: float) -> list:
+        # Database thread; returns our jobs whose runner stopped
+        self._last_heartbeat = now
+        cutoff = now - CONSUMER_TIMEOUT
+        live = "(SELECT name FROM consumers WHERE seen_at > ?)"
+        self._execute("INSERT OR REPLACE INTO consumers (name, seen_at) VALUES (?, ?)", (self.name, now))
+        # Nobody is waiting for the requests of a process that stopped
+        self._execute(f"DELETE FROM jobs WHERE owner NOT IN {live}", (cutoff,))
+        self._execute(f"DELETE FROM replies WHERE owner NOT IN {live}", (cutoff,))
+        self._execute("DELETE FROM consumers WHERE seen_at <= ?", (cutoff,))
+        # Ours that were claimed by a process that stopped will never get a reply
+        lost = self._execute(
+            f"SELECT id FROM jobs WHERE owner = ? AND claimed_by IS NOT NULL AND claimed_by != ? AND claimed_by NOT IN {live}",
+            (self.name, self.name, cutoff)
+        )
+        self._consumers = max(1, self._execute("SELECT COUNT(*) FROM consumers")[0][0])
+        SHARED_QUEUE_CONSUMERS.set(self._consumers)
+        return [job for job, in lost]
+
+
+def _fail_if_not_queued(req, insert: concurrent.futures.Future):
+    if insert.exception() is not None and not req.future.done():
+        logging.error(f"[QUEUE] Could not enqueue a request: {insert.exception()}")
+        req.future.set_exception(insert.exception())
+
+
+def _log_failure(done: concurrent.futures.Future):
+    if not done.cancelled() and done.exception() is not None:
+        logging.error(f"[QUEUE] Shared queue write failed: {done.exception()}")
+
+
+def make_queue(maxsize: int = 0):
+    """Queue backend picked by INFERSAFE_QUEUE_BACKEND."""
+    if config.QUEUE_BACKEND == "memory":
+        return MemoryQueue(maxsize=maxsize)
+    if config.QUEUE_BACKEND == "sqlite":
+        return SQLiteQueue(config.QUEUE_PATH, maxsize)
+    raise ValueError(f"Unknown queue backend {config.QUEUE_BACKEND!r}, expected 'memory' or 'sqlite'")
@@ -0,0 +1,32 @@
+import time
+from collections import OrderedDict
+from typing import Hashable, Optional
+
+
+class ResponseCache:
+    """Bounded LRU cache of finished generations with a per-entry TTL.
+
+    Only safe for deterministic (greedy) decoding, otherwise a hit would pin one random sample.
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: "OrderedDict[Hashable, tuple[float, str]]" = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[str]:
+        item = self.entries.get(key)
+        if item is None:
+            return None
+        expires_at, text = item
+        if expires_at < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return text
+
+    def put(self, key: Hashable, text: str):
+        self.entries[key] = (time.monotonic() + self.ttl, text)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
@@ -0,0 +1,114 @@
+import asyncio
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+STREAM_BUFFER_SIZE = 64  # max token deltas buffered per request before the model thread waits
+
+
+class TokenChannel:
+    """Carries token deltas from the executor thread that runs the model to the HTTP response.
+
+    The queue is bounded, so a client that reads slowly makes the generating thread
+    wait on `put_threadsafe` instead of buffering the whole completion in memory.
+    """
+
+    def __init__(self, maxsize: int = STREAM_BUFFER_SIZE):
+        self.loop = asyncio.get_event_loop()
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.emitted = 0  # number of deltas pushed so far
+        self.closed = False
+
+    def put_threadsafe(self, delta: str):
+        # Called from the model's executor thread, blocks while the queue is full (backpressure)
+        if self.closed:
+            return
+        self.emitted += 1
+        asyncio.run_coroutine_threadsafe(self.queue.put(delta), self.loop).result()
+
+    async def put(self, delta: str):
+        # Event-loop side, waits for room like put_threadsafe does
+        if self.closed:
+            return
+        self.emitted += 1
+        await self.queue.put(delta)
+
+    def put_nowait(self, delta: str):
+        # Event-loop side counterpart of put_threadsafe, only for a channel that still has room
+        self.emitted += 1
+        self.queue.put_nowait(delta)
+
+    def close(self):
+        # Reader went away: drop buffered deltas so a blocked producer can finish
+        self.closed = True
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+    async def iter_until(self, future: asyncio.Future, timeout: float) -> AsyncIterator[str]:
+        """Yield deltas as they arrive until `future` resolves and the buffer is drained.
+
+        Raises asyncio.TimeoutError if the whole generation takes longer than `timeout`.
+        """
+        deadline = self.loop.time() + timeout
+        while True:
+            if not self.queue.empty():
+                yield self.queue.get_nowait()
+                continue
+            if future.done():
+                # Every put completes before the model call returns, so nothing is left in flight
+                return
+            remaining = deadline - self.loop.time()
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            getter = asyncio.ensure_future(self.queue.get())
+            done, _ = await asyncio.wait({getter, future}, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            if getter in done:
+                yield getter.result()
+            else:
+                getter.cancel()
+
+
+class TokenRelay:
+    """Hands deltas from a model thread to `on_token` on the event loop, in order, without blocking.
+
+    For models whose own thread is shared (a process worker's reply reader, the continuous-batching
+    engine): `push` only schedules the delta, and `on_token` (a coroutine function such as
+    BatchedRequest.emit_async) waits on the loop for room in the reader's channel, so a slow reader
+    backs up its own relay and nothing else. `backlog` tells the producer how far behind it is.
+    """
+
+    def __init__(self, on_token: Callable[[str], Awaitable[None]], loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.on_token = on_token
+        self.loop = loop or asyncio.get_event_loop()
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.pushed = 0  # written by the producer only
+        self.delivered = 0  # written by the relay task only
+        self.error: Optional[Exception] = None  # first exception raised by on_token
+        self._task = self.loop.create_task(self._run())
+
+    @property
+    def backlog(self) -> int:
+        return self.pushed - self.delivered
+
+    def push(self, delta: str):
+        # Any thread
+        self.pushed += 1
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, delta)
+
+    async def _run(self):
+        while True:
+            delta = await self.queue.get()
+            if delta is None:
+                return
+            if self.error is None:
+                try:
+                    await self.on_token(delta)
+                except Exception as e:
+                    self.error = e
+            self.delivered += 1
+
+    async def finish(self):
+        """Wait until every delta pushed before this call has been delivered (event loop only)."""
+        self.queue.put_nowait(None)
+        await asyncio.shield(self._task)
+
+    def cancel(self):
+        self._task.cancel()
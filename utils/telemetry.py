@@ -0,0 +1,165 @@
+import json
+import logging
+import queue
+import random
+import threading
+import time
+from typing import Optional
+from prometheus_client import Counter, Histogram
+from utils import config
+
+# Seconds; spans 5 ms (a cache hit) to a minute (a long generation behind a full queue)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+QUEUE_WAIT = Histogram("inference_queue_wait_seconds", "Enqueue to batch dispatch", buckets=LATENCY_BUCKETS)
+DISPATCH_TIME = Histogram(
+    "inference_dispatch_seconds", "Batch dispatch to a worker starting the request (routing and worker slot wait)",
+    buckets=LATENCY_BUCKETS
+)
+TIME_TO_FIRST_TOKEN = Histogram("inference_time_to_first_token_seconds", "Time from request arrival to the first streamed token")
+INTER_TOKEN_LATENCY = Histogram(
+    "inference_inter_token_seconds", "Gap between consecutive generated tokens of a request",
+    buckets=(0.005, 0.01, 0.02, 0.035, 0.05, 0.075, 0.1, 0.2, 0.5, 1.0)
+)
+TOTAL_LATENCY = Histogram("inference_total_latency_seconds", "Enqueue to final result, retries included", buckets=LATENCY_BUCKETS)
+TOKENS_PER_SECOND = Histogram(
+    "inference_tokens_per_second", "Decode speed of a request after its first token",
+    buckets=(1, 2, 5, 10, 20, 35, 50, 75, 100, 200, 500)
+)
+BATCH_SIZE = Histogram("inference_batch_size", "Requests per dispatched batch", buckets=(1, 2, 4, 8, 16, 32, 64))
+WORKER_BATCH_SIZE = Histogram(
+    "model_worker_batch_size", "Requests running together on a worker when one of them starts", ["worker"],
+    buckets=(1, 2, 3, 4, 6, 8, 12, 16)
+)
+WORKER_BUSY_SECONDS = Counter(
+    "model_worker_busy_seconds_total", "Time a worker had at least one request running; rate() is its utilisation", ["worker"]
+)
+
+_WALL_OFFSET = time.time() - time.monotonic()  # converts monotonic stamps to epoch seconds for spans
+
+
+def forget_worker(name: str):
+    # Drop a retired worker's labelled series so they don't linger in /metrics
+    for metric in (WORKER_BATCH_SIZE, WORKER_BUSY_SECONDS):
+        try:
+            metric.remove(name)
+        except KeyError:
+            pass
+
+
+class SpanExporter:
+    """Appends sampled request traces to a JSONL file from a background thread.
+
+    `export` never blocks the caller: records go through a bounded queue and are dropped
+    (and counted) if the writer falls behind.
+    """
+
+    def __init__(self, path: str, max_pending: int = 1000):
+        self.path = path
+        self.queue: "queue.Queue" = queue.Queue(maxsize=max_pending)
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._write, name="span-exporter", daemon=True)
+        self._thread.start()
+
+    def export(self, record: dict):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _write(self):
+        with open(self.path, "a", buffering=1) as f:
+            while True:
+                record = self.queue.get()
+                if record is None:
+                    return
+                f.write(json.dumps(record) + "\n")
+
+    def close(self):
+        self.queue.put(None)
+        self._thread.join(timeout=5)
+
+
+_exporter: Optional[SpanExporter] = None
+_exporter_lock = threading.Lock()
+
+
+def _span_exporter() -> SpanExporter:
+    global _exporter
+    with _exporter_lock:
+        if _exporter is None:
+            _exporter = SpanExporter(config.TRACE_FILE)
+            logging.info(f"[TELEMETRY] Exporting sampled request traces to {config.TRACE_FILE}")
+        return _exporter
+
+
+class RequestTrace:
+    """Stage timestamps of one request, turned into histogram samples once it finishes.
+
+    Marks are plain attribute writes; `token` runs on the decoding thread for every token, so it
+    does one histogram observe and nothing else.
+    """
+
+    __slots__ = ("enqueued_at", "dispatched_at", "started_at", "first_token_at", "last_token_at",
+                 "tokens", "worker", "attempts", "sampled")
+
+    def __init__(self, enqueued_at: Optional[float] = None):
+        self.enqueued_at = time.monotonic() if enqueued_at is None else enqueued_at
+        self.dispatched_at: Optional[float] = None
+        self.started_at: Optional[float] = None
+        self.first_token_at: Optional[float] = None
+        self.last_token_at: Optional[float] = None
+        self.tokens = 0
+        self.worker: Optional[str] = None
+        self.attempts = 0
+        rate = config.TRACE_SAMPLE_RATE
+        self.sampled = rate > 0 and random.random() < rate
+
+    def dispatched(self, now: Optional[float] = None):
+        self.dispatched_at = time.monotonic() if now is None else now
+        QUEUE_WAIT.observe(self.dispatched_at - self.enqueued_at)
+
+    def started(self, worker: str):
+        # Called once per attempt when a worker slot is acquired; dispatch time counts the first one
+        now = time.monotonic()
+        self.attempts += 1
+        self.worker = worker
+        if self.started_at is None:
+            self.started_at = now
+            if self.dispatched_at is not None:
+                DISPATCH_TIME.observe(now - self.dispatched_at)
+
+    def token(self):
+        now = time.monotonic()
+        if self.last_token_at is None:
+            self.first_token_at = now
+        else:
+            INTER_TOKEN_LATENCY.observe(now - self.last_token_at)
+        self.last_token_at = now
+        self.tokens += 1
+
+    def finish(self, outcome: str):
+        now = time.monotonic()
+        TOTAL_LATENCY.observe(now - self.enqueued_at)
+        if self.tokens > 1 and self.last_token_at > self.first_token_at:
+            TOKENS_PER_SECOND.observe((self.tokens - 1) / (self.last_token_at - self.first_token_at))
+        if self.sampled:
+            _span_exporter().export(self.to_record(outcome, now))
+
+    def to_record(self, outcome: str, finished_at: float) -> dict:
+        stages = [
+            ("queue", self.enqueued_at, self.dispatched_at),
+            ("dispatch", self.dispatched_at, self.started_at),
+            ("prefill", self.started_at, self.first_token_at),
+            ("decode", self.first_token_at, self.last_token_at),
+        ]
+        spans = [
+            {"name": name, "start": round(start + _WALL_OFFSET, 6), "duration": round(end - start, 6)}
+            for name, start, end in stages if start is not None and end is not None
+        ]
+        return {
+            "start": round(self.enqueued_at + _WALL_OFFSET, 6),
+            "duration": round(finished_at - self.enqueued_at, 6),
+            "outcome": outcome, "worker": self.worker, "attempts": self.attempts, "tokens": self.tokens,
+            "spans": spans,
+        }